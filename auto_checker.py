@@ -1,11 +1,15 @@
 import sys
 import os
-import io
-import boto3
-from typing import Iterable, Dict, Any, List, Generator, Tuple
-from pypdf import PdfReader
+import time
+import argparse
+from typing import Iterable, Dict, Any, List, Generator, Tuple, TYPE_CHECKING
 
-from pdf_to_vector import convert_to_vectors
+from concurrent.futures import ProcessPoolExecutor
+from pdf_extract import extract_pdf_text, extract_pdf_file_parallel, download_to_spool, download_to_tempfile, reset_peak_rss, peak_rss_kb, PAGE_TIMEOUT_SECONDS
+import pdf_to_vector
+from pdf_to_vector import convert_to_vectors, upsert_documents, PAGE_SEPARATOR, EMBED_BATCH_SIZE
+import ingest_pipeline
+from ingest_pipeline import IngestPipeline, reindex_from_store
 
 sys.path.append(
     os.path.abspath(
@@ -13,31 +17,46 @@ sys.path.append(
     )
 )
 
-from pymilvus import MilvusClient, Collection
+from milvus_pool import get_client, milvus_uri, BufferedWriter
+from milvus_index import ensure_collection
+from etag_manifest import EtagManifest, rebuild_manifest, ETAG_MANIFEST_PATH
+from s3_listing import ShardSpec, ListingCheckpoint, iter_listing, parse_shard
+from text_store import TextStore, TEXT_STORE_DIR
+import metrics
+from bill_fields import BillFieldStore, BILL_FIELDS_DIR, backfill_from_text_store
+
+if TYPE_CHECKING:
+    from pymilvus import MilvusClient
 
 from credentials import ORACLE_S3_ACCESS_KEY, ORACLE_S3_SECRET_KEY, ORACLE_S3_ENDPOINT, ORACLE_REGION, ORACLE_INGEST_BUCKET, MILVUS_HOST, MILVUS_PORT, COLLECTION_NAME
 
-s3_client = boto3.client(
-    "s3",
-    aws_access_key_id=ORACLE_S3_ACCESS_KEY,
-    aws_secret_access_key=ORACLE_S3_SECRET_KEY,
-    endpoint_url=ORACLE_S3_ENDPOINT
-)
+# --- Lazily Created Clients ---
+# Importing this module has no side effects; clients are created on first use.
+_s3_client = None
 
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        import boto3
 
-client = MilvusClient("http://"+MILVUS_HOST+":"+MILVUS_PORT, db_name="default")
+        _s3_client = boto3.client(
+            "s3",
+            aws_access_key_id=ORACLE_S3_ACCESS_KEY,
+            aws_secret_access_key=ORACLE_S3_SECRET_KEY,
+            endpoint_url=ORACLE_S3_ENDPOINT
+        )
+    return _s3_client
 
-if not client.has_collection(COLLECTION_NAME):
-    client.create_collection(
-        collection_name=COLLECTION_NAME,
-        dimension=768,
-        metric_type="COSINE",
-        auto_id=True,
-        enable_dynamic_field=True
-    )
-    print(f"Collection '{COLLECTION_NAME}' created.")
-else:
-    print(f"Collection '{COLLECTION_NAME}' already exists.")
+
+def get_milvus_client() -> "MilvusClient":
+    return get_client(milvus_uri(MILVUS_HOST, MILVUS_PORT), db_name="default")
+
+
+def warmup():
+    """Creates the clients and loads the embedding model before the first document arrives."""
+    get_s3_client()
+    ensure_collection(get_milvus_client(), COLLECTION_NAME)
+    pdf_to_vector.warmup()
 
 
 def _norm_etag(x: str) -> str:
@@ -47,7 +66,7 @@ def _batched(seq: List[str], n: int) -> Iterable[List[str]]:
     for i in range(0, len(seq), n):
         yield seq[i:i+n]
 
-def _query_existing_etags(client: MilvusClient, collection: str, etags: List[str], etag_field="etag", batch_size=500) -> set:
+def _query_existing_etags(client: "MilvusClient", collection: str, etags: List[str], etag_field="etag", batch_size=500) -> set:
     """Check existence in Milvus in IN-batches; returns a set of found etags."""
     found = set()
     in_list = ",".join([f'"{e}"' for e in etags])
@@ -68,22 +87,34 @@ def iter_new_objects_by_etag(
     s3_client,
     bucket: str,
     prefix: str,
-    milvus_client: MilvusClient,
+    milvus_client: "MilvusClient",
     collection_name: str,
     etag_field: str = "ETag",
     page_batch_check: int = 750,
+    manifest: EtagManifest = None,
+    shard: ShardSpec = None,
+    resume_key: str = None,
+    checkpoint: ListingCheckpoint = None,
 ) -> Generator[Dict[str, Any], None, None]:
     """
     Stream pages from S3/OCI and yield only objects whose ETag is NOT already in Milvus.
     Memory-friendly: handles a single page at a time.
+    With a manifest, existence is checked locally and Milvus is never queried.
+    Only objects owned by `shard` and sorting after `resume_key` are listed;
+    every listed key is registered with `checkpoint`.
     """
-    paginator = s3_client.get_paginator("list_objects_v2")
-    pages = paginator.paginate(Bucket=bucket, Prefix=prefix or "")
+    pages = iter_listing(s3_client, bucket, prefix=prefix, shard=shard, resume_key=resume_key)
 
 
-    milvus_client.load_collection(collection_name)
+    if manifest is None:
+        milvus_client.load_collection(collection_name)
 
-    for page in pages:
+    while True:
+        t_list = time.time()
+        with metrics.timed("list"):
+            page = next(pages, None)
+        if page is None:
+            break
         contents = page.get("Contents", []) or []
         if not contents:
             continue
@@ -92,20 +123,38 @@ def iter_new_objects_by_etag(
         for obj in contents:
             etg = _norm_etag(obj.get("ETag"))
             if not etg:
+                if checkpoint is not None:
+                    checkpoint.listed(obj["Key"], new=False)
                 continue
             etag_to_objs.setdefault(etg, []).append(obj)
 
         unique_etags = list(etag_to_objs.keys())
 
         existing = set()
-        for sub in _batched(unique_etags, page_batch_check):
-            existing |= _query_existing_etags(
-                milvus_client, collection_name, sub, etag_field=etag_field, batch_size=page_batch_check
-            )
-
+        with metrics.timed("dedupe"):
+            if manifest is not None:
+                existing = manifest.contains_many(unique_etags)
+            else:
+                for sub in _batched(unique_etags, page_batch_check):
+                    existing |= _query_existing_etags(
+                        milvus_client, collection_name, sub, etag_field=etag_field, batch_size=page_batch_check
+                    )
+        n_new = sum(len(objs) for etg, objs in etag_to_objs.items() if etg not in existing)
+        metrics.DOCUMENTS.inc(n_new, stage="list", result="new")
+        metrics.DOCUMENTS.inc(len(contents) - n_new, stage="list", result="existing")
+
+        if checkpoint is not None:
+            for obj in contents:
+                etg = _norm_etag(obj.get("ETag"))
+                if etg:
+                    checkpoint.listed(obj["Key"], new=etg not in existing)
+
+        t_listed = time.time()
         for etg, objs in etag_to_objs.items():
             if etg not in existing:
                 for obj in objs:
+                    if metrics.tracing_enabled():
+                        metrics.record_span("list", metrics.trace_id_for(etg), t_list, t_listed, key=obj["Key"])
                     yield obj
 
 
@@ -114,70 +163,277 @@ def _is_pdf_key(key: str) -> bool:
     return key.lower().endswith(".pdf")
 
 
-def read_pdf_from_s3_bytes(s3_client, bucket: str, key: str, max_pages: int = None) -> Tuple[str, List[str], Dict[str, Any]]:
+def read_pdf_from_s3_bytes(s3_client, bucket: str, key: str, max_pages: int = None, download_mode: str = "spool",
+                           page_pool: ProcessPoolExecutor = None, page_timeout: float = PAGE_TIMEOUT_SECONDS, trace_id: str = None) -> Tuple[str, List[str], Dict[str, Any]]:
     """
-    Download the object into memory (bytes) and extract text.
+    Download the object and extract text.
+    download_mode "spool" streams the body into a size-capped SpooledTemporaryFile
+    that pypdf reads as a file handle; "memory" reads it into one bytes object.
+    With a page_pool, the body goes to a temp file and long documents have
+    their pages extracted in parallel by the pool.
+    A page that fails or exceeds page_timeout is left empty and listed in meta["failed_pages"].
+    meta["peak_rss_kb"] is the process's peak RSS while handling this document.
+    Download and extraction times are recorded as the "download" / "extract"
+    stages (as spans of `trace_id` when tracing is on).
     Returns: (full_text, pages_list, meta)
     """
-    resp = s3_client.get_object(Bucket=bucket, Key=key)
-    body = resp["Body"].read()  # bytes
-    reader = PdfReader(io.BytesIO(body))
-
-    try:
-        if getattr(reader, "is_encrypted", False):
-            try:
-                reader.decrypt("")
-            except Exception:
-                pass
-    except Exception:
-        pass
-
-    pages, limit = [], (max_pages or 10**9)
-    for i, page in enumerate(reader.pages):
-        if i >= limit:
-            break
-        txt = page.extract_text() or ""
-        pages.append(txt)
-
-    full_text = "\n\n".join(pages)
-    meta = {
-        "n_pages_total": len(reader.pages),
+    reset_peak_rss()
+    worker_peak_kb = 0
+    if page_pool is not None:
+        with metrics.timed("download", trace_id, key=key):
+            path, meta = download_to_tempfile(s3_client, bucket, key)
+        try:
+            with metrics.timed("extract", trace_id, key=key):
+                pages, n_pages_total, failed_pages, worker_peak_kb = extract_pdf_file_parallel(path, page_pool, max_pages, page_timeout)
+        finally:
+            os.remove(path)
+    elif download_mode == "memory":
+        with metrics.timed("download", trace_id, key=key):
+            resp = s3_client.get_object(Bucket=bucket, Key=key)
+            body = resp["Body"].read()  # bytes
+        with metrics.timed("extract", trace_id, key=key):
+            pages, n_pages_total, failed_pages = extract_pdf_text(body, max_pages, page_timeout)
+        meta = {
+            "content_length": resp.get("ContentLength"),
+            "content_type": resp.get("ContentType"),
+            "key": key,
+            "bucket": bucket,
+        }
+    else:
+        with metrics.timed("download", trace_id, key=key):
+            spool, meta = download_to_spool(s3_client, bucket, key)
+        with spool, metrics.timed("extract", trace_id, key=key):
+            pages, n_pages_total, failed_pages = extract_pdf_text(spool, max_pages, page_timeout)
+
+    metrics.BYTES.inc(meta.get("content_length") or 0)
+    metrics.PAGES.inc(len(pages) - len(failed_pages), result="ok")
+    metrics.PAGES.inc(len(failed_pages), result="failed")
+
+    full_text = PAGE_SEPARATOR.join(pages)
+    meta.update({
+        "n_pages_total": n_pages_total,
         "n_pages_read": len(pages),
-        "content_length": resp.get("ContentLength"),
-        "content_type": resp.get("ContentType"),
-        "key": key,
-        "bucket": bucket,
-    }
+        "failed_pages": failed_pages,
+        "peak_rss_kb": max(peak_rss_kb(), worker_peak_kb),
+    })
     return full_text, pages, meta
 
 
 
-new_objs_iter = iter_new_objects_by_etag(
-    s3_client=s3_client,
-    bucket=ORACLE_INGEST_BUCKET,
-    prefix="",
-    milvus_client=client,
-    collection_name=COLLECTION_NAME,
-    etag_field="ETag",
-    page_batch_check=5
-)
+def _ingest_sequential(objects: Iterable[Dict[str, Any]], max_pages: int = None, manifest: EtagManifest = None, on_done=None, on_failed=None, download_mode: str = "spool", text_store: TextStore = None, upsert: bool = False, bill_fields: BillFieldStore = None, page_pool: ProcessPoolExecutor = None, page_timeout: float = PAGE_TIMEOUT_SECONDS):
+    """One object at a time: download, extract, embed, insert."""
+    totals = {"documents": 0, "added": 0, "removed": 0, "reused": 0}
+    for obj in objects:
+        report = _ingest_one_sequential(obj, max_pages=max_pages, manifest=manifest, download_mode=download_mode, text_store=text_store, upsert=upsert, bill_fields=bill_fields, page_pool=page_pool, page_timeout=page_timeout)
+        if report is False:
+            if on_failed is not None:
+                on_failed(obj["Key"])
+            continue
+        for name, n in (report or {}).items():
+            totals[name] += n
+        if on_done is not None:
+            on_done(obj["Key"])
+    if upsert:
+        print(f"[upsert] {totals}")
 
-for obj in new_objs_iter:
+
+def _ingest_one_sequential(obj: Dict[str, Any], max_pages: int = None, manifest: EtagManifest = None, download_mode: str = "spool", text_store: TextStore = None, upsert: bool = False, bill_fields: BillFieldStore = None, page_pool: ProcessPoolExecutor = None, page_timeout: float = PAGE_TIMEOUT_SECONDS):
+    """Download, extract, embed and insert a single object. With upsert, returns its add/remove/reuse report; False if it failed."""
     key  = obj["Key"]
     etag = obj["ETag"].strip('"')
     print(key," : ",etag)
 
 
     if not _is_pdf_key(key):
-        continue
+        return
 
     try:
-        text, pages, meta = read_pdf_from_s3_bytes(s3_client, ORACLE_INGEST_BUCKET, key)
-        #print(f"[PDF] {key} | etag={etag} | pages_read={meta['n_pages_read']}/{meta['n_pages_total']}")
-
-        convert_to_vectors(full_text = text, key=etag, filename=key)
+        record = text_store.get(etag) if text_store is not None else None
+        if record is not None:
+            pages, meta = record["pages"], record["meta"]
+            text = PAGE_SEPARATOR.join(pages)
+        else:
+            text, pages, meta = read_pdf_from_s3_bytes(get_s3_client(), ORACLE_INGEST_BUCKET, key, max_pages=max_pages, download_mode=download_mode, page_pool=page_pool, page_timeout=page_timeout, trace_id=metrics.trace_id_for(etag))
+            print(f"[PDF] {key} | etag={etag} | pages_read={meta['n_pages_read']}/{meta['n_pages_total']} | failed_pages={meta['failed_pages']} | peak_rss={meta['peak_rss_kb']} kB")
+            if text_store is not None:
+                text_store.put(etag, key, pages, meta)
+        if bill_fields is not None:
+            bill_fields.add_pages(etag, key, pages)
+
+        if upsert:
+            return upsert_documents([(etag, key, text, pages)], client=get_milvus_client(), manifest=manifest)
+        convert_to_vectors(full_text = text, key=etag, filename=key, pages=pages)
+        if manifest is not None and text:
+            manifest.add_many([(etag, key)])
 
     except Exception as e:
+        metrics.FAILURES.inc(stage="ingest")
         print(f"[skip] {key} ({e})")
+        return False
+
+
+def _parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Ingest new PDF bills from object storage into Milvus.")
+    parser.add_argument("--sequential", action="store_true", help="process one object at a time instead of using the pipeline")
+    parser.add_argument("--download-workers", type=int, default=ingest_pipeline.DOWNLOAD_WORKERS, help="concurrent downloads")
+    parser.add_argument("--extract-workers", type=int, default=ingest_pipeline.EXTRACT_WORKERS, help="PDF text extraction processes")
+    parser.add_argument("--queue-size", type=int, default=ingest_pipeline.QUEUE_SIZE, help="max documents buffered between stages")
+    parser.add_argument("--embed-batch-docs", type=int, default=ingest_pipeline.EMBED_BATCH_DOCS, help="max documents embedded together")
+    parser.add_argument("--embed-batch-size", type=int, default=EMBED_BATCH_SIZE, help="chunks per model forward pass")
+    parser.add_argument("--insert-batch-rows", type=int, default=ingest_pipeline.INSERT_BATCH_ROWS, help="rows per Milvus insert")
+    parser.add_argument("--page-workers", type=int, default=0, help="with --sequential, extract the pages of long PDFs in this many processes")
+    parser.add_argument("--page-timeout", type=float, default=PAGE_TIMEOUT_SECONDS, help="seconds before a single page is skipped (0 = no limit)")
+    parser.add_argument("--max-pages", type=int, default=None, help="only read the first N pages of each PDF")
+    parser.add_argument("--download-mode", choices=["spool", "memory"], default="spool", help="stream bodies to a spooled/temp file or read them into memory")
+    parser.add_argument("--spool-dir", default=None, help="directory for temp files of streamed downloads")
+    parser.add_argument("--manifest", default=ETAG_MANIFEST_PATH, help="local ETag manifest used for deduplication")
+    parser.add_argument("--bloom", action="store_true", help="keep only a Bloom filter of the manifest in memory")
+    parser.add_argument("--no-manifest", action="store_true", help="check every listing page against Milvus instead")
+    parser.add_argument("--rebuild-manifest", action="store_true", help="rebuild the manifest from the collection and exit")
+    parser.add_argument("--prefix", default="", help="only list keys under this prefix")
+    parser.add_argument("--shard", default="0/1", help="process shard i of N (0-based), e.g. 2/8")
+    parser.add_argument("--shard-by", choices=["hash", "prefix"], default="hash", help="split keys by key hash or by key prefix range")
+    parser.add_argument("--resume", action="store_true", help="continue this shard's listing after its last checkpointed key")
+    parser.add_argument("--checkpoint-dir", default=".", help="where per-shard listing checkpoints are kept")
+    parser.add_argument("--text-store", default=TEXT_STORE_DIR, help="directory of extracted text keyed by ETag (\"\" disables it)")
+    parser.add_argument("--reindex", action="store_true", help="rebuild vectors from the text store only, without object storage")
+    parser.add_argument("--target-collection", default=COLLECTION_NAME, help="collection written by --reindex")
+    parser.add_argument("--bill-fields", default=BILL_FIELDS_DIR, help="Parquet dataset of extracted bill fields (\"\" disables extraction)")
+    parser.add_argument("--backfill-bill-fields", action="store_true", help="extract bill fields for every document in the text store and exit")
+    parser.add_argument("--metrics-port", type=int, default=metrics.METRICS_PORT, help="serve Prometheus /metrics and /metrics.json on this port while ingesting (0 = off)")
+    parser.add_argument("--metrics-json", default="", help="write a JSON snapshot of all metrics here when done")
+    parser.add_argument("--upsert", action="store_true", help="replace the stored chunks of re-uploaded files (matched by key) instead of appending; only changed chunks are embedded")
+    return parser.parse_args(argv)
+
+
+def _open_manifest(args: argparse.Namespace) -> EtagManifest:
+    """Opens the manifest, building it from the collection the first time (the only Milvus scan)."""
+    if args.no_manifest:
+        return None
+    if args.rebuild_manifest or not EtagManifest.exists(args.manifest):
+        n = rebuild_manifest(args.manifest, get_milvus_client(), COLLECTION_NAME, etag_field="ETag")
+        print(f"[manifest] {args.manifest} rebuilt with {n} ETags.")
+    return EtagManifest(args.manifest, use_bloom=args.bloom)
+
+
+def _reindex(args: argparse.Namespace, text_store: TextStore):
+    """CPU-only rebuild: re-chunk and re-embed every stored document into the target collection."""
+    if text_store is None:
+        raise SystemExit("--reindex needs a text store.")
+    client = get_milvus_client()
+    fresh = not client.has_collection(args.target_collection)
+    ensure_collection(client, args.target_collection)
+    with BufferedWriter(client, args.target_collection, max_rows=args.insert_batch_rows) as writer:
+        stats = reindex_from_store(
+            text_store, writer,
+            embed_batch_docs=args.embed_batch_docs,
+            embed_batch_size=args.embed_batch_size,
+            replace_existing=not fresh,
+        )
+    print(f"[reindex] {stats}")
+
+
+def main(argv: List[str] = None):
+    args = _parse_args(argv)
+    metrics.start_server(args.metrics_port)
+    pdf_to_vector.warmup()
+    text_store = TextStore(args.text_store) if args.text_store else None
+    bill_fields = BillFieldStore(args.bill_fields) if args.bill_fields else None
+    if args.backfill_bill_fields:
+        if text_store is None or bill_fields is None:
+            raise SystemExit("--backfill-bill-fields needs a text store and a bill fields directory.")
+        print(f"[bill fields] {backfill_from_text_store(text_store, bill_fields)}")
+        return
+    if args.reindex:
+        _reindex(args, text_store)
+        return
+
+    ensure_collection(get_milvus_client(), COLLECTION_NAME)
+    manifest = _open_manifest(args)
+    if args.rebuild_manifest:
+        return
+
+    shard = ShardSpec(*parse_shard(args.shard), mode=args.shard_by)
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
+    checkpoint_path = ListingCheckpoint.path_for(args.checkpoint_dir, shard)
+    if not args.resume and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = ListingCheckpoint(checkpoint_path, shard)
+    if checkpoint.last_key:
+        print(f"[shard {shard.label}] resuming after {checkpoint.last_key!r}")
+
+    new_objs_iter = iter_new_objects_by_etag(
+        s3_client=get_s3_client(),
+        bucket=ORACLE_INGEST_BUCKET,
+        prefix=args.prefix,
+        milvus_client=get_milvus_client(),
+        collection_name=COLLECTION_NAME,
+        etag_field="ETag",
+        page_batch_check=5,
+        manifest=manifest,
+        shard=shard,
+        resume_key=checkpoint.last_key,
+        checkpoint=checkpoint,
+    )
+
+    try:
+        if args.sequential:
+            page_pool = ProcessPoolExecutor(max_workers=args.page_workers) if args.page_workers > 1 else None
+            try:
+                _ingest_sequential(new_objs_iter, max_pages=args.max_pages, manifest=manifest, on_done=checkpoint.done, on_failed=checkpoint.failed, download_mode=args.download_mode, text_store=text_store, upsert=args.upsert, bill_fields=bill_fields, page_pool=page_pool, page_timeout=args.page_timeout)
+            finally:
+                if page_pool is not None:
+                    page_pool.shutdown()
+        else:
+            _ingest_pipelined(args, new_objs_iter, manifest, checkpoint, text_store, bill_fields)
+    finally:
+        if bill_fields is not None:
+            bill_fields.close()
+        checkpoint.save()
+        print(f"[shard {shard.label}] {checkpoint.progress()}")
+        if args.metrics_json:
+            metrics.REGISTRY.write_json(args.metrics_json)
+
+
+def _pdf_objects(objects: Iterable[Dict[str, Any]], checkpoint: ListingCheckpoint) -> Generator[Dict[str, Any], None, None]:
+    """Passes PDFs on to the pipeline; anything else is complete as soon as it is listed."""
+    for obj in objects:
+        if _is_pdf_key(obj["Key"]):
+            yield obj
+        else:
+            checkpoint.done(obj["Key"])
+
+
+def _ingest_pipelined(args: argparse.Namespace, objects: Iterable[Dict[str, Any]], manifest: EtagManifest, checkpoint: ListingCheckpoint, text_store: TextStore = None, bill_fields: BillFieldStore = None):
+    """Runs the staged pipeline; ETags are recorded in the manifest as their rows are flushed."""
+    writer = BufferedWriter(
+        get_milvus_client(), COLLECTION_NAME, max_rows=args.insert_batch_rows,
+        on_flush=manifest.record_rows if manifest is not None else None,
+    )
+    pipeline = IngestPipeline(
+        s3_client=get_s3_client(),
+        bucket=ORACLE_INGEST_BUCKET,
+        writer=writer,
+        download_workers=args.download_workers,
+        extract_workers=args.extract_workers,
+        queue_size=args.queue_size,
+        embed_batch_docs=args.embed_batch_docs,
+        embed_batch_size=args.embed_batch_size,
+        max_pages=args.max_pages,
+        download_mode=args.download_mode,
+        spool_dir=args.spool_dir,
+        text_store=text_store,
+        on_done=checkpoint.done,
+        on_failed=checkpoint.failed,
+        upsert=args.upsert,
+        manifest=manifest,
+        bill_fields=bill_fields,
+        page_timeout=args.page_timeout,
+    )
+    with writer:
+        stats = pipeline.run(_pdf_objects(objects, checkpoint))
+    print(f"[done] {stats}")
 
 
+if __name__ == "__main__":
+    main()
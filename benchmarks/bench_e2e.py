@@ -0,0 +1,351 @@
+# --- End-to-end ingestion and retrieval benchmark against local stand-ins ---
+#
+#   python benchmarks/bench_e2e.py --docs 200 --out bench_e2e.json
+#   python benchmarks/bench_e2e.py --docs 200 --baseline bench_e2e.json      # run, then compare
+#   python benchmarks/bench_e2e.py --compare old.json new.json               # compare two saved runs
+#
+# Everything runs locally: synthetic multi-page bills are served by moto's
+# in-process S3 mock (or MinIO / any S3 endpoint with --s3-endpoint), vectors
+# go to a milvus-lite file, and chat turns talk to llm_test/fake_openai_server.py.
+# Each document is pushed through the stages one at a time so every stage gets
+# its own latency samples:
+#   list, dedupe (per listing page), download, extract, chunk, embed, insert
+#   (per document), search (per uncached query) and chat_turn (per question);
+# "pipeline" then ingests the same objects through IngestPipeline for overall
+# throughput. Needs moto (unless --s3-endpoint is given), boto3, milvus-lite
+# and the embedding model; the output JSON is the input of --compare.
+
+import os, sys, json, time, socket, argparse, platform, subprocess, tempfile
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "llm_test"))
+sys.path.append(os.path.dirname(__file__))
+from synthetic_bills import generate_bills
+
+BUCKET = "bench-bills"
+COLLECTION = "bench_e2e"
+STAGES = ["list", "dedupe", "download", "extract", "chunk", "embed", "insert", "search", "chat_turn", "pipeline"]
+
+
+# --- Measurements ---
+class StageTimer:
+    """Latency samples per stage, each with the number of items it covered (pages, chunks, rows...)."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.items: Dict[str, int] = {}
+
+    @contextmanager
+    def time(self, stage: str, items: int = 1):
+        t0 = time.perf_counter()
+        yield
+        self.record(stage, time.perf_counter() - t0, items)
+
+    def record(self, stage: str, seconds: float, items: int = 1):
+        self.samples.setdefault(stage, []).append(seconds)
+        self.items[stage] = self.items.get(stage, 0) + items
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        out = {}
+        for stage in sorted(self.samples, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)):
+            secs = np.asarray(self.samples[stage])
+            total = float(secs.sum())
+            out[stage] = {
+                "calls": len(secs),
+                "items": self.items[stage],
+                "total_s": round(total, 4),
+                "items_per_s": round(self.items[stage] / total, 2) if total else None,
+                "p50_ms": round(1000 * float(np.percentile(secs, 50)), 3),
+                "p95_ms": round(1000 * float(np.percentile(secs, 95)), 3),
+                "max_ms": round(1000 * float(secs.max()), 3),
+            }
+        return out
+
+
+# --- Local Stand-ins ---
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _configure_environment(workdir: str, llm_port: int):
+    """Points every module at the stand-ins; must run before pdf_to_vector / llm_test modules are imported."""
+    db_path = os.path.join(workdir, "milvus.db")
+    os.environ.update({
+        "MILVUS_HOST": db_path, "MILVUS_PORT": "0", "COLLECTION_NAME": COLLECTION,
+        "MILVUS_WRITE_STAMP_DIR": os.path.join(workdir, "stamps"),
+        "EMBEDDING_CACHE_PATH": "",  # every run embeds for real
+        "JETSTREAM_BASE": f"http://127.0.0.1:{llm_port}/v1", "JETSTREAM_API_KEY": "bench", "JETSTREAM_MODEL": "fake",
+        "RAG_ANSWER_CACHE": "0", "RAG_HISTORY_DB": "",
+    })
+    # pdf_to_vector reads its Milvus settings from a `credentials` module
+    with open(os.path.join(workdir, "credentials.py"), "w") as f:
+        f.write(
+            f"MILVUS_HOST = {db_path!r}\nMILVUS_PORT = '0'\nCOLLECTION_NAME = {COLLECTION!r}\n"
+            f"ORACLE_S3_ACCESS_KEY = ORACLE_S3_SECRET_KEY = 'bench'\nORACLE_S3_ENDPOINT = None\n"
+            f"ORACLE_REGION = 'us-east-1'\nORACLE_INGEST_BUCKET = {BUCKET!r}\n"
+        )
+    sys.path.insert(0, workdir)
+
+
+@contextmanager
+def object_store(args):
+    """An S3 client with the bench bucket: moto in-process by default, or the endpoint given."""
+    import boto3
+
+    if args.s3_endpoint:
+        s3 = boto3.client("s3", endpoint_url=args.s3_endpoint, aws_access_key_id=args.s3_access_key,
+                          aws_secret_access_key=args.s3_secret_key, region_name="us-east-1")
+        yield s3
+        return
+    from moto import mock_aws
+
+    with mock_aws():
+        yield boto3.client("s3", region_name="us-east-1", aws_access_key_id="bench", aws_secret_access_key="bench")
+
+
+def _upload(s3, bills) -> int:
+    try:
+        s3.create_bucket(Bucket=BUCKET)
+    except Exception as e:
+        if "BucketAlready" not in type(e).__name__ + str(e):
+            raise
+    total = 0
+    for key, body, _ in bills:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=body, ContentType="application/pdf")
+        total += len(body)
+    return total
+
+
+def _questions(bills, n: int) -> List[str]:
+    templates = [
+        "How many kWh did account {account} use in {month}?",
+        "What was the amount due on the {month} bill for account {account}?",
+        "What rate per kWh was charged in {month} and when was that bill due?",
+        "Compare the usage of {month} and the amount due for account {account}",
+    ]
+    return [templates[i % len(templates)].format(**bills[(i * 7) % len(bills)][2]) for i in range(n)]
+
+
+# --- Stages ---
+def bench_staged(timer: StageTimer, s3, args, workdir: str):
+    """One document at a time through every ingestion stage, then search and chat."""
+    import milvus_index
+    import models
+    import pdf_to_vector
+    from milvus_pool import get_client, BufferedWriter
+    from etag_manifest import EtagManifest
+    from pdf_extract import download_to_tempfile, extract_pdf_file
+    from s3_listing import iter_listing
+
+    client = get_client(pdf_to_vector.MILVUS_URI)
+    if client.has_collection(COLLECTION):
+        client.drop_collection(COLLECTION)
+    milvus_index.ensure_collection(client, COLLECTION, dim=models.EMBEDDING_DIM)
+    manifest = EtagManifest(os.path.join(workdir, "manifest.sqlite"))
+    pdf_to_vector.warmup()
+
+    writer = BufferedWriter(client, COLLECTION, max_interval=0)
+    listing = iter_listing(s3, BUCKET)
+    while True:
+        with timer.time("list"):
+            page = next(listing, None)
+        if page is None:
+            break
+        objects = page.get("Contents", [])
+        etags = [obj["ETag"].strip('"') for obj in objects]
+        with timer.time("dedupe", len(etags)):
+            known = manifest.contains_many(etags)
+        new = [obj for obj in objects if obj["ETag"].strip('"') not in known]
+
+        for obj in new:
+            key, etag = obj["Key"], obj["ETag"].strip('"')
+            with timer.time("download"):
+                path, _ = download_to_tempfile(s3, BUCKET, key)
+            try:
+                t0 = time.perf_counter()
+                pages, _, _, _ = extract_pdf_file(path)
+                timer.record("extract", time.perf_counter() - t0, len(pages))
+            finally:
+                os.remove(path)
+            full_text = pdf_to_vector.PAGE_SEPARATOR.join(pages)
+            t0 = time.perf_counter()
+            chunks = pdf_to_vector._chunk_document(full_text, pages)
+            timer.record("chunk", time.perf_counter() - t0, len(chunks))
+            t0 = time.perf_counter()
+            vectors = pdf_to_vector._embed_chunks([c["text"] for c in chunks], batch_size=args.embed_batch_size)
+            timer.record("embed", time.perf_counter() - t0, len(chunks))
+            fields = pdf_to_vector._document_fields(full_text, pages)
+            rows = [pdf_to_vector._make_row(etag, key, i, c, v, fields) for i, (c, v) in enumerate(zip(chunks, vectors)) if v is not None]
+            with timer.time("insert", len(rows)):
+                writer.add(rows)
+                writer.flush()
+            manifest.add_many([(etag, key)])
+    writer.close()
+    client.flush(COLLECTION)
+    manifest.close()
+
+
+def bench_retrieval(timer: StageTimer, bills, args):
+    import rag_get_pdf_data as rag
+
+    rag.warmup()
+    for question in _questions(bills, args.queries):
+        rag._query_cache.clear()
+        rag.invalidate_search_cache()
+        with timer.time("search"):
+            rag._search(question, top_k=rag.TOP_K)
+    if not args.chat_turns:
+        return
+
+    import llm_with_rag
+    from fake_openai_server import serve
+
+    server = serve("127.0.0.1", args.llm_port, token_delay=args.token_delay, background=True)
+    try:
+        llm_with_rag.get_tool_llm()
+        for question in _questions(bills, args.chat_turns):
+            with timer.time("chat_turn"):
+                llm_with_rag.run_one_turn({"input": question, "history": []})
+    finally:
+        server.shutdown()
+
+
+def bench_pipeline(timer: StageTimer, s3, args):
+    """The same objects through IngestPipeline (all stages overlapped) into a scratch collection."""
+    import milvus_index
+    import models
+    import pdf_to_vector
+    from milvus_pool import get_client, BufferedWriter
+    from ingest_pipeline import IngestPipeline
+    from s3_listing import iter_listing
+
+    client = get_client(pdf_to_vector.MILVUS_URI)
+    name = COLLECTION + "_pipeline"
+    if client.has_collection(name):
+        client.drop_collection(name)
+    milvus_index.ensure_collection(client, name, dim=models.EMBEDDING_DIM)
+    objects = [obj for page in iter_listing(s3, BUCKET) for obj in page.get("Contents", [])]
+    with BufferedWriter(client, name) as writer:
+        pipeline = IngestPipeline(s3, BUCKET, writer=writer, extract_workers=args.extract_workers)
+        t0 = time.perf_counter()
+        stats = pipeline.run(iter(objects))
+        timer.record("pipeline", time.perf_counter() - t0, stats["embedded"])
+    client.drop_collection(name)
+    return stats
+
+
+# --- Comparison ---
+def compare(baseline: Dict, current: Dict, tolerance: float = 0.15, min_ms: float = 1.0) -> List[str]:
+    """
+    Prints a stage-by-stage table and returns the regressions: a p50 or p95
+    more than `tolerance` slower than the baseline (ignoring differences under
+    min_ms), or throughput that dropped by more than `tolerance`.
+    """
+    regressions = []
+    print(f"{'stage':<10} {'p50 ms':>21} {'p95 ms':>21} {'items/s':>21}")
+    for stage in STAGES:
+        old, new = baseline["stages"].get(stage), current["stages"].get(stage)
+        if not old or not new:
+            continue
+        cells = []
+        for metric, higher_is_worse in (("p50_ms", True), ("p95_ms", True), ("items_per_s", False)):
+            a, b = old.get(metric), new.get(metric)
+            if not a or b is None:
+                cells.append(f"{'-':>21}")
+                continue
+            change = (b - a) / a
+            worse = change > tolerance if higher_is_worse else change < -tolerance
+            if worse and (not higher_is_worse or b - a >= min_ms):
+                regressions.append(f"{stage} {metric}: {a} -> {b} ({change:+.0%})")
+                mark = "!"
+            else:
+                mark = " "
+            cells.append(f"{a} -> {b} ({change:+.0%}){mark}".rjust(21))
+        print(f"{stage:<10} " + " ".join(cells))
+    return regressions
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def run(args) -> Dict[str, Any]:
+    import models
+
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+    args.llm_port = args.llm_port or _free_port()
+    _configure_environment(workdir, args.llm_port)
+    bills = generate_bills(args.docs, pages=(args.min_pages, args.max_pages), seed=args.seed)
+
+    timer = StageTimer()
+    with object_store(args) as s3:
+        uploaded = _upload(s3, bills)
+        bench_staged(timer, s3, args, workdir)
+        bench_retrieval(timer, bills, args)
+        pipeline_stats = bench_pipeline(timer, s3, args) if not args.skip_pipeline else None
+
+    return {
+        "meta": {
+            "commit": _git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "machine": platform.machine(), "cpus": os.cpu_count(), "docs": args.docs, "bytes": uploaded,
+            "pages": [args.min_pages, args.max_pages], "object_store": args.s3_endpoint or "moto",
+            "embedding_dim": models.EMBEDDING_DIM, "workdir": workdir,
+        },
+        "stages": timer.summary(),
+        "pipeline_stats": pipeline_stats,
+    }
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="End-to-end ingestion/retrieval benchmark with local stand-ins.")
+    parser.add_argument("--docs", type=int, default=100)
+    parser.add_argument("--min-pages", type=int, default=2)
+    parser.add_argument("--max-pages", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=50, help="uncached searches")
+    parser.add_argument("--chat-turns", type=int, default=20)
+    parser.add_argument("--embed-batch-size", type=int, default=32)
+    parser.add_argument("--extract-workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds per streamed token of the stub LLM")
+    parser.add_argument("--llm-port", type=int, default=0, help="port of the stub LLM server (0 = any free port)")
+    parser.add_argument("--s3-endpoint", help="use this S3 endpoint (e.g. MinIO) instead of moto")
+    parser.add_argument("--s3-access-key", default="minioadmin")
+    parser.add_argument("--s3-secret-key", default="minioadmin")
+    parser.add_argument("--skip-pipeline", action="store_true")
+    parser.add_argument("--out", help="write the results JSON here")
+    parser.add_argument("--baseline", help="after the run, compare against this results JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="only compare two results files")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="relative slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            regressions = compare(json.load(f), json.load(g), args.tolerance)
+    else:
+        results = run(args)
+        print(json.dumps(results["stages"], indent=2))
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(results, f, indent=2)
+        regressions = []
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare(json.load(f), results, args.tolerance)
+
+    if regressions:
+        print("\nRegressions:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+# --- Parity and throughput of the embedding backends (torch / onnx / onnx-int8) ---
+#
+#   python benchmarks/bench_embedding.py --export                      # export + quantise, then benchmark
+#   python benchmarks/bench_embedding.py --backends onnx-int8 --workers 0 2 4 --out bench_embedding.json
+#   python benchmarks/bench_embedding.py --source text_store --text-store text_store --n 2000
+#
+# Every backend encodes the same passages (bill pages, or chunks from the text
+# store) and questions. Parity is measured against the torch reference: the
+# cosine similarity of each vector to its reference vector, and how many of the
+# reference top-k passages each question still retrieves. Throughput is
+# measured twice: "batch" encodes all passages with --batch-size (ingestion),
+# "single" encodes one question per call (search latency). With --workers N > 1
+# the backend runs in an EmbeddingPool of N processes; pss_mb is the
+# proportional memory of the process(es) holding the model, so weights that the
+# workers share through mmap are only counted once. Exits 1 when a backend's
+# lowest cosine is below --min-cosine.
+
+import os, sys, json, time, random, argparse
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.dirname(__file__))
+import models
+from synthetic_bills import bill_pages
+
+DOCUMENT_PREFIX = "search_document: "
+QUERY_PREFIX = "search_query: "
+
+
+def _synthetic_texts(n: int, n_queries: int, seed: int = 0) -> Tuple[List[str], List[str]]:
+    """Bill pages as passages (about one chunk each) and questions about those bills."""
+    rng = random.Random(seed)
+    passages, facts = [], []
+    while len(passages) < n:
+        account = f"{rng.randint(10 ** 11, 10 ** 12 - 1)}"
+        pages, bill = bill_pages(account, date(2023 + rng.randint(0, 2), rng.randint(1, 12), 5), rng.randint(1, 4), rng)
+        passages.extend("\n".join(lines) for lines in pages)
+        facts.append(bill)
+    templates = [
+        "How many kWh did account {account} use in {month}?",
+        "What was the amount due on the {month} bill?",
+        "What rate per kWh was charged in {month}?",
+    ]
+    queries = [templates[i % len(templates)].format(**facts[i % len(facts)]) for i in range(n_queries)]
+    return passages[:n], queries
+
+
+def _text_store_texts(n: int, n_queries: int, text_store_dir: str) -> Tuple[List[str], List[str]]:
+    """Real chunks from the text store; questions are the first line of held-out chunks."""
+    import pdf_to_vector
+    from text_store import TextStore
+
+    texts: List[str] = []
+    for record in TextStore(text_store_dir).iter_records():
+        full_text = pdf_to_vector.PAGE_SEPARATOR.join(record["pages"])
+        texts.extend(c["text"] for c in pdf_to_vector._chunk_text(full_text, pdf_to_vector.CHUNK_SIZE, pdf_to_vector.CHUNK_OVERLAP))
+        if len(texts) >= n + n_queries:
+            break
+    if len(texts) <= n_queries:
+        raise SystemExit(f"Only {len(texts)} chunks in {text_store_dir}; need more than {n_queries}.")
+    queries = [t.strip().splitlines()[0][:200] for t in texts[n:n + n_queries]]
+    return texts[:n], queries
+
+
+def _pss_mb(pids: List[int]) -> Optional[float]:
+    """Summed proportional set size (Linux only): shared pages are split between the processes mapping them."""
+    total = 0
+    try:
+        for pid in pids:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+    except (OSError, StopIteration):
+        return None
+    return round(total / 1024, 1)
+
+
+def _model_pids(model) -> List[int]:
+    if isinstance(model, models.EmbeddingPool):
+        return list(model._pool._processes)
+    return [os.getpid()]
+
+
+def _normalise(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def _top_k(passages: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    return np.argsort(-(_normalise(queries) @ _normalise(passages).T), axis=1)[:, :k]
+
+
+def parity(reference: Dict[str, np.ndarray], current: Dict[str, np.ndarray], k: int) -> Dict[str, float]:
+    """Per-vector cosine to the reference and top-k overlap of the question -> passage rankings."""
+    cosines = np.concatenate([
+        np.sum(_normalise(reference[part]) * _normalise(current[part]), axis=1) for part in ("passages", "queries")
+    ])
+    truth = _top_k(reference["passages"], reference["queries"], k)
+    found = _top_k(current["passages"], current["queries"], k)
+    overlap = np.mean([len(set(f) & set(t)) / k for f, t in zip(found.tolist(), truth.tolist())])
+    return {
+        "cosine_mean": round(float(cosines.mean()), 5),
+        "cosine_min": round(float(cosines.min()), 5),
+        f"top{k}_overlap": round(float(overlap), 4),
+    }
+
+
+def bench_backend(backend: str, workers: int, passages: List[str], queries: List[str], args) -> Tuple[Dict, Dict[str, np.ndarray]]:
+    t0 = time.perf_counter()
+    model = models.get_embedding_model(args.model, backend, workers)
+    model.encode([DOCUMENT_PREFIX + p for p in passages[:max(workers, 1) * 2]], batch_size=args.batch_size)  # load + warm every worker
+    load_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    passage_vectors = np.asarray(model.encode([DOCUMENT_PREFIX + p for p in passages], batch_size=args.batch_size), dtype=np.float32)
+    batch_s = time.perf_counter() - t0
+
+    latencies, query_vectors = [], []
+    for q in queries:
+        t = time.perf_counter()
+        query_vectors.append(model.encode(QUERY_PREFIX + q))
+        latencies.append(time.perf_counter() - t)
+
+    result = {
+        "backend": backend,
+        "workers": workers,
+        "load_s": round(load_s, 2),
+        "batch_passages_per_s": round(len(passages) / batch_s, 2),
+        "batch_s": round(batch_s, 3),
+        "single_p50_ms": round(1000 * float(np.percentile(latencies, 50)), 2),
+        "single_p95_ms": round(1000 * float(np.percentile(latencies, 95)), 2),
+        "pss_mb": _pss_mb(_model_pids(model)),
+    }
+    if isinstance(model, models.EmbeddingPool):
+        model.close()
+    models._models.clear()  # one model in memory at a time, so pss_mb stays comparable
+    return result, {"passages": passage_vectors, "queries": np.asarray(query_vectors, dtype=np.float32)}
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Compare embedding backends for parity and throughput.")
+    parser.add_argument("--model", default="nomic-ai/nomic-embed-text-v1.5")
+    parser.add_argument("--backends", nargs="+", default=list(models.EMBEDDING_BACKENDS), choices=models.EMBEDDING_BACKENDS)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0], help="Worker processes per backend (0 = in process).")
+    parser.add_argument("--export", action="store_true", help="Export and quantise the ONNX models first.")
+    parser.add_argument("--onnx-dir", default=models.ONNX_DIR)
+    parser.add_argument("--source", choices=["synthetic", "text_store"], default="synthetic")
+    parser.add_argument("--text-store", default="text_store")
+    parser.add_argument("--n", type=int, default=512, help="Passages encoded in the batch workload.")
+    parser.add_argument("--queries", type=int, default=100, help="Questions encoded one at a time.")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--min-cosine", type=float, default=0.98, help="Lowest acceptable cosine to the torch vectors.")
+    parser.add_argument("--out", help="Also write the results as JSON to this file.")
+    args = parser.parse_args(argv)
+
+    models.ONNX_DIR = args.onnx_dir
+    if args.export:
+        models.export_onnx(args.model, args.onnx_dir)
+    if args.source == "synthetic":
+        passages, queries = _synthetic_texts(args.n, args.queries)
+    else:
+        passages, queries = _text_store_texts(args.n, args.queries, args.text_store)
+
+    # The torch in-process run is the parity reference, so it always runs first
+    runs = [("torch", 0)] + [(b, w) for b in args.backends for w in args.workers if (b, w) != ("torch", 0)]
+    reference, results, failed = None, [], []
+    for backend, workers in runs:
+        result, vectors = bench_backend(backend, workers, passages, queries, args)
+        if reference is None:
+            reference = vectors
+        result.update(parity(reference, vectors, args.k))
+        if result["cosine_min"] < args.min_cosine:
+            failed.append(f"{backend} x{workers}")
+        print(json.dumps(result))
+        results.append(result)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({
+                "model": args.model, "source": args.source, "passages": len(passages), "queries": len(queries),
+                "batch_size": args.batch_size, "cpu_count": os.cpu_count(), "results": results,
+            }, f, indent=2)
+    if failed:
+        print(f"Below --min-cosine {args.min_cosine}: {', '.join(failed)}", file=sys.stderr)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# --- Recall / latency / memory of Matryoshka dimensions x Milvus index types ---
+#
+#   python benchmarks/bench_index.py --uri ./bench_milvus.db --source synthetic --n 20000
+#   python benchmarks/bench_index.py --uri http://127.0.0.1:19530 --source text_store \
+#       --dims 768 512 256 --indexes HNSW IVF_FLAT IVF_SQ8 IVF_PQ
+#
+# For every (dim, index) pair the corpus is loaded into a scratch collection and
+# searched with held-out queries. recall@k is measured against exact brute-force
+# cosine search at the same dim ("recall") and at the full 768 dims
+# ("recall_vs_full", which includes the Matryoshka truncation loss; only
+# meaningful with --source text_store, synthetic vectors are not Matryoshka-trained).
+# milvus-lite (a local .db uri) only builds FLAT / IVF_FLAT / AUTOINDEX; use a
+# Milvus server for HNSW and the quantised IVF indexes.
+
+import os, sys, json, time, argparse
+from typing import Dict, List
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import models
+import milvus_index
+from milvus_pool import get_client
+
+
+def _synthetic_corpus(n: int, n_queries: int, dim: int = models.NATIVE_DIM, seed: int = 0):
+    """Clustered Gaussian vectors: crude, but gives ANN indexes realistic neighbourhoods to find."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(8, n // 200), dim)).astype(np.float32)
+    def sample(m):
+        return centers[rng.integers(0, len(centers), m)] + 0.35 * rng.normal(size=(m, dim)).astype(np.float32)
+    return sample(n), sample(n_queries)
+
+
+def _text_store_corpus(n: int, n_queries: int, text_store_dir: str, batch_size: int):
+    """Real chunk embeddings (full 768 dims) of documents in the text store; queries are held-out chunks."""
+    import pdf_to_vector
+    from text_store import TextStore
+
+    texts: List[str] = []
+    for record in TextStore(text_store_dir).iter_records():
+        full_text = pdf_to_vector.PAGE_SEPARATOR.join(record["pages"])
+        texts.extend(c["text"] for c in pdf_to_vector._chunk_text(full_text, pdf_to_vector.CHUNK_SIZE, pdf_to_vector.CHUNK_OVERLAP))
+        if len(texts) >= n + n_queries:
+            break
+    if len(texts) <= n_queries:
+        raise SystemExit(f"Only {len(texts)} chunks in {text_store_dir}; need more than {n_queries}.")
+    vectors = np.asarray(pdf_to_vector._encode_chunks(texts[:n + n_queries], batch_size=batch_size), dtype=np.float32)
+    return vectors[n_queries:], vectors[:n_queries]
+
+
+def _exact_top_k(corpus: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    c = corpus / np.linalg.norm(corpus, axis=1, keepdims=True)
+    q = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    sims = q @ c.T
+    return np.argsort(-sims, axis=1)[:, :k]
+
+
+def _recall(found: List[List[int]], truth: np.ndarray) -> float:
+    k = truth.shape[1]
+    return float(np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth.tolist())]))
+
+
+def _estimated_index_mb(index_type: str, n: int, dim: int, params: Dict) -> float:
+    """Rough in-memory size of the vector index (raw vectors for FLAT-like indexes, codes for quantised ones)."""
+    if index_type == "IVF_SQ8":
+        size = n * dim
+    elif index_type == "IVF_PQ":
+        size = n * params.get("m", dim // 8) * params.get("nbits", 8) / 8
+    elif index_type == "HNSW":
+        size = n * dim * 4 + n * params.get("M", 16) * 2 * 4
+    else:
+        size = n * dim * 4
+    return size / 2 ** 20
+
+
+def bench_one(client, corpus_full, queries_full, truth_full, dim: int, index_type: str, k: int, batch: int) -> Dict:
+    corpus = models.reduce_dimension(corpus_full, dim)
+    queries = models.reduce_dimension(queries_full, dim)
+    truth = _exact_top_k(corpus, queries, k)
+
+    name = f"bench_{index_type.lower()}_{dim}"
+    if client.has_collection(name):
+        client.drop_collection(name)
+    milvus_index.ensure_collection(client, name, dim=dim, index_type=index_type, scalar_fields=False)
+    t0 = time.perf_counter()
+    for i in range(0, len(corpus), batch):
+        client.insert(collection_name=name, data=[{"vector": v.tolist(), "row": i + j} for j, v in enumerate(corpus[i:i + batch])])
+    client.flush(name)
+    load_s = time.perf_counter() - t0
+
+    params = milvus_index.search_params(index_type, k)
+    latencies, found = [], []
+    for q in queries:
+        t = time.perf_counter()
+        res = client.search(collection_name=name, data=[q.tolist()], limit=k, output_fields=["row"], search_params=params)
+        latencies.append(time.perf_counter() - t)
+        found.append([hit["entity"]["row"] for hit in res[0]])
+    client.drop_collection(name)
+
+    return {
+        "dim": dim,
+        "index": index_type,
+        "search_params": params["params"],
+        f"recall@{k}": round(_recall(found, truth), 4),
+        f"recall@{k}_vs_full": round(_recall(found, truth_full), 4),
+        "p50_ms": round(1000 * float(np.percentile(latencies, 50)), 2),
+        "p95_ms": round(1000 * float(np.percentile(latencies, 95)), 2),
+        "load_s": round(load_s, 2),
+        "est_index_mb": round(_estimated_index_mb(index_type, len(corpus), dim, milvus_index.index_params(index_type, dim)), 1),
+    }
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark embedding dimensions and Milvus index types.")
+    parser.add_argument("--uri", default="./bench_milvus.db", help="Milvus server URI or a milvus-lite .db file.")
+    parser.add_argument("--source", choices=["synthetic", "text_store"], default="synthetic")
+    parser.add_argument("--text-store", default="text_store")
+    parser.add_argument("--n", type=int, default=20000, help="Corpus size.")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dims", type=int, nargs="+", default=[768, 512, 256, 128])
+    parser.add_argument("--indexes", nargs="+", default=["FLAT", "IVF_FLAT"])
+    parser.add_argument("--insert-batch", type=int, default=2000)
+    parser.add_argument("--out", help="Also write the results as JSON to this file.")
+    args = parser.parse_args(argv)
+
+    if args.source == "synthetic":
+        corpus, queries = _synthetic_corpus(args.n, args.queries)
+    else:
+        corpus, queries = _text_store_corpus(args.n, args.queries, args.text_store, batch_size=32)
+    truth_full = _exact_top_k(corpus, queries, args.k)
+
+    client = get_client(args.uri)
+    results = []
+    for dim in args.dims:
+        for index_type in args.indexes:
+            result = bench_one(client, corpus, queries, truth_full, dim, index_type.upper(), args.k, args.insert_batch)
+            print(json.dumps(result))
+            results.append(result)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"n": len(corpus), "queries": len(queries), "k": args.k, "source": args.source, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# --- Synthetic multi-page Duke Energy style bills, written as minimal PDFs without extra dependencies ---
+
+import random
+from datetime import date, timedelta
+from typing import Dict, List, Tuple
+
+_RATES = ["Residential Service (RS)", "Residential Service Time of Use (RSTOU)", "Small General Service (SGS)"]
+
+
+def _escape(line: str) -> str:
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def pdf_from_pages(pages: List[List[str]]) -> bytes:
+    """A text-only PDF with one Helvetica line per string; pypdf extracts the lines back in order."""
+    objects: List[bytes] = []
+
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(b"")  # filled in once the page tree exists
+    tree = add(b"")
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    page_ids = []
+    for lines in pages:
+        stream = "".join(f"BT /F1 9 Tf 36 {770 - 12 * i} Td ({_escape(line)}) Tj ET\n" for i, line in enumerate(lines)).encode("latin-1")
+        content = add(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        page_ids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>"
+            % (tree, font, content)
+        ))
+    objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % tree
+    kids = b" ".join(b"%d 0 R" % i for i in page_ids)
+    objects[tree - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog, xref)
+    return bytes(out)
+
+
+def bill_pages(account: str, period_start: date, n_pages: int, rng: random.Random) -> Tuple[List[List[str]], Dict]:
+    """Page lines of one bill plus the values printed on it (for building questions)."""
+    period_end = period_start + timedelta(days=29)
+    due = period_end + timedelta(days=21)
+    kwh = rng.randint(350, 2400)
+    rate = round(rng.uniform(0.09, 0.16), 4)
+    amount = round(kwh * rate + 14.0, 2)
+    fmt = lambda d: d.strftime("%b %d, %Y")
+    facts = {"account": account, "month": period_end.strftime("%B %Y"), "kwh": kwh, "amount_due": amount, "rate": rate}
+
+    summary = [
+        "Duke Energy Carolinas",
+        f"Account number: {account[:4]} {account[4:8]} {account[8:]}",
+        f"Billing period: {fmt(period_start)} - {fmt(period_end)}",
+        f"Your rate: {rng.choice(_RATES)}",
+        f"Total usage {kwh:,} kWh",
+        f"Energy charge ${rate} per kWh",
+        f"Amount due ${amount:,.2f}",
+        f"Payment due date: {fmt(due)}",
+    ]
+    pages = [summary + [f"Message {i}: Thank you for being a Duke Energy customer. Tips to save energy this season." for i in range(20)]]
+    for p in range(1, n_pages):
+        day = period_start
+        lines = [f"Daily usage detail, page {p + 1}"]
+        for _ in range(40):
+            lines.append(f"{day.strftime('%m/%d/%Y')}  on-peak {rng.uniform(2, 30):.1f} kWh  off-peak {rng.uniform(5, 40):.1f} kWh  high {rng.randint(40, 98)}F")
+            day += timedelta(days=1)
+        pages.append(lines)
+    return pages, facts
+
+
+def generate_bills(n: int, pages: Tuple[int, int] = (2, 6), seed: int = 0) -> List[Tuple[str, bytes, Dict]]:
+    """n bills spread over a few accounts and consecutive months: [(key, pdf_bytes, facts)]."""
+    rng = random.Random(seed)
+    accounts = [f"{rng.randint(10 ** 11, 10 ** 12 - 1)}" for _ in range(max(1, n // 12))]
+    bills = []
+    for i in range(n):
+        account = accounts[i % len(accounts)]
+        month = i // len(accounts)
+        start = date(2023 + month // 12, month % 12 + 1, 5)
+        page_lines, facts = bill_pages(account, start, rng.randint(*pages), rng)
+        key = f"bills/{account}/{start.strftime('%Y-%m')}.pdf"
+        bills.append((key, pdf_from_pages(page_lines), facts))
+    return bills
@@ -0,0 +1,303 @@
+import os
+import re
+import time
+import uuid
+import logging
+import threading
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional
+
+# --- Configuration ---
+BILL_FIELDS_DIR = os.getenv("BILL_FIELDS_DIR", "bill_fields") # "" disables field extraction
+BILL_FIELDS_FLUSH_ROWS = 500 # Records buffered before a Parquet file is written
+
+# --- Field Extraction ---
+# Patterns for the fields printed on Duke Energy bills. Each field takes the
+# first pattern that matches; fields that are not found are left as None.
+_MONTHS = "Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Sept|Oct|Nov|Dec"
+_DATE = rf"(?:(?:{_MONTHS})[a-z]*\.?\s+\d{{1,2}},?\s+\d{{4}}|\d{{1,2}}/\d{{1,2}}/\d{{2,4}})"
+_NUMBER = r"\d{1,3}(?:,\d{3})*(?:\.\d+)?|\d+(?:\.\d+)?"
+
+_PATTERNS = {
+    "account": [
+        r"Account\s+(?:number|no\.?|#)\s*:?\s*(\d[\d\s-]{6,}\d)",
+    ],
+    "period": [
+        rf"(?:Billing|Service|Bill)\s+period\s*:?\s*({_DATE})\s*(?:-|–|to|through)\s*({_DATE})",
+        rf"[Ss]ervice\s+(?:from\s+)?({_DATE})\s*(?:-|–|to|through)\s*({_DATE})",
+    ],
+    "kwh": [
+        rf"(?:Total|Billed|Energy)\s+(?:usage|kWh|energy\s+used|used)\D{{0,25}}?({_NUMBER})\s*kWh",
+        rf"({_NUMBER})\s*kWh\s+(?:used|total|billed)",
+        rf"({_NUMBER})\s*kWh",
+    ],
+    "amount_due": [
+        rf"(?:Total\s+)?[Aa]mount\s+due[^$\d]{{0,40}}\$\s*({_NUMBER})",
+        rf"[Tt]otal\s+(?:current\s+)?(?:charges|due)[^$\d]{{0,40}}\$\s*({_NUMBER})",
+    ],
+    "due_date": [
+        rf"(?:[Pp]ayment\s+)?[Dd]ue\s+(?:date|by|on)\s*:?\s*({_DATE})",
+        rf"[Pp]lease\s+pay\s+by\s*:?\s*({_DATE})",
+    ],
+    "rate_schedule": [
+        r"(?:Rate|Rate\s+schedule|Your\s+rate)\s*:\s*([A-Za-z][\w ()/&-]{2,60}?)\s*(?:\n|$)",
+        r"((?:Residential|Small\s+General|General)\s+Service[\w ()-]{0,30}?)\s*(?:\n|$)",
+    ],
+    "rate_per_kwh": [
+        rf"\$?\s*({_NUMBER})\s*(?:per|/)\s*kWh",
+    ],
+}
+_COMPILED = {field: [re.compile(p, re.MULTILINE) for p in patterns] for field, patterns in _PATTERNS.items()}
+
+
+def _parse_date(text: str) -> Optional[date]:
+    text = re.sub(r"\s+", " ", text.replace(",", "")).strip()
+    text = text.replace("Sept ", "Sep ")
+    for fmt in ("%b %d %Y", "%B %d %Y", "%b. %d %Y", "%m/%d/%Y", "%m/%d/%y"):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_number(text: str) -> Optional[float]:
+    try:
+        return float(text.replace(",", ""))
+    except ValueError:
+        return None
+
+
+def _first(field: str, text: str):
+    for pattern in _COMPILED[field]:
+        match = pattern.search(text)
+        if match:
+            return match.groups()
+    return None
+
+
+def extract_bill_fields(pages: List[str]) -> Dict[str, Any]:
+    """
+    Parses the structured fields of one bill from its page texts. Returns a
+    dict with account, period_start, period_end, billing_month ("YYYY-MM" of
+    the period end), kwh, amount_due, due_date, rate_schedule and
+    rate_per_kwh; fields that are not found are None.
+    """
+    text = "\n".join(pages)
+    fields: Dict[str, Any] = dict.fromkeys(
+        ["account", "period_start", "period_end", "billing_month", "kwh", "amount_due", "due_date", "rate_schedule", "rate_per_kwh"]
+    )
+
+    found = _first("account", text)
+    if found:
+        fields["account"] = re.sub(r"[\s-]", "", found[0])
+    found = _first("period", text)
+    if found:
+        fields["period_start"], fields["period_end"] = _parse_date(found[0]), _parse_date(found[1])
+    found = _first("kwh", text)
+    if found:
+        fields["kwh"] = _parse_number(found[0])
+    found = _first("amount_due", text)
+    if found:
+        fields["amount_due"] = _parse_number(found[0])
+    found = _first("due_date", text)
+    if found:
+        fields["due_date"] = _parse_date(found[0])
+    found = _first("rate_schedule", text)
+    if found:
+        fields["rate_schedule"] = found[0].strip()
+    found = _first("rate_per_kwh", text)
+    if found:
+        fields["rate_per_kwh"] = _parse_number(found[0])
+
+    month_from = fields["period_end"] or fields["due_date"]
+    if month_from is not None:
+        fields["billing_month"] = month_from.strftime("%Y-%m")
+    return fields
+
+
+# --- Columnar Store ---
+def _schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("etag", pa.string()),
+        ("key", pa.string()),
+        ("account", pa.string()),
+        ("period_start", pa.date32()),
+        ("period_end", pa.date32()),
+        ("billing_month", pa.string()),
+        ("kwh", pa.float64()),
+        ("amount_due", pa.float64()),
+        ("due_date", pa.date32()),
+        ("rate_schedule", pa.string()),
+        ("rate_per_kwh", pa.float64()),
+        ("extracted_at", pa.timestamp("us")),
+    ])
+
+
+class BillFieldStore:
+    """
+    Append-only Parquet dataset of extracted bill fields, hive-partitioned by
+    billing_month (root/billing_month=2024-07/part-*.parquet), so questions
+    about a range of months only read those partitions.
+
+    Records are buffered and written as one file per partition on flush().
+    A re-extracted or corrected bill is simply appended again; reads keep the
+    newest record per ETag and per (account, billing_month).
+    pyarrow is only imported when the store is first written or read.
+    """
+
+    def __init__(self, root: str = BILL_FIELDS_DIR, flush_rows: int = BILL_FIELDS_FLUSH_ROWS):
+        self.root = root
+        self.flush_rows = flush_rows
+        self.records_written = 0
+        self._buffer: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def add(self, etag: str, key: str, fields: Dict[str, Any]) -> bool:
+        """Buffers one bill's fields; bills with neither a month nor an amount/usage are skipped."""
+        if fields.get("billing_month") is None or (fields.get("kwh") is None and fields.get("amount_due") is None):
+            logging.info(f"No bill fields recognised in {key}; not added to the field store.")
+            return False
+        with self._lock:
+            self._buffer.append(dict(fields, etag=etag, key=key, extracted_at=datetime.utcnow()))
+            due = len(self._buffer) >= self.flush_rows
+        if due:
+            self.flush()
+        return True
+
+    def add_pages(self, etag: str, key: str, pages: List[str]) -> bool:
+        return self.add(etag, key, extract_bill_fields(pages))
+
+    def flush(self) -> int:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        with self._lock:
+            records, self._buffer = self._buffer, []
+        if not records:
+            return 0
+        by_month: Dict[str, List[Dict[str, Any]]] = {}
+        for record in records:
+            by_month.setdefault(record["billing_month"], []).append(record)
+        schema = _schema()
+        for month, rows in by_month.items():
+            directory = os.path.join(self.root, f"billing_month={month}")
+            os.makedirs(directory, exist_ok=True)
+            table = pa.Table.from_pylist(rows, schema=schema).drop_columns(["billing_month"])
+            # Write-then-rename so readers never see a half-written file
+            final = os.path.join(directory, f"part-{int(time.time())}-{uuid.uuid4().hex[:8]}.parquet")
+            pq.write_table(table, final + ".tmp")
+            os.replace(final + ".tmp", final)
+        self.records_written += len(records)
+        logging.info(f"Wrote {len(records)} bill records across {len(by_month)} month partitions.")
+        return len(records)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def read(self, since: str = None, until: str = None, account: str = None):
+        """
+        Latest record per bill as a pyarrow Table, optionally restricted to
+        billing months in [since, until] ("YYYY-MM") and one account.
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        files = [
+            os.path.join(dirpath, name)
+            for dirpath, _, names in os.walk(self.root)
+            for name in names if name.endswith(".parquet")
+        ]
+        if not files:
+            return _schema().empty_table()
+        dataset = ds.dataset(files, schema=_schema(), format="parquet", partitioning="hive", partition_base_dir=self.root)
+        condition = None
+        for part in (
+            ds.field("billing_month") >= since if since else None,
+            ds.field("billing_month") <= until if until else None,
+            ds.field("account") == account if account else None,
+        ):
+            if part is not None:
+                condition = part if condition is None else condition & part
+        table = dataset.to_table(filter=condition)
+        if table.num_rows == 0:
+            return table
+
+        # Newest extraction wins, first per ETag, then per (account, billing_month)
+        table = table.sort_by([("extracted_at", "descending")])
+        keep, seen_etags, seen_bills = [], set(), set()
+        for i, (etag, account_no, month) in enumerate(zip(
+            table["etag"].to_pylist(), table["account"].to_pylist(), table["billing_month"].to_pylist()
+        )):
+            bill = (account_no, month)
+            if etag in seen_etags or (account_no is not None and bill in seen_bills):
+                continue
+            seen_etags.add(etag)
+            seen_bills.add(bill)
+            keep.append(i)
+        return table.take(pa.array(keep)).sort_by([("billing_month", "ascending")])
+
+
+# --- Aggregates ---
+AGGREGATES = {"sum", "mean", "min", "max", "count"}
+METRICS = {"kwh", "amount_due", "rate_per_kwh"}
+
+
+def aggregate(
+    store: BillFieldStore,
+    metric: str = "kwh",
+    agg: str = "sum",
+    group_by: str = "billing_month",
+    since: str = None,
+    until: str = None,
+    account: str = None,
+) -> List[Dict[str, Any]]:
+    """
+    `agg` of `metric` per `group_by` ("billing_month", "account", "year" or
+    "none"), e.g. monthly kWh for the last year. Returns plain dict rows.
+    """
+    import pyarrow.compute as pc
+
+    if metric not in METRICS:
+        raise ValueError(f"metric must be one of {sorted(METRICS)}")
+    if agg not in AGGREGATES:
+        raise ValueError(f"agg must be one of {sorted(AGGREGATES)}")
+    table = store.read(since=since, until=until, account=account)
+    if table.num_rows == 0:
+        return []
+
+    if group_by == "year":
+        table = table.append_column("year", pc.utf8_slice_codeunits(table["billing_month"], 0, 4))
+    if group_by == "none":
+        value = getattr(pc, agg)(table[metric]).as_py() if agg != "count" else pc.count(table[metric]).as_py()
+        return [{f"{metric}_{agg}": value, "bills": table.num_rows}]
+    if group_by not in ("billing_month", "account", "year"):
+        raise ValueError("group_by must be billing_month, account, year or none")
+
+    aggregations = [(metric, agg)] if agg == "count" else [(metric, agg), (metric, "count")]
+    rows = []
+    for row in table.group_by(group_by).aggregate(aggregations).to_pylist():
+        out = {group_by: row[group_by], f"{metric}_{agg}": row[f"{metric}_{agg}"], "bills": row[f"{metric}_count"]}
+        rows.append(out)
+    return sorted(rows, key=lambda r: (r[group_by] is None, r[group_by]))
+
+
+def backfill_from_text_store(text_store, store: BillFieldStore) -> Dict[str, int]:
+    """Extracts fields for every document already in the text store (no downloads)."""
+    stats = {"documents": 0, "added": 0}
+    for record in text_store.iter_records():
+        stats["documents"] += 1
+        if store.add_pages(record["etag"], record["key"], record["pages"]):
+            stats["added"] += 1
+    store.flush()
+    return stats
@@ -0,0 +1,183 @@
+import os
+import math
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Dict, Iterable, List, Set, Tuple
+
+# --- Configuration ---
+ETAG_MANIFEST_PATH = os.getenv("ETAG_MANIFEST_PATH", "etag_manifest.sqlite")
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings. Never gives false negatives, so a
+    miss proves an ETag was never ingested without touching SQLite.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(1, capacity)
+        self.n_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.n_bits + 7) // 8)
+
+    def _positions(self, item: str) -> Iterable[int]:
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.n_hashes):
+            yield (h1 + i * h2) % self.n_bits
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class EtagManifest:
+    """
+    Local, persistent record of every ETag that was successfully ingested.
+
+    By default all ETags are loaded into an in-memory set, so existence checks
+    cost no I/O at all. With use_bloom=True only a Bloom filter is kept in
+    memory and SQLite is consulted for the (rare) positives, which keeps
+    memory flat for very large buckets.
+    """
+
+    def __init__(self, path: str = ETAG_MANIFEST_PATH, use_bloom: bool = False, bloom_capacity: int = 1_000_000):
+        self.path = path
+        self.use_bloom = use_bloom
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS etags (etag TEXT PRIMARY KEY, filename TEXT, ingested_at REAL)"
+        )
+        self._conn.commit()
+
+        self._etags: Set[str] = set()
+        self._bloom = None
+        if use_bloom:
+            count = self._conn.execute("SELECT COUNT(*) FROM etags").fetchone()[0]
+            rows = self._conn.execute("SELECT etag FROM etags")
+            self._bloom_capacity = max(bloom_capacity, 2 * count)
+            self._bloom = BloomFilter(self._bloom_capacity)
+            for (etag,) in rows:
+                self._bloom.add(etag)
+        else:
+            self._etags = {etag for (etag,) in self._conn.execute("SELECT etag FROM etags")}
+
+    @staticmethod
+    def exists(path: str = ETAG_MANIFEST_PATH) -> bool:
+        return os.path.exists(path)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM etags").fetchone()[0]
+
+    def __contains__(self, etag: str) -> bool:
+        if self._bloom is None:
+            return etag in self._etags
+        if etag not in self._bloom:
+            return False
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM etags WHERE etag = ?", (etag,)).fetchone() is not None
+
+    def contains_many(self, etags: Iterable[str]) -> Set[str]:
+        """Returns the subset of `etags` that is already in the manifest."""
+        return {etag for etag in etags if etag in self}
+
+    def add_many(self, items: Iterable[Tuple[str, str]]):
+        """Records (etag, filename) pairs as ingested."""
+        items = [(etag, filename) for etag, filename in items if etag]
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO etags (etag, filename, ingested_at) VALUES (?, ?, ?)",
+                [(etag, filename, now) for etag, filename in items],
+            )
+            self._conn.commit()
+            for etag, _ in items:
+                if self._bloom is not None:
+                    self._bloom.add(etag)
+                else:
+                    self._etags.add(etag)
+
+    def discard_many(self, etags: Iterable[str]):
+        """Forgets ETags whose rows were removed (e.g. superseded by an upsert)."""
+        etags = [etag for etag in etags if etag]
+        if not etags:
+            return
+        with self._lock:
+            self._conn.executemany("DELETE FROM etags WHERE etag = ?", [(etag,) for etag in etags])
+            self._conn.commit()
+            # A Bloom filter cannot forget; its false positives are settled by the SQLite lookup
+            self._etags.difference_update(etags)
+
+    def record_rows(self, rows: List[Dict]):
+        """BufferedWriter on_flush hook: records the ETags of the rows just inserted."""
+        self.add_many({(row.get("ETag"), row.get("filename")) for row in rows})
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def rebuild_manifest(path: str, milvus_client, collection_name: str, etag_field: str = "ETag", batch_size: int = 1000) -> int:
+    """
+    Replaces the manifest at `path` with the ETags currently stored in the
+    collection, scanning it once with a query iterator. The new manifest is
+    built in a temporary file and moved into place only after a complete
+    scan, so a failed or interrupted rebuild leaves the previous file (or
+    none) rather than a partial one that later runs would trust. Close any
+    EtagManifest open on `path` first. Returns the number of distinct ETags.
+    """
+    logging.info(f"Rebuilding ETag manifest '{path}' from collection '{collection_name}'...")
+    tmp_path = f"{path}.rebuild"
+    for stale in (tmp_path, f"{tmp_path}-wal", f"{tmp_path}-shm"):
+        if os.path.exists(stale):
+            os.remove(stale)
+    milvus_client.load_collection(collection_name)
+    iterator = milvus_client.query_iterator(
+        collection_name=collection_name,
+        batch_size=batch_size,
+        filter="",
+        output_fields=[etag_field, "filename"],
+    )
+
+    manifest = EtagManifest(tmp_path)
+    seen = set()
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            new = {
+                (str(r[etag_field]).strip('"').strip("'"), r.get("filename"))
+                for r in rows
+                if r.get(etag_field) is not None
+            }
+            new = {item for item in new if item[0] not in seen}
+            seen.update(etag for etag, _ in new)
+            manifest.add_many(new)
+    except BaseException:
+        manifest.close()
+        os.remove(tmp_path)
+        raise
+    finally:
+        iterator.close()
+
+    # Closing the last connection checkpoints the WAL into the file, so one file is moved
+    manifest.close()
+    for stale in (f"{path}-wal", f"{path}-shm"):
+        if os.path.exists(stale):
+            os.remove(stale)
+    os.replace(tmp_path, path)
+    logging.info(f"ETag manifest rebuilt with {len(seen)} ETags.")
+    return len(seen)
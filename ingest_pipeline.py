@@ -0,0 +1,512 @@
+import os
+import json
+import queue
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Callable, Dict, Any, List, Iterable, Tuple, TYPE_CHECKING
+
+from milvus_pool import get_client, touch_write_stamp, BufferedWriter, WriterFull
+from pdf_extract import (
+    download_to_tempfile, extract_pdf_file, extract_pdf_bytes, count_pages, submit_page_ranges, gather_page_ranges,
+    PAGE_FANOUT_MIN_PAGES, PAGE_TIMEOUT_SECONDS,
+)
+from text_store import TextStore
+from bill_fields import BillFieldStore
+import pdf_to_vector
+import metrics
+
+if TYPE_CHECKING:
+    from etag_manifest import EtagManifest
+from pdf_to_vector import build_payloads, upsert_documents, PAGE_SEPARATOR, EMBED_BATCH_SIZE, MILVUS_URI, COLLECTION_NAME
+
+# --- Configuration ---
+DOWNLOAD_WORKERS = 8      # Concurrent S3 get_object calls
+EXTRACT_WORKERS = os.cpu_count() or 2 # pypdf worker processes
+QUEUE_SIZE = 32           # Max documents waiting between two stages (backpressure)
+EMBED_BATCH_DOCS = 8      # Max documents whose chunks are embedded together
+INSERT_BATCH_ROWS = 1000  # Rows gathered before one Milvus insert
+
+_DONE = object() # End-of-stream marker passed between stages
+_DOCUMENT_EVENTS = {"queued": "queue", "downloaded": "download", "extracted": "extract", "embedded": "embed", "text_store_hits": "text_store"}
+
+
+class IngestPipeline:
+    """
+    Staged ingestion: download -> extract -> embed -> insert.
+
+    Each stage runs concurrently and hands work to the next one through a
+    bounded queue, so a slow stage blocks the ones before it instead of
+    letting documents pile up in memory:
+      - a thread pool downloads objects (network bound),
+      - a process pool extracts PDF text (CPU bound, GIL free),
+      - a single thread embeds documents in batches (one model in memory),
+      - a single thread hands rows to a BufferedWriter for bulk inserts.
+    Failures are counted per document and never stop the pipeline.
+    Stage times, document counts, failures and queue depths are also
+    reported through `metrics`; with tracing on every document gets
+    download/extract/embed spans under the trace id of its ETag.
+    In "spool" download mode bodies are streamed to temp files that the
+    extraction processes mmap, so no document is held in RAM between stages;
+    "memory" mode passes the body bytes instead.
+    Spooled documents longer than page_fanout_min_pages are split into page
+    ranges that run as separate pool tasks; a page that fails or exceeds
+    page_timeout is left empty and listed in meta["failed_pages"].
+    With a TextStore, documents whose ETag is already stored skip download
+    and extraction, and freshly extracted text is added to the store.
+    `on_done(key)` is called once per object when it has been inserted or
+    produced no rows, `on_failed(key)` when it failed (on_done if no
+    on_failed is given).
+    With upsert=True each document replaces the stored version of its key
+    (see pdf_to_vector.upsert_documents) instead of being appended; the
+    manifest, if given, then also forgets the superseded ETags.
+    With a BillFieldStore, the bill fields of every extracted document
+    (text store hits included) are parsed and appended to it.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucket: str,
+        writer: BufferedWriter = None,
+        download_workers: int = DOWNLOAD_WORKERS,
+        extract_workers: int = EXTRACT_WORKERS,
+        queue_size: int = QUEUE_SIZE,
+        embed_batch_docs: int = EMBED_BATCH_DOCS,
+        embed_batch_size: int = EMBED_BATCH_SIZE,
+        insert_batch_rows: int = INSERT_BATCH_ROWS,
+        max_pages: int = None,
+        download_mode: str = "spool",
+        spool_dir: str = None,
+        text_store: TextStore = None,
+        on_done: Callable[[str], None] = None,
+        on_failed: Callable[[str], None] = None,
+        upsert: bool = False,
+        manifest: "EtagManifest" = None,
+        bill_fields: BillFieldStore = None,
+        page_timeout: float = PAGE_TIMEOUT_SECONDS,
+        page_fanout_min_pages: int = PAGE_FANOUT_MIN_PAGES,
+    ):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.writer = writer or BufferedWriter(get_client(MILVUS_URI), COLLECTION_NAME, max_rows=insert_batch_rows)
+        self.download_workers = max(1, download_workers)
+        self.extract_workers = max(1, extract_workers)
+        self.queue_size = max(1, queue_size)
+        self.embed_batch_docs = max(1, embed_batch_docs)
+        self.embed_batch_size = embed_batch_size
+        self.max_pages = max_pages
+        self.download_mode = download_mode
+        self.spool_dir = spool_dir
+        self.text_store = text_store
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.upsert = upsert
+        self.manifest = manifest
+        self.bill_fields = bill_fields
+        self.page_timeout = page_timeout
+        self.page_fanout_min_pages = page_fanout_min_pages
+        if on_done is not None:
+            self._chain_on_flush()
+
+        self.stats = {"queued": 0, "downloaded": 0, "extracted": 0, "embedded": 0, "rows_inserted": 0, "failed": 0, "text_store_hits": 0, "failed_pages": 0, "peak_rss_kb": 0}
+        if upsert:
+            self.stats.update({"rows_removed": 0, "rows_reused": 0})
+        if bill_fields is not None:
+            self.stats["bill_fields"] = 0
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name: str, n: int = 1):
+        with self._stats_lock:
+            self.stats[name] += n
+        if name in _DOCUMENT_EVENTS:
+            metrics.DOCUMENTS.inc(n, stage=_DOCUMENT_EVENTS[name], result="ok")
+
+    def _failed(self, stage: str, keys: List[str]):
+        self._count("failed", len(keys))
+        metrics.FAILURES.inc(len(keys), stage=stage)
+        metrics.DOCUMENTS.inc(len(keys), stage=stage, result="failed")
+        for key in keys:
+            if self.on_failed is not None:
+                self.on_failed(key)
+            else:
+                self._done(key)
+
+    def _done(self, key: str):
+        if self.on_done is not None:
+            self.on_done(key)
+
+    def _chain_on_flush(self):
+        """Reports documents as done once their rows are actually in Milvus."""
+        previous = self.writer.on_flush
+
+        def _on_flush(rows: List[Dict]):
+            if previous is not None:
+                previous(rows)
+            for key in dict.fromkeys(row["filename"] for row in rows):
+                self._done(key)
+
+        self.writer.on_flush = _on_flush
+
+    # --- Stages ---
+    def _feed(self, objects: Iterable[Dict[str, Any]], obj_q: queue.Queue):
+        try:
+            for obj in objects:
+                obj_q.put(obj)
+                self._count("queued")
+        except Exception as e:
+            logging.error(f"Object listing failed, finishing with what was queued: {e}")
+        finally:
+            for _ in range(self.download_workers):
+                obj_q.put(_DONE)
+
+    def _download(self, obj_q: queue.Queue, downloaded_q: queue.Queue, extracted_q: queue.Queue):
+        while True:
+            obj = obj_q.get()
+            if obj is _DONE:
+                return
+            key = obj.get("Key") if isinstance(obj, dict) else None
+            try:
+                # Inside the try: one malformed listing entry must not end this worker
+                etag = obj["ETag"].strip('"')
+                record = self.text_store.get(etag) if self.text_store is not None else None
+                if record is not None:
+                    # Already extracted once: go straight to the embedder
+                    extracted_q.put((etag, key, PAGE_SEPARATOR.join(record["pages"]), record["pages"], record["meta"]))
+                    self._count("text_store_hits")
+                    continue
+
+                with metrics.timed("download", metrics.trace_id_for(etag), key=key, mode=self.download_mode):
+                    if self.download_mode == "memory":
+                        resp = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+                        source = resp["Body"].read()
+                        meta = {
+                            "content_length": resp.get("ContentLength"),
+                            "content_type": resp.get("ContentType"),
+                            "key": key,
+                            "bucket": self.bucket,
+                        }
+                    else:
+                        source, meta = download_to_tempfile(self.s3_client, self.bucket, key, directory=self.spool_dir)
+                metrics.BYTES.inc(meta.get("content_length") or 0)
+                downloaded_q.put((obj, source, meta))
+                self._count("downloaded")
+            except Exception as e:
+                logging.error(f"[skip] download of {key} failed: {e}")
+                self._failed("download", [key])
+
+    def _dispatch_extract(self, pool: ProcessPoolExecutor, downloaded_q: queue.Queue, pending_q: queue.Queue):
+        while True:
+            item = downloaded_q.get()
+            if item is _DONE:
+                pending_q.put(_DONE)
+                return
+            obj, source, meta = item
+            # pending_q is bounded, which caps the number of documents inside the process pool
+            submitted = time.time()
+            try:
+                job = self._submit_extract(pool, obj, source)
+            except Exception as e:
+                logging.error(f"[skip] text extraction of {obj['Key']} could not start: {e}")
+                self._failed("extract", [obj["Key"]])
+                if isinstance(source, str):
+                    os.remove(source)
+                continue
+            pending_q.put((obj, source, meta, job, submitted))
+
+    def _submit_extract(self, pool: ProcessPoolExecutor, obj: Dict[str, Any], source):
+        """A future for the whole document, or (n_pages_total, page range futures) for a long one."""
+        if isinstance(source, bytes):
+            return pool.submit(extract_pdf_bytes, source, self.max_pages, self.page_timeout)
+        try:
+            n_pages_total = count_pages(source)
+        except Exception as e:
+            logging.debug(f"Could not count the pages of {obj['Key']}, extracting it as one task: {e}")
+            n_pages_total = 0
+        if n_pages_total > self.page_fanout_min_pages:
+            return n_pages_total, submit_page_ranges(pool, source, n_pages_total, self.max_pages, page_timeout=self.page_timeout)
+        return pool.submit(extract_pdf_file, source, self.max_pages, self.page_timeout)
+
+    def _collect_extract(self, pending_q: queue.Queue, extracted_q: queue.Queue):
+        while True:
+            item = pending_q.get()
+            if item is _DONE:
+                extracted_q.put(_DONE)
+                return
+            obj, source, meta, job, submitted = item
+            etag = None
+            try:
+                etag = obj["ETag"].strip('"')
+                if isinstance(job, tuple):
+                    n_pages_total, ranges = job
+                    pages, failed_pages, peak_rss_kb = gather_page_ranges(ranges)
+                else:
+                    pages, n_pages_total, failed_pages, peak_rss_kb = job.result()
+                meta.update({"n_pages_total": n_pages_total, "n_pages_read": len(pages), "failed_pages": failed_pages, "peak_rss_kb": peak_rss_kb})
+                logging.info(f"[PDF] {obj['Key']} | pages_read={len(pages)}/{n_pages_total} | failed_pages={len(failed_pages)} | peak_rss={peak_rss_kb} kB")
+                with self._stats_lock:
+                    self.stats["peak_rss_kb"] = max(self.stats["peak_rss_kb"], peak_rss_kb)
+                    self.stats["failed_pages"] += len(failed_pages)
+                # Submit-to-result time, so it includes the wait for a free worker process
+                finished = time.time()
+                metrics.STAGE_SECONDS.observe(finished - submitted, stage="extract")
+                metrics.PAGES.inc(len(pages) - len(failed_pages), result="ok")
+                metrics.PAGES.inc(len(failed_pages), result="failed")
+                metrics.record_span(
+                    "extract", metrics.trace_id_for(etag), submitted, finished,
+                    key=obj["Key"], pages=len(pages), failed_pages=len(failed_pages), fanout=isinstance(job, tuple),
+                )
+                if self.text_store is not None:
+                    self.text_store.put(etag, obj["Key"], pages, meta)
+                extracted_q.put((etag, obj["Key"], PAGE_SEPARATOR.join(pages), pages, meta))
+                self._count("extracted")
+            except Exception as e:
+                logging.error(f"[skip] text extraction of {obj['Key']} failed: {e}")
+                if etag is not None:
+                    metrics.record_span("extract", metrics.trace_id_for(etag), submitted, time.time(), status="error", key=obj["Key"])
+                self._failed("extract", [obj["Key"]])
+            finally:
+                if isinstance(source, str):
+                    os.remove(source)
+
+    def _embed(self, extracted_q: queue.Queue, rows_q: queue.Queue):
+        finished = False
+        while not finished:
+            batch = [extracted_q.get()]
+            # Top the batch up with whatever is already waiting, without blocking
+            while len(batch) < self.embed_batch_docs and batch[-1] is not _DONE:
+                try:
+                    batch.append(extracted_q.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is _DONE:
+                batch.pop()
+                finished = True
+            if not batch:
+                continue
+
+            documents = [(etag, key, text, pages) for etag, key, text, pages, _ in batch]
+            self._extract_fields(documents)
+            if self.upsert:
+                self._upsert(documents)
+                continue
+            started = time.time()
+            try:
+                rows = build_payloads(documents, batch_size=self.embed_batch_size)
+            except Exception as e:
+                logging.error(f"[skip] embedding of {len(batch)} documents failed: {e}")
+                self._trace_batch("embed", documents, started, status="error")
+                self._failed("embed", [key for _, key, _, _ in documents])
+                continue
+
+            self._trace_batch("embed", documents, started)
+            self._count("embedded", len(batch))
+            keys_with_rows = {row["filename"] for row in rows}
+            for _, key, _, _ in documents:
+                if key not in keys_with_rows:
+                    self._done(key)
+            rows_q.put(rows)
+        rows_q.put(_DONE)
+
+    @staticmethod
+    def _trace_batch(name: str, documents: List[Tuple], started: float, status: str = "ok"):
+        """One span per document of a batch that was processed as a whole."""
+        if not metrics.tracing_enabled():
+            return
+        finished = time.time()
+        for etag, key, _, _ in documents:
+            metrics.record_span(name, metrics.trace_id_for(etag), started, finished, status=status, key=key, batch_docs=len(documents))
+
+    def _extract_fields(self, documents: List[Tuple]):
+        if self.bill_fields is None:
+            return
+        for etag, key, _, pages in documents:
+            try:
+                if self.bill_fields.add_pages(etag, key, pages):
+                    self._count("bill_fields")
+            except Exception as e:
+                logging.warning(f"Bill field extraction failed for {key}: {e}")
+
+    def _upsert(self, documents: List[Tuple]):
+        """Diffs and writes the batch right here: its deletes must follow its own flushed inserts."""
+        started = time.time()
+        try:
+            report = upsert_documents(
+                documents, collection_name=self.writer.collection_name, writer=self.writer,
+                manifest=self.manifest, batch_size=self.embed_batch_size,
+            )
+        except Exception as e:
+            logging.error(f"[skip] upsert of {len(documents)} documents failed: {e}")
+            self._trace_batch("upsert", documents, started, status="error")
+            self._failed("upsert", [key for _, key, _, _ in documents])
+            return
+        self._trace_batch("upsert", documents, started)
+        self._count("embedded", len(documents))
+        self._count("rows_removed", report["removed"])
+        self._count("rows_reused", report["reused"])
+        # Keys with new rows were reported by the flush; unchanged documents are done as well
+        for _, key, _, _ in documents:
+            self._done(key)
+
+    def _insert(self, rows_q: queue.Queue):
+        while True:
+            rows = rows_q.get()
+            if rows is _DONE:
+                try:
+                    self.writer.flush()
+                except Exception as e:
+                    # Nothing will retry these rows any more
+                    lost = self.writer.discard()
+                    logging.error(f"Final bulk insert failed, {len(lost)} rows were not written: {e}")
+                    self._failed("insert", list(dict.fromkeys(row["filename"] for row in lost)))
+                return
+            try:
+                self.writer.add(rows)
+            except WriterFull as e:
+                logging.error(f"[skip] {len(rows)} rows dropped, the writer is full: {e}")
+                self._failed("insert", list(dict.fromkeys(row["filename"] for row in rows)))
+            except Exception as e:
+                logging.error(f"Bulk insert failed after retries, rows kept for the next flush: {e}")
+                metrics.FAILURES.inc(stage="insert_retry")
+
+    # --- Driver ---
+    def run(self, objects: Iterable[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        Pushes every listed object through the pipeline and blocks until the
+        last row is inserted. Returns the per-stage counters.
+        """
+        obj_q = queue.Queue(maxsize=self.queue_size)
+        downloaded_q = queue.Queue(maxsize=self.queue_size)
+        pending_q = queue.Queue(maxsize=self.extract_workers * 2)
+        extracted_q = queue.Queue(maxsize=self.queue_size)
+        rows_q = queue.Queue(maxsize=self.queue_size)
+        rows_before = self.writer.rows_written
+
+        queues = {"objects": obj_q, "downloaded": downloaded_q, "extracting": pending_q, "extracted": extracted_q, "rows": rows_q}
+
+        def _sample_queues():
+            for name, q in queues.items():
+                metrics.QUEUE_DEPTH.set(q.qsize(), queue=name)
+
+        metrics.REGISTRY.add_collector(_sample_queues)
+        try:
+            with ProcessPoolExecutor(max_workers=self.extract_workers) as extract_pool:
+                # Start the worker processes before any pipeline thread exists, so they fork from a quiet parent
+                extract_pool.submit(int).result()
+
+                with ThreadPoolExecutor(max_workers=self.download_workers, thread_name_prefix="download") as download_pool:
+                    stage_threads = [
+                        threading.Thread(target=self._feed, args=(objects, obj_q), name="feed"),
+                        threading.Thread(target=self._dispatch_extract, args=(extract_pool, downloaded_q, pending_q), name="extract-dispatch"),
+                        threading.Thread(target=self._collect_extract, args=(pending_q, extracted_q), name="extract-collect"),
+                        threading.Thread(target=self._embed, args=(extracted_q, rows_q), name="embed"),
+                        threading.Thread(target=self._insert, args=(rows_q,), name="insert"),
+                    ]
+                    for t in stage_threads:
+                        t.start()
+
+                    downloads = [download_pool.submit(self._download, obj_q, downloaded_q, extracted_q) for _ in range(self.download_workers)]
+                    try:
+                        for d in downloads:
+                            d.result()
+                    finally:
+                        # Always end the downstream stages, or their threads would wait forever
+                        downloaded_q.put(_DONE)
+
+                    for t in stage_threads:
+                        t.join()
+        finally:
+            metrics.REGISTRY.remove_collector(_sample_queues)
+            for name in queues:
+                metrics.QUEUE_DEPTH.set(0, queue=name)
+
+        if self.bill_fields is not None:
+            self.bill_fields.flush()
+
+        self.stats["rows_inserted"] = self.writer.rows_written - rows_before
+        embedding_cache = pdf_to_vector.get_embedding_cache()
+        if embedding_cache is not None:
+            cache_stats = embedding_cache.stats()
+            self.stats["embedding_cache_hits"] = cache_stats["hits"]
+            self.stats["embedding_cache_misses"] = cache_stats["misses"]
+        logging.info(f"Ingestion pipeline finished: {self.stats}")
+        return dict(self.stats)
+
+
+def _etag_filter(etags: Iterable[str]) -> str:
+    return "ETag in [" + ",".join(json.dumps(etag) for etag in etags) + "]"
+
+
+def reindex_from_store(
+    text_store: TextStore,
+    writer: BufferedWriter,
+    embed_batch_docs: int = EMBED_BATCH_DOCS,
+    embed_batch_size: int = EMBED_BATCH_SIZE,
+    replace_existing: bool = True,
+) -> Dict[str, int]:
+    """
+    Rebuilds the vectors of every stored document with the current chunking
+    and embedding settings, without touching object storage.
+    With replace_existing the old rows of each batch's ETags are deleted from
+    the writer's collection once the new rows are inserted and flushed (like
+    upsert_documents), so a failed batch leaves the old rows in place; its
+    new rows are discarded, or deleted if a flush wrote part of them. Pass
+    False when writing into a fresh collection.
+    """
+    stats = {"documents": 0, "rows": 0, "failed": 0}
+    batch: List[Dict[str, Any]] = []
+
+    def _stale_ids(etags: List[str]) -> List[int]:
+        rows = writer.client.query(
+            collection_name=writer.collection_name, filter=_etag_filter(etags), output_fields=["id"],
+            limit=pdf_to_vector.UPSERT_QUERY_LIMIT,
+        )
+        if len(rows) >= pdf_to_vector.UPSERT_QUERY_LIMIT:
+            raise RuntimeError(f"{len(etags)} documents have {pdf_to_vector.UPSERT_QUERY_LIMIT}+ stored rows; use a smaller embed_batch_docs.")
+        return [row["id"] for row in rows]
+
+    def _rollback(etags: List[str], stale_ids: List[int]):
+        """Drops this batch's unflushed rows and deletes any of its rows a partial flush already wrote."""
+        lost = writer.discard()
+        try:
+            written = set(_stale_ids(etags)) - set(stale_ids)
+            for i in range(0, len(written), 1000):
+                writer.client.delete(collection_name=writer.collection_name, ids=sorted(written)[i:i + 1000])
+        except Exception as e:
+            logging.error(f"Could not remove the partly written rows of {len(etags)} documents: {e}")
+        return len(lost)
+
+    def _embed_batch():
+        documents = [(r["etag"], r["key"], PAGE_SEPARATOR.join(r["pages"]), r["pages"]) for r in batch]
+        etags = [r["etag"] for r in batch]
+        stale_ids = None
+        try:
+            # Old ids are read before the insert so that only they are deleted afterwards
+            stale_ids = _stale_ids(etags) if replace_existing else []
+            rows = build_payloads(documents, batch_size=embed_batch_size)
+            writer.add(rows)
+            writer.flush()
+            if stale_ids:
+                for i in range(0, len(stale_ids), 1000):
+                    writer.client.delete(collection_name=writer.collection_name, ids=stale_ids[i:i + 1000])
+                touch_write_stamp(writer.collection_name)
+            stats["documents"] += len(batch)
+            stats["rows"] += len(rows)
+        except Exception as e:
+            # Nothing of a failed batch may stay buffered for the next one to flush
+            dropped = _rollback(etags, stale_ids) if stale_ids is not None else len(writer.discard())
+            logging.error(f"[skip] reindexing of {len(batch)} documents failed, {dropped} buffered rows dropped: {e}")
+            stats["failed"] += len(batch)
+        batch.clear()
+
+    for record in text_store.iter_records():
+        batch.append(record)
+        if len(batch) >= embed_batch_docs:
+            _embed_batch()
+    if batch:
+        _embed_batch()
+    writer.flush()
+
+    logging.info(f"Reindex from text store finished: {stats}")
+    return stats
@@ -0,0 +1,142 @@
+# --- Semantic answer cache: near-duplicate questions skip both LLM calls ---
+
+import os, re, json, time, threading
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import numpy as np  # ships with sentence-transformers
+
+ANSWER_CACHE_ENABLED = os.getenv("RAG_ANSWER_CACHE", "0") not in ("", "0", "false")  # opt-in
+ANSWER_CACHE_THRESHOLD = float(os.getenv("RAG_ANSWER_CACHE_THRESHOLD", "0.95"))  # cosine similarity
+ANSWER_CACHE_SIZE = int(os.getenv("RAG_ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("RAG_ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_UNSTAMPED_TTL = float(os.getenv("RAG_ANSWER_CACHE_UNSTAMPED_TTL", "300"))  # when no write stamp is visible
+ANSWER_CACHE_CONTEXT_MESSAGES = int(os.getenv("RAG_ANSWER_CACHE_CONTEXT", "4"))  # history messages that must match too
+
+
+def conversation_context(history: list, n: int = ANSWER_CACHE_CONTEXT_MESSAGES) -> str:
+    """
+    The last `n` history messages as a cache key part: a question only reuses
+    answers given after the same recent conversation ("and the month before?"
+    means something else in every chat). "" for a new conversation.
+    """
+    recent = history[-n:] if n else []
+    return json.dumps([[getattr(m, "type", ""), getattr(m, "content", str(m))] for m in recent]) if recent else ""
+
+
+def cited_etags(answer: str, tool_outputs: Iterable[str]) -> Set[str]:
+    """
+    ETags behind an answer: those of the passages whose [source_id] the answer
+    cites, or of every returned passage when it cites none we can recognise.
+    """
+    cited, returned = set(), set()
+    for content in tool_outputs:
+        try:
+            passages = json.loads(content).get("passages", [])
+        except (ValueError, AttributeError):
+            continue
+        for p in passages:
+            if not p.get("etag"):
+                continue
+            returned.add(p["etag"])
+            ids = p.get("source_ids") or [p.get("source_id")]
+            if any(sid and re.search(re.escape(sid) + r"(?!\d)", answer) for sid in ids):
+                cited.add(p["etag"])
+    return cited or returned
+
+
+class SemanticAnswerCache:
+    """
+    Answers keyed by the (unit-normalised) embedding of the question and an
+    exact `context` string (see conversation_context). A lookup returns the
+    most similar cached answer of the same context when its cosine
+    similarity reaches `threshold`. Every entry records the collection's
+    write stamp when it was stored and is dropped once the stamp moves: new
+    bills can change an answer ("my latest bill") even when the documents it
+    cited still exist. Entries also expire after `ttl`, or after
+    `unstamped_ttl` when they were stored without a visible stamp (0), since
+    then nothing would tell that the collection changed.
+    """
+
+    def __init__(self, read_stamp: Callable[[], int],
+                 threshold: float = ANSWER_CACHE_THRESHOLD, max_entries: int = ANSWER_CACHE_SIZE,
+                 ttl: float = ANSWER_CACHE_TTL, unstamped_ttl: float = ANSWER_CACHE_UNSTAMPED_TTL):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.unstamped_ttl = unstamped_ttl
+        self._read_stamp = read_stamp
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._entries: List[Dict] = []
+        self.hits = self.misses = self.invalidations = 0
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        return v / (np.linalg.norm(v) + 1e-12)
+
+    def lookup(self, vector, context: str = "") -> Optional[Dict]:
+        """Returns {"question", "answer", "etags", "similarity"} or None."""
+        q = self._unit(vector)
+        with self._lock:
+            self._expire()
+            while self._entries:
+                sims = self._vectors @ q
+                sims[np.array([e["context"] != context for e in self._entries])] = -np.inf
+                i = int(np.argmax(sims))
+                if sims[i] < self.threshold:
+                    break
+                entry = self._entries[i]
+                if self._still_valid(entry):
+                    self.hits += 1
+                    entry["last_used"] = time.monotonic()
+                    return dict(question=entry["question"], answer=entry["answer"],
+                                etags=sorted(entry["etags"]), similarity=float(sims[i]))
+                self._remove(i)
+                self.invalidations += 1
+            self.misses += 1
+            return None
+
+    def put(self, vector, question: str, answer: str, etags: Set[str], context: str = ""):
+        if not etags or not answer:
+            return  # only answers grounded in retrieved documents are cached
+        q = self._unit(vector)
+        now = time.monotonic()
+        with self._lock:
+            if self._entries and self._vectors.shape[1] != q.shape[0]:
+                self._clear()  # embedding size changed; old vectors are not comparable
+            if len(self._entries) >= self.max_entries:
+                self._remove(min(range(len(self._entries)), key=lambda i: self._entries[i]["last_used"]))
+            self._entries.append({"question": question, "answer": answer, "etags": set(etags), "context": context,
+                                  "created": now, "last_used": now, "stamp": self._read_stamp()})
+            self._vectors = np.vstack([self._vectors, q[None, :]]) if self._vectors.size else q[None, :]
+
+    def _still_valid(self, entry: Dict) -> bool:
+        # Anything written since the answer was stored may change it
+        if self._read_stamp() != entry["stamp"]:
+            return False
+        return bool(entry["stamp"]) or time.monotonic() - entry["created"] < self.unstamped_ttl
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        for i in reversed(range(len(self._entries))):
+            if self._entries[i]["created"] < cutoff:
+                self._remove(i)
+
+    def _remove(self, i: int):
+        del self._entries[i]
+        self._vectors = np.delete(self._vectors, i, axis=0)
+
+    def _clear(self):
+        self._entries = []
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0, "invalidations": self.invalidations}
@@ -0,0 +1,55 @@
+# --- Aggregate questions answered from the extracted bill-field table (no vector search, no LLM) ---
+
+import os, sys, json, time
+from typing import Optional
+from langchain_core.tools import tool
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from bill_fields import BillFieldStore, BILL_FIELDS_DIR, AGGREGATES, METRICS, aggregate
+
+BILL_FIELDS_PATH = os.getenv("RAG_BILL_FIELDS_DIR", BILL_FIELDS_DIR)
+
+_store: Optional[BillFieldStore] = None
+
+
+def _get_store() -> BillFieldStore:
+    global _store
+    if _store is None:
+        _store = BillFieldStore(BILL_FIELDS_PATH)
+    return _store
+
+
+def _last_months(n: int) -> str:
+    """First "YYYY-MM" of the last n billing months, counting the current one."""
+    now = time.localtime()
+    index = now.tm_year * 12 + now.tm_mon - 1 - (n - 1)
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+@tool("bill_stats", return_direct=False)
+def bill_stats(
+    metric: str = "kwh",
+    agg: str = "sum",
+    group_by: str = "billing_month",
+    months: int = 0,
+    since: str = "",
+    until: str = "",
+    account: str = "",
+) -> str:
+    """Aggregates fields extracted from every bill: metric is kwh, amount_due or rate_per_kwh;
+    agg is sum, mean, min, max or count; group_by is billing_month, account, year or none.
+    Restrict with months=N (last N months) or since/until as "YYYY-MM", and optionally one account.
+    Use for totals, averages and per-month usage or cost; returns JSON {rows, bills}."""
+    if metric not in METRICS or agg not in AGGREGATES:
+        return json.dumps({"error": f"metric must be one of {sorted(METRICS)} and agg one of {sorted(AGGREGATES)}"})
+    if months and not since:
+        since = _last_months(months)
+    try:
+        rows = aggregate(
+            _get_store(), metric=metric, agg=agg, group_by=group_by,
+            since=since or None, until=until or None, account=account or None,
+        )
+    except ValueError as e:
+        return json.dumps({"error": str(e)})
+    return json.dumps({"metric": metric, "agg": agg, "group_by": group_by, "since": since or None,
+                       "until": until or None, "rows": rows, "bills": sum(r["bills"] for r in rows)}, default=str)
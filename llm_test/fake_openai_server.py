@@ -0,0 +1,118 @@
+# --- Minimal OpenAI-compatible chat server for exercising llm_with_rag offline ---
+#
+#   python fake_openai_server.py --port 8011 --token-delay 0.02
+#   JETSTREAM_BASE=http://127.0.0.1:8011/v1 JETSTREAM_API_KEY=x JETSTREAM_MODEL=fake python llm_with_rag.py --stream --timings
+#
+# When tools are offered and the conversation has no tool results yet, the
+# model asks for search_pdfs, one parallel call per "and"-separated part of
+# the question; otherwise it answers with a short
+# <think> block followed by a canned answer citing the tool results.
+
+import json, time, uuid, argparse, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+
+def _tool_calls_for(question: str) -> List[Dict]:
+    parts = [p.strip() for p in question.split(" and ") if p.strip()] or [question]
+    return [
+        {"id": f"call_{uuid.uuid4().hex[:8]}", "type": "function",
+         "function": {"name": "search_pdfs", "arguments": json.dumps({"query": part})}}
+        for part in parts
+    ]
+
+
+def _answer_for(messages: List[Dict]) -> str:
+    n_tools = sum(1 for m in messages if m.get("role") == "tool")
+    return f"<think>checking {n_tools} tool results</think>\n\nBased on {n_tools} search result(s), here is the answer [fake#0]."
+
+
+class FakeChatHandler(BaseHTTPRequestHandler):
+    token_delay = 0.0
+    first_token_delay = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        messages = body.get("messages", [])
+        has_tool_results = any(m.get("role") == "tool" for m in messages)
+        question = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+
+        if body.get("tools") and not has_tool_results:
+            message = {"role": "assistant", "content": None, "tool_calls": _tool_calls_for(question)}
+            finish = "tool_calls"
+        else:
+            message = {"role": "assistant", "content": _answer_for(messages)}
+            finish = "stop"
+
+        time.sleep(self.first_token_delay)
+        if body.get("stream"):
+            self._stream(body, message, finish)
+        else:
+            self._send_json({
+                "id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model", "fake"),
+                "choices": [{"index": 0, "message": message, "finish_reason": finish}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+
+    def _send_json(self, payload: Dict):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, body: Dict, message: Dict, finish: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": body.get("model", "fake")}
+
+        def send(delta: Dict, finish_reason=None):
+            chunk = dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}])
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        send({"role": "assistant", "content": ""})
+        if message.get("tool_calls"):
+            for i, tc in enumerate(message["tool_calls"]):
+                send({"tool_calls": [dict(tc, index=i)]})
+        else:
+            # Roughly one "token" per word, keeping the whitespace
+            words = message["content"].split(" ")
+            for i, word in enumerate(words):
+                time.sleep(self.token_delay)
+                send({"content": word if i == len(words) - 1 else word + " "})
+        send({}, finish)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def serve(host: str = "127.0.0.1", port: int = 8011, token_delay: float = 0.0,
+          first_token_delay: float = 0.0, background: bool = False) -> ThreadingHTTPServer:
+    handler = type("Handler", (FakeChatHandler,), {"token_delay": token_delay, "first_token_delay": first_token_delay})
+    server = ThreadingHTTPServer((host, port), handler)
+    if background:
+        threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible chat completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Seconds between streamed tokens.")
+    parser.add_argument("--first-token-delay", type=float, default=0.0, help="Seconds before the first byte of each reply.")
+    args = parser.parse_args()
+    print(f"Serving fake chat completions on http://{args.host}:{args.port}/v1")
+    serve(args.host, args.port, args.token_delay, args.first_token_delay)
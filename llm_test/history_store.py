@@ -0,0 +1,169 @@
+# --- Bounded, optionally persistent chat histories for RunnableWithMessageHistory ---
+
+import os, json, time, sqlite3, logging, threading
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, HumanMessage, ToolMessage, messages_from_dict, messages_to_dict
+
+HISTORY_MAX_TURNS = int(os.getenv("RAG_HISTORY_MAX_TURNS", "12"))       # user turns kept per session
+HISTORY_MAX_CHARS = int(os.getenv("RAG_HISTORY_MAX_CHARS", "24000"))    # total message chars kept per session
+HISTORY_TOOL_TURNS = int(os.getenv("RAG_HISTORY_TOOL_TURNS", "1"))      # turns whose tool outputs stay verbatim
+MAX_SESSIONS = int(os.getenv("RAG_MAX_SESSIONS", "1000"))               # sessions held in memory
+SESSION_IDLE_SECONDS = float(os.getenv("RAG_SESSION_IDLE_SECONDS", "3600"))
+HISTORY_DB_PATH = os.getenv("RAG_HISTORY_DB", "")                       # "" keeps histories in memory only
+
+
+def _content_len(msg: BaseMessage) -> int:
+    return len(msg.content) if isinstance(msg.content, str) else len(json.dumps(msg.content))
+
+
+def _compact_tool_output(content: str) -> str:
+    """Replaces a search tool's JSON output by the source_ids it returned."""
+    try:
+        payload = json.loads(content)
+        sources = []
+        for p in payload.get("passages", []):
+            sources.extend(p.get("source_ids") or [p.get("source_id")])
+        return f"[earlier search results: {', '.join(s for s in sources if s) or 'none'}]"
+    except (ValueError, AttributeError, TypeError):
+        return content[:200] + ("..." if len(content) > 200 else "")
+
+
+class BoundedChatHistory(BaseChatMessageHistory):
+    """
+    A session's messages, trimmed after every write so the replayed prompt
+    stays flat: at most max_turns user turns and max_chars characters are
+    kept (oldest whole turns go first), and tool outputs older than the last
+    tool_turns turns are compacted to the source ids they cited.
+    """
+
+    def __init__(self, max_turns: int = HISTORY_MAX_TURNS, max_chars: int = HISTORY_MAX_CHARS,
+                 tool_turns: int = HISTORY_TOOL_TURNS, messages: Sequence[BaseMessage] = (), on_change=None):
+        self.max_turns = max_turns
+        self.max_chars = max_chars
+        self.tool_turns = tool_turns
+        self.messages: List[BaseMessage] = list(messages)
+        self._on_change = on_change
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.messages.extend(messages)
+        self._trim()
+        if self._on_change is not None:
+            self._on_change(self)
+
+    def clear(self) -> None:
+        self.messages = []
+        if self._on_change is not None:
+            self._on_change(self)
+
+    def _turn_starts(self) -> List[int]:
+        return [i for i, m in enumerate(self.messages) if isinstance(m, HumanMessage)]
+
+    def _trim(self):
+        starts = self._turn_starts()
+        # Compact tool outputs that belong to older turns
+        if len(starts) > self.tool_turns:
+            keep_from = starts[-self.tool_turns] if self.tool_turns else len(self.messages)
+            for i in range(keep_from):
+                m = self.messages[i]
+                if isinstance(m, ToolMessage) and not m.content.startswith("[earlier search results"):
+                    self.messages[i] = ToolMessage(content=_compact_tool_output(m.content), tool_call_id=m.tool_call_id)
+
+        # Drop whole turns from the front until both limits hold (the latest turn is always kept)
+        if self.max_turns and len(starts) > self.max_turns:
+            self.messages = self.messages[starts[-self.max_turns]:]
+            starts = self._turn_starts()
+        total = sum(_content_len(m) for m in self.messages)
+        while self.max_chars and total > self.max_chars and len(starts) > 1:
+            dropped = self.messages[:starts[1]]
+            self.messages = self.messages[starts[1]:]
+            total -= sum(_content_len(m) for m in dropped)
+            starts = self._turn_starts()
+
+
+class HistoryStore:
+    """
+    Session id -> BoundedChatHistory, with LRU eviction: at most max_sessions
+    are held in memory and sessions idle for idle_seconds are dropped. With a
+    db_path, histories are written to SQLite on every change and reloaded
+    when an evicted (or pre-restart) session comes back.
+    """
+
+    def __init__(self, max_sessions: int = MAX_SESSIONS, idle_seconds: float = SESSION_IDLE_SECONDS,
+                 db_path: Optional[str] = HISTORY_DB_PATH or None, **history_limits):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.history_limits = history_limits
+        self.evictions = 0
+        self._sessions: "OrderedDict[str, BoundedChatHistory]" = OrderedDict()
+        self._last_used = {}
+        self._lock = threading.RLock()
+        self._conn = None
+        if db_path:
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_history (session_id TEXT PRIMARY KEY, messages TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    def get(self, session_id: str) -> BoundedChatHistory:
+        with self._lock:
+            history = self._sessions.get(session_id)
+            if history is None:
+                history = BoundedChatHistory(
+                    messages=self._load(session_id),
+                    on_change=lambda h, sid=session_id: self._save(sid, h),
+                    **self.history_limits,
+                )
+                self._sessions[session_id] = history
+            self._sessions.move_to_end(session_id)
+            self._last_used[session_id] = time.monotonic()
+            self._evict()
+            return history
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._sessions:
+            oldest = next(iter(self._sessions))
+            idle = now - self._last_used[oldest] > self.idle_seconds
+            if len(self._sessions) <= self.max_sessions and not idle:
+                break
+            del self._sessions[oldest], self._last_used[oldest]
+            self.evictions += 1
+            logging.debug(f"Evicted chat session {oldest} from memory.")
+
+    def _load(self, session_id: str) -> List[BaseMessage]:
+        if self._conn is None:
+            return []
+        row = self._conn.execute("SELECT messages FROM chat_history WHERE session_id = ?", (session_id,)).fetchone()
+        return messages_from_dict(json.loads(row[0])) if row else []
+
+    def _save(self, session_id: str, history: BoundedChatHistory):
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chat_history (session_id, messages, updated) VALUES (?, ?, ?)",
+                (session_id, json.dumps(messages_to_dict(history.messages), ensure_ascii=False), time.time()),
+            )
+            self._conn.commit()
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._last_used.pop(session_id, None)
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM chat_history WHERE session_id = ?", (session_id,))
+                self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -1,6 +1,15 @@
-import os, json
+import os, json, time, logging, argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
 from dotenv import load_dotenv
-from rag_get_pdf_data import search_pdfs
+from rag_get_pdf_data import (
+    search_pdfs, search_pdfs_many, embed_query, collection_write_stamp, warmup as warmup_retrieval
+)
+from bill_analytics import bill_stats
+from answer_cache import ANSWER_CACHE_ENABLED, SemanticAnswerCache, cited_etags, conversation_context
+from history_store import BoundedChatHistory, HistoryStore
+import metrics  # repo root, put on sys.path by rag_get_pdf_data
 
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import (
@@ -11,13 +20,13 @@ from langchain_core.runnables import RunnableLambda
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.tools import tool
-from langchain_community.chat_message_histories import ChatMessageHistory
 
 load_dotenv()
 
-BASE = os.environ["JETSTREAM_BASE"]
-KEY = os.environ["JETSTREAM_API_KEY"]
-MODEL = os.environ["JETSTREAM_MODEL"]
+BASE = os.getenv("JETSTREAM_BASE")
+KEY = os.getenv("JETSTREAM_API_KEY")
+MODEL = os.getenv("JETSTREAM_MODEL")
+TOOL_WORKERS = int(os.getenv("RAG_TOOL_WORKERS", "4"))
 
 def strip_think(text: str) -> str:
     if "</think>" in text:
@@ -25,14 +34,110 @@ def strip_think(text: str) -> str:
     if "<think>" in text:
         return ""  # only thoughts were produced; next steps will fix via tokens
     return text
-    
 
-llm = ChatOpenAI(
-    base_url=BASE,
-    api_key=KEY,
-    model=MODEL,
-    temperature=0.2,
-)
+
+class ThinkStripper:
+    """
+    Streaming counterpart of strip_think: feed() text chunks as they arrive and
+    get back only what should be shown. Reasoning models may leave out the
+    opening tag (DeepSeek-R1 style output is "reasoning</think>answer"), so
+    everything is held back until the first </think>, then dropped together
+    with the whitespace after it; if the stream ends without one, flush()
+    returns what strip_think would. The joined output therefore always equals
+    strip_think(whole response):
+
+    >>> text = "reasoning here</think>\\n\\nAnswer"
+    >>> s = ThinkStripper()
+    >>> "".join(s.feed(c) for c in text) + s.flush() == strip_think(text) == "Answer"
+    True
+
+    hold=False is for a model known not to write </think>: text then streams
+    as soon as it cannot be the start of a leading <think> block.
+    """
+
+    OPEN, CLOSE = "<think>", "</think>"
+
+    def __init__(self, hold: bool = True):
+        self.hold = hold
+        self._buf = ""
+        self._state = "start"  # start -> after_think -> passthrough
+
+    def feed(self, chunk: str) -> str:
+        self._buf += chunk
+        if self._state == "start":
+            idx = self._buf.find(self.CLOSE)
+            if idx != -1:
+                self._buf = self._buf[idx + len(self.CLOSE):]
+                self._state = "after_think"
+            else:
+                head = self._buf.lstrip()
+                if self.hold or self.OPEN in self._buf or not head or self.OPEN.startswith(head):
+                    return ""  # the </think> may still come
+                self._state = "passthrough"
+        if self._state == "after_think":
+            self._buf = self._buf.lstrip()
+            if not self._buf:
+                return ""
+            self._state = "passthrough"
+        out, self._buf = self._buf, ""
+        return out
+
+    def flush(self) -> str:
+        """Whatever is still held back once the stream ended (empty if it was all thoughts)."""
+        out = self._buf if self._state == "passthrough" or (self._state == "start" and self.OPEN not in self._buf) else ""
+        self._buf = ""
+        return out
+
+
+# Whether the model writes </think>; None until a whole answer was seen. Once
+# one without it has been seen, answers stream without being held back. Only
+# final answers count: a tool-call response usually has no text at all.
+_model_emits_think: Optional[bool] = None
+
+def _note_think(answer: str):
+    global _model_emits_think
+    if not answer.strip():
+        return
+    if "</think>" in answer:
+        _model_emits_think = True
+    elif _model_emits_think is None:
+        _model_emits_think = False
+
+
+# Timings of the most recent turns (seconds), newest last
+turn_timings: deque = deque(maxlen=100)
+
+_TIMING_STAGES = {"total_s": "chat_turn", "ttft_s": "chat_ttft", "first_llm_s": "chat_first_llm", "tools_s": "chat_tools"}
+
+def _record_timings(timings: Dict[str, float]):
+    turn_timings.append(timings)
+    for key, stage in _TIMING_STAGES.items():
+        if key in timings:
+            metrics.STAGE_SECONDS.observe(timings[key], stage=stage)
+    logging.info("turn timings: " + ", ".join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in timings.items()))
+
+
+_tool_llm = None
+
+def get_tool_llm():
+    """Builds the tool-bound chat model on first use, so importing this module needs no credentials."""
+    global _tool_llm
+    if _tool_llm is None:
+        if not (BASE and KEY and MODEL):
+            raise RuntimeError("JETSTREAM_BASE, JETSTREAM_API_KEY and JETSTREAM_MODEL must be set.")
+        llm = ChatOpenAI(
+            base_url=BASE,
+            api_key=KEY,
+            model=MODEL,
+            temperature=0.2,
+        )
+        _tool_llm = llm.bind_tools([search_pdfs, search_pdfs_many, bill_stats])
+    return _tool_llm
+
+def warmup():
+    """Creates the chat client, connects to Milvus and loads the embedder ahead of the first turn."""
+    get_tool_llm()
+    warmup_retrieval()
 
 
 # @tool
@@ -50,37 +155,156 @@ llm = ChatOpenAI(
 #     return demo
 
 # tool_llm = llm.bind_tools([search_pdfs])   # tool_choice="auto" by default
-tool_llm = llm.bind_tools([search_pdfs])
 
 prompt = ChatPromptTemplate.from_messages([
     ("system",
     "Answer from conversation when possible. "
     "If external facts from PDFs are needed, CALL the tool `search_pdfs` with the user's full question. "
-    "After tools return, cite the [source_id]s and return only the final answer. No <think>. "
+    "If the question compares several bills or periods, CALL `search_pdfs_many` once with one sub-query per part. "
+    "When the question names an account number or billing months, pass them as `account` and `month` / `since` / `until` (YYYY-MM) to narrow the search. "
+    "For totals, averages or per-month usage and cost across many bills (e.g. kWh per month for the last year), CALL `bill_stats`. "
+    "After tools return, cite the [source_id]s (and their pages, when shown) and return only the final answer. No <think>. "
     "If context is insufficient, say you don't know."),
     MessagesPlaceholder("history"),
     ("human", "{input}")
 ])
 
 
-TOOL_REGISTRY = {search_pdfs.name: search_pdfs}
+TOOL_REGISTRY = {search_pdfs.name: search_pdfs, search_pdfs_many.name: search_pdfs_many, bill_stats.name: bill_stats}
+
+def _run_tool_call(tc, user_input: str) -> ToolMessage:
+    name = tc.get("name") if isinstance(tc, dict) else tc.name
+    args = tc.get("args", {}) if isinstance(tc, dict) else tc.args
+    call_id = tc["id"] if isinstance(tc, dict) else tc.id
+    # run the tool (returns JSON string with joined_context + passages)
+    tool_obj = TOOL_REGISTRY.get(name)
+    if tool_obj is None:
+        logging.error(f"Model called unknown tool {name}")
+        return ToolMessage(content=f"[ERROR] Unknown tool: {name}", tool_call_id=call_id)
+    if tool_obj is search_pdfs and not args:
+        args = {"query": user_input}  # search_pdfs needs a query; default to the user's question
+    try:
+        result = tool_obj.invoke(args)
+    except Exception as e:
+        logging.error(f"Tool call {name} failed: {e}")
+        result = f"[ERROR] {name} failed: {e}"
+    return ToolMessage(content=result, tool_call_id=call_id)
+
+def _run_tool_calls(tool_calls: list, user_input: str) -> List[ToolMessage]:
+    """Runs independent tool calls concurrently; results keep the order of the calls."""
+    if len(tool_calls) == 1:
+        return [_run_tool_call(tool_calls[0], user_input)]
+    with ThreadPoolExecutor(max_workers=min(TOOL_WORKERS, len(tool_calls))) as pool:
+        return list(pool.map(lambda tc: _run_tool_call(tc, user_input), tool_calls))
+
+# ===== Semantic answer cache (opt-in: RAG_ANSWER_CACHE=1) =====
+# Recurring questions ("when is payment due") are answered from earlier turns
+# whose question embeds within the similarity threshold and whose recent
+# history is the same, skipping both LLM calls. Only document-grounded answers
+# are stored: the model must have searched with the user's own question and
+# the answer's citations must map to ETags. Any write to the collection drops
+# every stored answer.
+answer_cache = SemanticAnswerCache(collection_write_stamp) if ANSWER_CACHE_ENABLED else None
+
+def _cached_answer(question: str, history: list, timings: Dict) -> Optional[str]:
+    if answer_cache is None:
+        return None
+    hit = answer_cache.lookup(embed_query(question), conversation_context(history))
+    timings["answer_cache_hit"] = hit is not None
+    metrics.count_cache("answer", int(hit is not None), int(hit is None))
+    return hit["answer"] if hit else None
+
+def _remember_answer(question: str, history: list, answer: str, tool_calls: list, tool_msgs: List[ToolMessage]):
+    if answer_cache is None or not tool_msgs:
+        return
+    queries = [((tc.get("args") if isinstance(tc, dict) else tc.args) or {}).get("query", "") for tc in tool_calls]
+    if not any(q.strip().lower() == question.strip().lower() for q in queries):
+        return
+    answer_cache.put(embed_query(question), question, answer, cited_etags(answer, [m.content for m in tool_msgs]),
+                     conversation_context(history))
 
 def run_one_turn(inputs: dict) -> str:
+    t0 = time.perf_counter()
+    timings = {"streamed": False}
+    cached = _cached_answer(inputs["input"], inputs.get("history", []), timings)
+    if cached is not None:
+        timings["ttft_s"] = timings["total_s"] = time.perf_counter() - t0
+        _record_timings(timings)
+        return cached
+
     msgs = prompt.format_messages(input=inputs["input"], history=inputs.get("history", []))
+    tool_llm = get_tool_llm()
     ai: AIMessage = tool_llm.invoke(msgs)
+    timings["first_llm_s"] = time.perf_counter() - t0
 
     if getattr(ai, "tool_calls", None):
-        tool_msgs = []
-        for tc in ai.tool_calls:
-            args = tc.get("args", {}) if isinstance(tc, dict) else tc.args
-            # run the tool (returns JSON string with joined_context + passages)
-            result = search_pdfs.invoke(args or {"query": inputs["input"]})
-            tool_msgs.append(ToolMessage(content=result, tool_call_id=tc["id"] if isinstance(tc, dict) else tc.id))
+        t_tools = time.perf_counter()
+        tool_msgs = _run_tool_calls(ai.tool_calls, inputs["input"])
+        timings["tools_s"] = time.perf_counter() - t_tools
+        timings["tool_calls"] = len(tool_msgs)
         # include the assistant tool-call message AND tool outputs
+        tool_calls = ai.tool_calls
         msgs = msgs + [ai] + tool_msgs
         ai = tool_llm.invoke(msgs)
+        _remember_answer(inputs["input"], inputs.get("history", []), strip_think(ai.content), tool_calls, tool_msgs)
+
+    text = strip_think(ai.content)
+    timings["ttft_s"] = timings["total_s"] = time.perf_counter() - t0
+    _record_timings(timings)
+    return text
+
+def run_one_turn_stream(inputs: dict) -> Iterator[str]:
+    """Same turn as run_one_turn, but yields the answer text as tokens arrive."""
+    t0 = time.perf_counter()
+    timings = {"streamed": True}
+    cached = _cached_answer(inputs["input"], inputs.get("history", []), timings)
+    if cached is not None:
+        timings["ttft_s"] = timings["total_s"] = time.perf_counter() - t0
+        _record_timings(timings)
+        yield cached
+        return
+
+    msgs = prompt.format_messages(input=inputs["input"], history=inputs.get("history", []))
+    tool_llm = get_tool_llm()
 
-    return strip_think(ai.content)
+    def _emit(text: str):
+        if text and "ttft_s" not in timings:
+            timings["ttft_s"] = time.perf_counter() - t0
+        return text
+
+    # First call: not streamed, since whatever the model writes before a tool
+    # call is not the answer; only a direct answer (no tools) is shown
+    ai: AIMessage = tool_llm.invoke(msgs)
+    timings["first_llm_s"] = time.perf_counter() - t0
+
+    if getattr(ai, "tool_calls", None):
+        t_tools = time.perf_counter()
+        tool_msgs = _run_tool_calls(ai.tool_calls, inputs["input"])
+        timings["tools_s"] = time.perf_counter() - t_tools
+        timings["tool_calls"] = len(tool_msgs)
+        msgs = msgs + [ai] + tool_msgs
+        stripper = ThinkStripper(hold=_model_emits_think is not False)
+        answer, raw = [], []
+        for chunk in tool_llm.stream(msgs):
+            raw.append(chunk.content or "")
+            out = _emit(stripper.feed(chunk.content or ""))
+            if out:
+                answer.append(out)
+                yield out
+        out = _emit(stripper.flush())
+        if out:
+            answer.append(out)
+            yield out
+        _note_think("".join(raw))
+        _remember_answer(inputs["input"], inputs.get("history", []), "".join(answer), ai.tool_calls, tool_msgs)
+    else:
+        _note_think(ai.content or "")
+        out = _emit(strip_think(ai.content or ""))
+        if out:
+            yield out
+    timings["total_s"] = time.perf_counter() - t0
+    timings.setdefault("ttft_s", timings["total_s"])
+    _record_timings(timings)
 
 # def run_one_turn(inputs: dict) -> str:
 #     # inputs carries {"input": user_text, "history": [...past BaseMessage objects...] }
@@ -115,11 +339,13 @@ def run_one_turn(inputs: dict) -> str:
 #     return strip_think(text)
 
 
-store: dict[str, ChatMessageHistory] = {}
-def get_history(session_id: str) -> ChatMessageHistory:
-    return store.setdefault(session_id, ChatMessageHistory())
+# Bounded per session and LRU-evicted across sessions; set RAG_HISTORY_DB to persist
+store = HistoryStore()
+def get_history(session_id: str) -> BoundedChatHistory:
+    return store.get(session_id)
 
 controller = RunnableLambda(run_one_turn)
+stream_controller = RunnableLambda(run_one_turn_stream)
 
 chat = RunnableWithMessageHistory(
     controller,
@@ -128,8 +354,23 @@ chat = RunnableWithMessageHistory(
     history_messages_key="history",   # must match MessagesPlaceholder("history")
 )
 
+# Use chat_stream.stream(...); the streamed chunks are joined into the history entry
+chat_stream = RunnableWithMessageHistory(
+    stream_controller,
+    get_session_history=get_history,
+    input_messages_key="input",
+    history_messages_key="history",
+)
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat with the PDF collection.")
+    parser.add_argument("--stream", action="store_true", help="Print the answer as it is generated.")
+    parser.add_argument("--timings", action="store_true", help="Print per-turn timings after each answer.")
+    args = parser.parse_args()
+
     session_id = "cli"
+    metrics.start_server()  # METRICS_PORT=9100 exposes /metrics while chatting
+    warmup()
     print("CLI ready. Ctrl+C or Ctrl+D to exit.")
     while True:
         try:
@@ -139,8 +380,12 @@ if __name__ == "__main__":
             break
         if not user:
             continue
-        result = chat.invoke(
-            {"input": user},
-            config={"configurable": {"session_id": session_id}}
-        )
-        print(result)
+        config = {"configurable": {"session_id": session_id}}
+        if args.stream:
+            for piece in chat_stream.stream({"input": user}, config=config):
+                print(piece, end="", flush=True)
+            print()
+        else:
+            print(chat.invoke({"input": user}, config=config))
+        if args.timings and turn_timings:
+            print(json.dumps(turn_timings[-1]))
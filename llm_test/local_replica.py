@@ -0,0 +1,371 @@
+# --- In-process replica of the collection for sub-millisecond search ---
+
+import os, json, time, logging, threading
+from collections import Counter
+from typing import Any, Dict, List, Tuple, Union
+
+import numpy as np
+
+REPLICA_DTYPES = ("float32", "float16")
+SYNC_BATCH_ETAGS = 100   # ETags per Milvus query when pulling rows
+SCORE_BLOCK_ROWS = 65536 # rows upcast to float32 at a time when scoring a float16 matrix
+COMPACT_FRACTION = 0.25  # rewrite the files once this share of the rows is deleted
+
+
+class LocalReplica:
+    """
+    A copy of the collection's vectors and passage fields on local disk,
+    searched in process instead of over the network.
+
+    Vectors are L2-normalised when they are pulled, so a dot product is the
+    collection's COSINE score and exact results rank like a Milvus FLAT
+    search. Files under `root`:
+      - vectors.<dtype>: the (rows, dim) matrix, memory-mapped read-only,
+      - rows.jsonl: the passage fields of each row (the metadata array),
+      - deleted.npy: one flag per row, set when its ETag left the collection
+        or its rows were pulled again,
+      - state.json: row count, live rows per ETag, the stored fields and the
+        write stamp of the last sync. It is replaced last, so whatever an
+        interrupted sync appended is cut off again on the next open.
+    With index="hnsw" (and hnswlib installed) an HNSW graph over the same
+    rows answers the queries instead of the exact scan. Filtered searches
+    (`where`, see milvus_index.metadata_filter) always scan the matching
+    rows exactly.
+
+    sync() is incremental: it reads only the ETag column of the collection,
+    pulls the rows of ETags that are new or whose row count changed (e.g. a
+    document whose rows were still being flushed), and flags the rows of
+    ETags that are gone (e.g. superseded by an upsert).
+    """
+
+    def __init__(
+        self,
+        root: str,
+        dim: int,
+        dtype: str = "float32",
+        index: str = "exact",
+        output_fields: List[str] = None,
+        vector_field: str = "vector",
+    ):
+        if dtype not in REPLICA_DTYPES:
+            raise ValueError(f"Replica dtype must be one of {REPLICA_DTYPES}, got {dtype}.")
+        self.root = root
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.index = index
+        self.output_fields = output_fields or ["text", "filename", "chunk_id", "ETag", "char_start", "char_end", "page", "page_end"]
+        self.vector_field = vector_field
+        self._vectors_path = os.path.join(root, f"vectors.{dtype}")
+        self._rows_path = os.path.join(root, "rows.jsonl")
+        self._deleted_path = os.path.join(root, "deleted.npy")
+        self._state_path = os.path.join(root, "state.json")
+        self._columns: Tuple[list, Dict[str, np.ndarray]] = ([], {})  # filter columns of self._rows
+        self._lock = threading.Lock()       # swaps of the searchable arrays
+        self._sync_lock = threading.Lock()  # one sync at a time
+        os.makedirs(root, exist_ok=True)
+
+        self.state = self._read_state()
+        self._rows = self._read_rows()
+        self._cut_unrecorded_rows()
+        self._matrix = self._map_matrix()
+        self._deleted = self._read_deleted()
+        self._hnsw = self._open_hnsw() if index == "hnsw" else None
+
+    # --- Persistence ---
+    def _empty_state(self) -> Dict[str, Any]:
+        return {
+            "dim": self.dim, "dtype": self.dtype.name, "fields": self.output_fields,
+            "rows": 0, "etags": {}, "write_stamp": None, "synced_at": 0.0,
+        }
+
+    def _read_state(self) -> Dict[str, Any]:
+        if not os.path.exists(self._state_path):
+            return self._empty_state()
+        with open(self._state_path) as f:
+            state = json.load(f)
+        if (state["dim"], state["dtype"], state.get("fields")) != (self.dim, self.dtype.name, self.output_fields):
+            logging.warning(f"Replica in {self.root} holds other vectors ({state['dim']}-d {state['dtype']}) or fields; rebuilding it.")
+            for path in (self._vectors_path, self._rows_path, self._deleted_path, self._state_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            return self._empty_state()
+        return state
+
+    def _write_state(self):
+        np.save(self._deleted_path, self._deleted)
+        with open(self._state_path + ".tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(self._state_path + ".tmp", self._state_path)
+
+    def _read_rows(self) -> List[Dict[str, Any]]:
+        rows: List[Dict[str, Any]] = []
+        if os.path.exists(self._rows_path):
+            with open(self._rows_path) as f:
+                for line in f:
+                    if len(rows) == self.state["rows"]:
+                        break
+                    rows.append(json.loads(line))
+        if len(rows) < self.state["rows"]:
+            raise ValueError(f"Replica in {self.root} is missing rows; delete the directory to rebuild it.")
+        return rows
+
+    def _cut_unrecorded_rows(self):
+        size = self.state["rows"] * self.dim * self.dtype.itemsize
+        if os.path.exists(self._vectors_path) and os.path.getsize(self._vectors_path) > size:
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(size)
+        if os.path.exists(self._rows_path) and self.state["rows"] < sum(1 for _ in open(self._rows_path)):
+            self._write_rows(self._rows)
+
+    def _write_rows(self, rows: List[Dict[str, Any]]):
+        with open(self._rows_path + ".tmp", "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+        os.replace(self._rows_path + ".tmp", self._rows_path)
+
+    def _map_matrix(self) -> np.ndarray:
+        if self.state["rows"] == 0:
+            return np.empty((0, self.dim), dtype=self.dtype)
+        return np.memmap(self._vectors_path, dtype=self.dtype, mode="r", shape=(self.state["rows"], self.dim))
+
+    def _read_deleted(self) -> np.ndarray:
+        deleted = np.load(self._deleted_path) if os.path.exists(self._deleted_path) else np.zeros(0, dtype=bool)
+        out = np.zeros(self.state["rows"], dtype=bool)
+        n = min(len(deleted), len(out))
+        out[:n] = deleted[:n]
+        return out
+
+    # --- HNSW ---
+    def _open_hnsw(self):
+        try:
+            import hnswlib
+        except ImportError:
+            logging.warning("hnswlib is not installed; the local replica falls back to exact search.")
+            return None
+        index = hnswlib.Index(space="ip", dim=self.dim)
+        path = os.path.join(self.root, "hnsw.bin")
+        if os.path.exists(path) and self.state.get("hnsw_rows") == self.state["rows"]:
+            index.load_index(path, max_elements=max(1024, self.state["rows"]))
+        else:
+            index.init_index(max_elements=max(1024, self.state["rows"]), ef_construction=200, M=16)
+            self._add_to_hnsw(index, 0)
+            for i in np.flatnonzero(self._deleted):
+                index.mark_deleted(int(i))  # a saved graph keeps its own marks
+        return index
+
+    def _add_to_hnsw(self, index, first: int):
+        n = self.state["rows"]
+        if n > index.get_max_elements():
+            index.resize_index(2 * n)
+        for start in range(first, n, SCORE_BLOCK_ROWS):
+            stop = min(n, start + SCORE_BLOCK_ROWS)
+            index.add_items(np.asarray(self._matrix[start:stop], dtype=np.float32), np.arange(start, stop))
+
+    # --- Sync ---
+    def is_fresh(self, write_stamp: int, max_age: float) -> bool:
+        """
+        True when the last sync saw `write_stamp`, i.e. the collection has not
+        been written since. Hosts that cannot see the stamp (it is always 0)
+        trust a sync for max_age seconds instead.
+        """
+        if self.state["write_stamp"] is None or write_stamp != self.state["write_stamp"]:
+            return False
+        return bool(write_stamp) or time.time() - self.state["synced_at"] < max_age
+
+    def sync(self, client, collection_name: str, write_stamp: int = 0) -> Dict[str, int]:
+        """
+        Brings the replica up to date with the collection; returns what changed.
+        Reads are Strong, so every write that moved `write_stamp` (read
+        before calling) is visible and recording the stamp as synced is safe.
+        """
+        with self._sync_lock:
+            t0 = time.perf_counter()
+            remote = self._remote_etag_counts(client, collection_name)
+            local = self.state["etags"]
+            changed = [etag for etag, n in remote.items() if local.get(etag) != n]
+            gone = [etag for etag in local if etag not in remote]
+            rows, vectors = self._fetch(client, collection_name, changed)
+
+            with self._lock:
+                replaced = set(changed) | set(gone)
+                before = self._deleted
+                deleted = before.copy()
+                for i, row in enumerate(self._rows):
+                    if row.get("ETag") in replaced:
+                        deleted[i] = True
+                first = len(self._rows)
+                self._append(rows, vectors)
+                self._deleted = np.concatenate([deleted, np.zeros(len(rows), dtype=bool)])
+                for etag in gone:
+                    del local[etag]
+                # What was actually fetched, so rows that landed in between are pulled next time
+                fetched = Counter(str(row.get("ETag")) for row in rows)
+                for etag in changed:
+                    if fetched[etag]:
+                        local[etag] = fetched[etag]
+                    else:
+                        local.pop(etag, None)
+
+                if self._deleted.sum() > COMPACT_FRACTION * max(1, len(self._rows)):
+                    self._compact()
+                elif self._hnsw is not None:
+                    self._add_to_hnsw(self._hnsw, first)
+                    for i in np.flatnonzero(deleted[:first] & ~before):
+                        self._hnsw.mark_deleted(int(i))
+                if self._hnsw is not None:
+                    self._hnsw.save_index(os.path.join(self.root, "hnsw.bin"))
+                    self.state["hnsw_rows"] = self.state["rows"]
+                self.state.update({"write_stamp": write_stamp, "synced_at": time.time()})
+                self._write_state()
+
+            report = {"added_rows": len(rows), "changed_etags": len(changed), "removed_etags": len(gone), "live_rows": self.live_rows()}
+            logging.info(f"Local replica synced in {time.perf_counter() - t0:.2f}s: {report}")
+            return report
+
+    def _remote_etag_counts(self, client, collection_name: str) -> Dict[str, int]:
+        counts: Counter = Counter()
+        iterator = client.query_iterator(
+            collection_name=collection_name, batch_size=4096, filter="", output_fields=["ETag"], consistency_level="Strong",
+        )
+        try:
+            while True:
+                batch = iterator.next()
+                if not batch:
+                    break
+                counts.update(str(r["ETag"]) for r in batch if r.get("ETag") is not None)
+        finally:
+            iterator.close()
+        return dict(counts)
+
+    def _fetch(self, client, collection_name: str, etags: List[str]):
+        rows: List[Dict[str, Any]] = []
+        vectors: List[List[float]] = []
+        for i in range(0, len(etags), SYNC_BATCH_ETAGS):
+            iterator = client.query_iterator(
+                collection_name=collection_name, batch_size=1024,
+                filter="ETag in [" + ",".join(json.dumps(e) for e in etags[i:i + SYNC_BATCH_ETAGS]) + "]",
+                output_fields=self.output_fields + [self.vector_field],
+                consistency_level="Strong",
+            )
+            try:
+                while True:
+                    page = iterator.next()
+                    if not page:
+                        break
+                    for r in page:
+                        vectors.append(r[self.vector_field])
+                        rows.append({field: r.get(field) for field in self.output_fields})
+            finally:
+                iterator.close()
+        return rows, vectors
+
+    def _append(self, rows: List[Dict[str, Any]], vectors: List[List[float]]):
+        if not rows:
+            return
+        matrix = np.asarray(vectors, dtype=np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        with open(self._vectors_path, "ab") as f:
+            f.write(matrix.astype(self.dtype).tobytes())
+        with open(self._rows_path, "a") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+        self._rows = self._rows + rows
+        self.state["rows"] = len(self._rows)
+        self._matrix = self._map_matrix()
+
+    def _compact(self):
+        """Rewrites the files without the deleted rows (and rebuilds the HNSW graph)."""
+        keep = np.flatnonzero(~self._deleted)
+        matrix = np.array(self._matrix[keep]) if len(keep) else np.empty((0, self.dim), dtype=self.dtype)
+        with open(self._vectors_path + ".tmp", "wb") as f:
+            f.write(matrix.tobytes())
+        os.replace(self._vectors_path + ".tmp", self._vectors_path)
+        self._rows = [self._rows[i] for i in keep]
+        self._write_rows(self._rows)
+        self._deleted = np.zeros(len(self._rows), dtype=bool)
+        self.state["rows"] = len(self._rows)
+        self._matrix = self._map_matrix()
+        if self._hnsw is not None:
+            self.state.pop("hnsw_rows", None)
+            self._hnsw = self._open_hnsw()
+        logging.info(f"Local replica compacted to {len(self._rows)} rows.")
+
+    # --- Search ---
+    def live_rows(self) -> int:
+        return int(len(self._rows) - self._deleted.sum())
+
+    def _column(self, rows: List[Dict[str, Any]], field: str) -> np.ndarray:
+        """One field of every row as an array, kept until the rows change."""
+        owner, columns = self._columns
+        if owner is not rows:
+            owner, columns = rows, {}
+            self._columns = (owner, columns)
+        if field not in columns:
+            columns[field] = np.array([row.get(field) if row.get(field) is not None else "" for row in rows], dtype=object)
+        return columns[field]
+
+    def _matching(self, rows: List[Dict[str, Any]], where: Dict[str, Union[List[Any], Tuple[Any, Any]]]) -> np.ndarray:
+        mask = np.ones(len(rows), dtype=bool)
+        for field, condition in where.items():
+            values = self._column(rows, field)
+            if isinstance(condition, tuple):
+                low, high = condition
+                if low:
+                    mask &= values >= low
+                if high:
+                    mask &= values <= high
+            else:
+                mask &= np.isin(values, list(condition))
+        return mask
+
+    def search(self, queries: List[List[float]], top_k: int, where: Dict[str, Any] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Top-k rows per query as Milvus-style hits ({"distance", "entity"}),
+        highest cosine first, among the rows matching `where` when given.
+        """
+        with self._lock:
+            matrix, rows, deleted, hnsw = self._matrix, self._rows, self._deleted, self._hnsw
+        q = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        q /= np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+        if where:
+            candidates = np.flatnonzero(self._matching(rows, where) & ~deleted)
+            k = min(top_k, len(candidates))
+        else:
+            k = min(top_k, int(len(rows) - deleted.sum()))
+        if k <= 0:
+            return [[] for _ in range(len(q))]
+
+        if where:
+            scores = self._scores(matrix[candidates], q)
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            found = []
+            for i in range(len(q)):
+                order = top[i][np.argsort(-scores[i, top[i]])]
+                found.append((candidates[order], scores[i, order]))
+        elif hnsw is not None:
+            hnsw.set_ef(max(64, 2 * k))
+            labels, distances = hnsw.knn_query(q, k=k)
+            found = [(labels[i], 1.0 - distances[i]) for i in range(len(q))]  # hnswlib "ip" distance is 1 - dot
+        else:
+            scores = self._scores(matrix, q)
+            scores[:, deleted] = -np.inf
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            found = []
+            for i in range(len(q)):
+                order = top[i][np.argsort(-scores[i, top[i]])]
+                found.append((order, scores[i, order]))
+        return [
+            [{"distance": float(score), "entity": rows[int(row)]} for row, score in zip(labels_i, scores_i)]
+            for labels_i, scores_i in found
+        ]
+
+    @staticmethod
+    def _scores(matrix: np.ndarray, q: np.ndarray) -> np.ndarray:
+        if matrix.dtype == np.float32:
+            return q @ np.asarray(matrix).T
+        # float16 has no BLAS path: score in float32 blocks to keep the upcast copy small
+        out = np.empty((len(q), len(matrix)), dtype=np.float32)
+        for start in range(0, len(matrix), SCORE_BLOCK_ROWS):
+            block = np.asarray(matrix[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+            out[:, start:start + len(block)] = q @ block.T
+        return out
@@ -0,0 +1,76 @@
+# --- Small in-process caches for the retrieval tool ---
+
+import time, threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """Thread-safe LRU map that also tracks hit rate and the time hits saved."""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        self._miss_seconds = 0.0  # total cost of the values stored by put()
+        self._puts = 0
+
+    def _live(self, entry) -> bool:
+        return True
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self._live(entry):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def _entry(self, value: Any) -> tuple:
+        return (value,)
+
+    def put(self, key: Hashable, value: Any, cost_seconds: float = 0.0):
+        """Stores value; cost_seconds is how long computing it took (used for the latency-saved estimate)."""
+        with self._lock:
+            self._miss_seconds += cost_seconds
+            self._puts += 1
+            self._data[key] = self._entry(value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            avg_miss = self._miss_seconds / self._puts if self._puts else 0.0
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "avg_miss_ms": avg_miss * 1000,
+                "saved_ms": self.hits * avg_miss * 1000,
+            }
+
+
+class TTLCache(LRUCache):
+    """LRUCache whose entries also expire ttl seconds after they were stored."""
+
+    def __init__(self, maxsize: int = 256, ttl: float = 300.0):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def _entry(self, value: Any) -> tuple:
+        return (value, time.monotonic() + self.ttl)
+
+    def _live(self, entry) -> bool:
+        return entry[1] > time.monotonic()
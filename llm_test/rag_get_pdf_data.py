@@ -1,11 +1,17 @@
 # --- Milvus-backed retrieval tool (matches your insert schema) ---
 
-import os, json
+import os, sys, json, time, logging, threading
 from dotenv import load_dotenv
 from typing import Dict, Any, List
-from pymilvus import MilvusClient
 from langchain_core.tools import tool
-from sentence_transformers import SentenceTransformer
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import models
+import milvus_index
+import metrics
+from milvus_pool import get_client, milvus_uri, read_write_stamp
+from rag_cache import LRUCache, TTLCache
+from local_replica import LocalReplica
 
 load_dotenv()
 
@@ -16,51 +22,369 @@ COLLECTION_NAME = os.getenv("COLLECTION_NAME")
 TEXT_FIELD = os.getenv("MILVUS_TEXT_FIELD", "text")
 VECTOR_FIELD = os.getenv("MILVUS_VECTOR_FIELD", "vector")
 TOP_K = int(os.getenv("RAG_TOP_K", "10"))
-MAX_CHARS = int(os.getenv("RAG_PASSAGE_CHARS", "2000"))
+MAX_CHARS = int(os.getenv("RAG_PASSAGE_CHARS", "0"))  # optional hard cap per packed passage; 0 = none
+CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "3000"))  # token budget for joined_context; 0 = unlimited
+CONTEXT_TOKENIZER_NAME = os.getenv("RAG_CONTEXT_TOKENIZER", EMBEDDING_MODEL_NAME)
+MIN_TRUNCATED_TOKENS = 64  # a passage cut shorter than this is dropped instead
 SCORE_THRESHOLD = float(os.getenv("RAG_SCORE_THRESHOLD", "0.0"))
 SEARCH_QUERY_PREFIX = os.getenv("SEARCH_QUERY_PREFIX", "")
+OUTPUT_FIELDS = [TEXT_FIELD, "filename", "chunk_id", "ETag", "account", "billing_month", "char_start", "char_end", "page", "page_end"]
+EMBEDDING_DIM = models.EMBEDDING_DIM  # must match the dimension the collection was ingested with
+QUERY_CACHE_SIZE = int(os.getenv("RAG_QUERY_CACHE_SIZE", "1024"))
+SEARCH_CACHE_SIZE = int(os.getenv("RAG_SEARCH_CACHE_SIZE", "256"))
+SEARCH_CACHE_TTL = float(os.getenv("RAG_SEARCH_CACHE_TTL", "300"))
+REPLICA_DIR = os.getenv("RAG_REPLICA_DIR", "")  # local search replica; "" = always search Milvus
+REPLICA_DTYPE = os.getenv("RAG_REPLICA_DTYPE", "float32")  # or float16 (half the memory)
+REPLICA_INDEX = os.getenv("RAG_REPLICA_INDEX", "exact")  # or hnsw (needs hnswlib)
+REPLICA_MAX_AGE = float(os.getenv("RAG_REPLICA_MAX_AGE", "300"))  # trust a sync this long when no write stamp is visible
+
+# ===== Lazy, one-time Milvus connection & collection check (NO INSERT) =====
+# The client and model are process-wide singletons (the model is shared with
+# ingestion when both run in one process) created on first use or by warmup().
+_collection_checked = False
+_index_type = milvus_index.INDEX_TYPE
+
+def _get_client():
+    global _collection_checked, _index_type
+    client = get_client(milvus_uri(MILVUS_HOST, MILVUS_PORT))
+    if not _collection_checked:
+        # raise early if collection missing/misnamed
+        client.describe_collection(COLLECTION_NAME)
+        # search knobs (ef / nprobe) follow the index the collection was actually built with
+        _index_type = milvus_index.detect_index_type(client, COLLECTION_NAME, VECTOR_FIELD)
+        _collection_checked = True
+    return client
+
+def _get_model():
+    # Queries are embedded a few at a time, which a worker pool would only slow down
+    return models.get_embedding_model(EMBEDDING_MODEL_NAME, workers=0)
+
+def warmup():
+    """Connects to Milvus, loads the query embedder and syncs the local replica before the first search."""
+    _get_client()
+    if _get_replica() is not None:
+        sync_replica()
+    models.warmup(EMBEDDING_MODEL_NAME, tokenizer=False, workers=0)
+    if CONTEXT_TOKENS:
+        models.get_tokenizer(CONTEXT_TOKENIZER_NAME)
+
+# ===== Query-embedding & search-result caches =====
+# Query vectors depend only on the query text, so they are kept for the life of
+# the process. Formatted results also depend on k and the score threshold and
+# expire after SEARCH_CACHE_TTL seconds; they are dropped as soon as ingestion
+# touches the collection's write stamp (see milvus_pool.touch_write_stamp).
+_query_cache = LRUCache(QUERY_CACHE_SIZE)
+_search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+_seen_write_stamp = None
+
+def _invalidate_if_ingested():
+    global _seen_write_stamp
+    stamp = read_write_stamp(COLLECTION_NAME)
+    if stamp != _seen_write_stamp:
+        if _seen_write_stamp is not None:
+            _search_cache.clear()
+        _seen_write_stamp = stamp
+
+def invalidate_search_cache():
+    """Drops every cached search result, e.g. after writing to the collection in-process."""
+    _search_cache.clear()
 
-# ===== One-time Milvus connection & collection check (NO INSERT) =====
-_client = MilvusClient(uri=f"http://{MILVUS_HOST}:{MILVUS_PORT}")
-# raise early if collection missing/misnamed
-_client.describe_collection(COLLECTION_NAME)
-_model = SentenceTransformer(EMBEDDING_MODEL_NAME, trust_remote_code=True)
+def cache_stats() -> Dict[str, Dict[str, float]]:
+    """Hit rates and estimated milliseconds saved by the query and search caches."""
+    return {"query_embeddings": _query_cache.stats(), "search_results": _search_cache.stats()}
+
+# ===== Optional local replica =====
+# With RAG_REPLICA_DIR set, searches run against an in-process copy of the
+# collection (see local_replica.py). Whenever the collection's write stamp has
+# moved since the last sync, the query goes to Milvus and one background
+# thread pulls the new ETags, so results are never staler than Milvus itself.
+_replica = None
+_replica_lock = threading.Lock()
+_replica_sync = threading.Lock()
+
+def _get_replica():
+    global _replica
+    if not REPLICA_DIR:
+        return None
+    if _replica is None:
+        with _replica_lock:
+            if _replica is None:
+                _replica = LocalReplica(
+                    REPLICA_DIR, EMBEDDING_DIM, dtype=REPLICA_DTYPE, index=REPLICA_INDEX, vector_field=VECTOR_FIELD,
+                    output_fields=OUTPUT_FIELDS,
+                )
+    return _replica
+
+def sync_replica() -> Dict[str, int]:
+    """Brings the local replica up to date now (blocking)."""
+    with _replica_sync:
+        return _get_replica().sync(_get_client(), COLLECTION_NAME, read_write_stamp(COLLECTION_NAME))
+
+def _sync_replica_in_background():
+    if not _replica_sync.acquire(blocking=False):
+        return  # a sync is already running
+    def _run():
+        try:
+            _get_replica().sync(_get_client(), COLLECTION_NAME, read_write_stamp(COLLECTION_NAME))
+        except Exception as e:
+            logging.warning(f"Local replica sync failed, searching Milvus meanwhile: {e}")
+        finally:
+            _replica_sync.release()
+    threading.Thread(target=_run, name="replica-sync", daemon=True).start()
+
+def _replica_search(qvs: List[List[float]], top_k: int, where: Dict[str, Any] = None):
+    """Hits from the local replica, or None when it is off or stale (a sync is then started)."""
+    replica = _get_replica()
+    if replica is None:
+        return None
+    if replica.is_fresh(read_write_stamp(COLLECTION_NAME), REPLICA_MAX_AGE):
+        metrics.count_cache("replica", 1, 0)
+        return replica.search(qvs, top_k, where=where)
+    metrics.count_cache("replica", 0, 1)
+    _sync_replica_in_background()
+    return None
+
+def _embed_queries(queries: List[str]) -> List[List[float]]:
+    """Embeds queries, encoding every uncached one in a single batch."""
+    vecs = [_query_cache.get(q) for q in queries]
+    missing = list(dict.fromkeys(q for q, v in zip(queries, vecs) if v is None))
+    metrics.count_cache("query_embedding", len(queries) - len(missing), len(missing))
+    if missing:
+        t0 = time.perf_counter()
+        encoded = _get_model().encode([f"{SEARCH_QUERY_PREFIX}{q}".strip() for q in missing])
+        encoded = models.reduce_dimension(encoded, EMBEDDING_DIM).tolist()  # same transform as at ingest
+        cost = (time.perf_counter() - t0) / len(missing)
+        fresh = dict(zip(missing, encoded))
+        for q, v in fresh.items():
+            _query_cache.put(q, v, cost)
+        vecs = [v if v is not None else fresh[q] for q, v in zip(queries, vecs)]
+    return vecs
 
 def _embed_query(q: str) -> List[float]:
-    return _model.encode(f"{SEARCH_QUERY_PREFIX}{q}".strip()).tolist()
+    return _embed_queries([q])[0]
+
+def embed_query(q: str) -> List[float]:
+    """Query embedding as used for search (shared with the answer cache)."""
+    return _embed_query(q)
 
-def _format_hits(hits: list) -> Dict[str, Any]:
-    passages, lines = [], []
-    for i, h in enumerate(hits, 1):
+def collection_write_stamp() -> int:
+    return read_write_stamp(COLLECTION_NAME)
+
+def _hits_to_passages(hits: list) -> List[Dict[str, Any]]:
+    """Raw per-chunk passages (full text and character span) from one query's hits."""
+    passages = []
+    for h in hits:
         ent = h.get("entity", {})
-        txt = (ent.get(TEXT_FIELD, "") or "")[:MAX_CHARS].strip()
         fn, cid, etag = ent.get("filename", ""), ent.get("chunk_id"), ent.get("ETag", "")
-        score = float(h.get("distance", 0.0))
         source_id = f"{fn}#{cid}" if fn and cid is not None else (etag or str(ent.get("id","")))
-        passages.append({"n": i, "source_id": source_id, "filename": fn, "chunk_id": cid, "etag": etag, "score": score, "text": txt})
-        lines.append(f"[{i}] {source_id}\n{txt}")
-    return {"passages": passages, "joined_context": "\n\n".join(lines)}
-
-def _search(query: str, top_k: int = TOP_K) -> Dict[str, Any]:
-    qv = _embed_query(query)
-    res = _client.search(
-        collection_name=COLLECTION_NAME,
-        data=[qv],
-        anns_field=VECTOR_FIELD,
-        limit=top_k,
-        output_fields=[TEXT_FIELD, "filename", "chunk_id", "ETag"],
-        search_params={"metric_type": "COSINE", "params": {}},
-    )
-    hits = res[0] if res else []
-    if SCORE_THRESHOLD > 0 and hits:
-        if float(hits[0].get("distance", 0.0)) < SCORE_THRESHOLD:
-            return {"passages": [], "joined_context": ""}
-    return _format_hits(hits)
+        passages.append({
+            "source_id": source_id, "filename": fn, "chunk_id": cid, "etag": etag,
+            "score": float(h.get("distance", 0.0)), "text": ent.get(TEXT_FIELD, "") or "",
+            "char_start": ent.get("char_start"), "char_end": ent.get("char_end"), "page": ent.get("page"),
+            "page_end": ent.get("page_end") or ent.get("page"), "billing_month": ent.get("billing_month") or None,
+        })
+    return passages
+
+# ===== Context packing =====
+# Neighbouring chunks of a document overlap (CHUNK_OVERLAP tokens at ingest),
+# so hits with consecutive chunk_ids from the same ETag are merged into one
+# passage with the overlap removed, and passages are then added best-first
+# until the context reaches CONTEXT_TOKENS (counted with a real tokenizer).
+def _suffix_prefix_overlap(a: str, b: str) -> int:
+    """Length of the longest suffix of `a` that is also a prefix of `b`."""
+    probe = b[:32]  # real overlaps are CHUNK_OVERLAP tokens long, far more than this
+    if not probe:
+        return 0
+    best = 0
+    idx = a.rfind(probe)
+    while idx != -1:
+        if len(a) - idx <= len(b) and b.startswith(a[idx:]):
+            best = len(a) - idx
+        idx = a.rfind(probe, 0, idx + len(probe) - 1)
+    return best
+
+def _join_chunks(text: str, end, nxt: Dict[str, Any]) -> str:
+    start = nxt.get("char_start")
+    if end is not None and start is not None:
+        # Chunks are exact slices of the document text, so the spans give the overlap directly
+        cut = end - start
+        if 0 < cut <= len(nxt["text"]):
+            return text + nxt["text"][cut:]
+        if cut <= 0:
+            return text + "\n" + nxt["text"]
+    return text + nxt["text"][_suffix_prefix_overlap(text, nxt["text"]):]
+
+def _merge_adjacent(passages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    by_doc: Dict[str, List[Dict[str, Any]]] = {}
+    blocks = []
+    for p in passages:
+        if p["chunk_id"] is None:
+            blocks.append([p])
+        else:
+            by_doc.setdefault(p["etag"] or p["filename"], []).append(p)
+    for doc in by_doc.values():
+        doc.sort(key=lambda p: p["chunk_id"])
+        run = [doc[0]]
+        for p in doc[1:]:
+            if p["chunk_id"] == run[-1]["chunk_id"]:
+                continue
+            if p["chunk_id"] == run[-1]["chunk_id"] + 1:
+                run.append(p)
+            else:
+                blocks.append(run)
+                run = [p]
+        blocks.append(run)
+
+    merged = []
+    for run in blocks:
+        text, end, starts = run[0]["text"], run[0]["char_end"], [0]
+        for p in run[1:]:
+            starts.append(len(text))  # where this chunk's new text begins
+            text = _join_chunks(text, end, p)
+            end = p["char_end"]
+        lead = len(text) - len(text.lstrip())
+        first = run[0]
+        merged.append({
+            "source_id": first["source_id"], "source_ids": [p["source_id"] for p in run],
+            "filename": first["filename"], "etag": first["etag"], "billing_month": first["billing_month"],
+            "chunk_id": first["chunk_id"], "chunk_ids": [p["chunk_id"] for p in run], "page": first["page"], "page_end": run[-1]["page_end"],
+            "page_ends": [p["page_end"] for p in run],
+            "score": max(p["score"] for p in run), "text": text.strip(),
+            "starts": [max(0, i - lead) for i in starts],
+        })
+    merged.sort(key=lambda b: b["score"], reverse=True)
+    return merged
+
+def _count_and_cut(text: str, max_tokens: int):
+    """Token count of `text` and, if it exceeds max_tokens, the text cut at that token boundary."""
+    enc = models.get_tokenizer(CONTEXT_TOKENIZER_NAME)(text, add_special_tokens=False, return_offsets_mapping=True)
+    offsets = enc["offset_mapping"]
+    if len(offsets) <= max_tokens:
+        return len(offsets), text
+    return len(offsets), text[:offsets[max_tokens - 1][1]] if max_tokens > 0 else ""
+
+def _page_label(block: Dict[str, Any]) -> str:
+    first, last = block.get("page"), block.get("page_end")
+    if first is None:
+        return ""
+    return f" (p. {first})" if last in (None, first) else f" (pp. {first}-{last})"
+
+def _format_hits(passages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    packed, lines = [], []
+    budget = CONTEXT_TOKENS
+    for block in _merge_adjacent(passages):
+        starts, page_ends = block.pop("starts"), block.pop("page_ends")
+        txt = block["text"][:MAX_CHARS] if MAX_CHARS else block["text"]
+        header = f"[{len(packed) + 1}] {', '.join(block['source_ids'])}{_page_label(block)}\n"
+        if CONTEXT_TOKENS:
+            remaining = budget - _count_and_cut(header, budget)[0]
+            n_tokens, txt = _count_and_cut(txt, max(remaining, 0))
+            if n_tokens > remaining:
+                if remaining < MIN_TRUNCATED_TOKENS:
+                    break
+                n_tokens = remaining
+            budget = remaining - n_tokens
+        if len(txt) < len(block["text"]):
+            # Only cite the chunks whose text survived the cut
+            kept = [sid for sid, start in zip(block["source_ids"], starts) if start < len(txt)]
+            block["source_ids"], block["chunk_ids"] = kept, block["chunk_ids"][:len(kept)]
+            block["page_end"] = page_ends[len(kept) - 1] if kept else block["page_end"]
+            header = f"[{len(packed) + 1}] {', '.join(kept)}{_page_label(block)}\n"
+        block = dict(block, n=len(packed) + 1, text=txt)
+        packed.append(block)
+        lines.append(header + txt)
+        if CONTEXT_TOKENS and budget < MIN_TRUNCATED_TOKENS:
+            break
+    return {"passages": packed, "joined_context": "\n\n".join(lines)}
+
+def _search_uncached(queries: List[str], top_k: int, where: Dict[str, Any] = None) -> List[List[Dict[str, Any]]]:
+    """One batched embed and one search request, on the local replica or Milvus (nq = len(queries))."""
+    qvs = _embed_queries(queries)
+    res = _replica_search(qvs, top_k, where)
+    if res is None:
+        client = _get_client()
+        res = client.search(
+            collection_name=COLLECTION_NAME,
+            data=qvs,
+            anns_field=VECTOR_FIELD,
+            limit=top_k,
+            filter=milvus_index.filter_expression(where or {}),
+            output_fields=OUTPUT_FIELDS,
+            search_params=milvus_index.search_params(_index_type, top_k),
+        )
+    results = []
+    for i in range(len(queries)):
+        hits = res[i] if res and i < len(res) else []
+        if SCORE_THRESHOLD > 0 and hits and float(hits[0].get("distance", 0.0)) < SCORE_THRESHOLD:
+            hits = []
+        results.append(_hits_to_passages(hits))
+    return results
+
+def _search_cached(queries: List[str], top_k: int, where: Dict[str, Any] = None) -> List[List[Dict[str, Any]]]:
+    """Per-query raw passages; cache misses are fetched together in one round trip."""
+    _invalidate_if_ingested()
+    scope = json.dumps(where or {}, sort_keys=True)
+    results = [_search_cache.get((q, top_k, SCORE_THRESHOLD, scope)) for q in queries]
+    missing = list(dict.fromkeys(q for q, r in zip(queries, results) if r is None))
+    metrics.count_cache("search_result", len(queries) - len(missing), len(missing))
+    if missing:
+        t0 = time.perf_counter()
+        with metrics.timed("search", queries=len(missing), top_k=top_k):
+            fetched = dict(zip(missing, _search_uncached(missing, top_k, where)))
+        cost = (time.perf_counter() - t0) / len(missing)
+        for q, r in fetched.items():
+            _search_cache.put((q, top_k, SCORE_THRESHOLD, scope), r, cost)
+        results = [r if r is not None else fetched[q] for q, r in zip(queries, results)]
+    return results
+
+def _search(query: str, top_k: int = TOP_K, where: Dict[str, Any] = None) -> Dict[str, Any]:
+    """`where` is a milvus_index.metadata_filter() result restricting the searched rows."""
+    return _format_hits(_search_cached([query], top_k, where)[0])
+
+def search_many(queries: List[str], top_k: int = TOP_K, where: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    Searches several sub-queries at once. Returns {queries, passages, joined_context}:
+    every query's hits are deduplicated by source_id (best score kept) and packed
+    together, and `queries` lists the source_ids each query matched. `where` is
+    the same metadata filter as for _search and applies to every query.
+    """
+    queries = [q.strip() for q in queries if q and q.strip()]
+    if not queries:
+        return {"passages": [], "joined_context": "", "queries": []}
+
+    merged: Dict[str, Dict[str, Any]] = {}
+    per_query = []
+    for q, passages in zip(queries, _search_cached(queries, top_k, where)):
+        for p in passages:
+            best = merged.get(p["source_id"])
+            if best is None or p["score"] > best["score"]:
+                merged[p["source_id"]] = p
+        per_query.append({"query": q, "source_ids": [p["source_id"] for p in passages]})
+
+    result = _format_hits(list(merged.values()))
+    result["queries"] = per_query
+    return result
 
 @tool("search_pdfs", return_direct=False)
-def search_pdfs(query: str, k: int = TOP_K) -> str:
-    """Milvus COSINE search over PDF chunks; returns JSON {passages, joined_context}."""
-    return json.dumps(_search(query, top_k=k), ensure_ascii=False)
+def search_pdfs(query: str, k: int = TOP_K, account: str = "", month: str = "", since: str = "", until: str = "") -> str:
+    """Milvus COSINE search over PDF chunks; returns JSON {passages, joined_context}. Optional filters:
+    account number, billing month "YYYY-MM", or a since/until range of billing months."""
+    try:
+        where = milvus_index.metadata_filter(account, month, since, until)
+    except ValueError as e:
+        return json.dumps({"error": str(e)})
+    return json.dumps(_search(query, top_k=k, where=where), ensure_ascii=False)
+
+@tool("search_pdfs_many", return_direct=False)
+def search_pdfs_many(queries: List[str], k: int = TOP_K, account: str = "", since: str = "", until: str = "") -> str:
+    """Searches PDF chunks for several sub-queries in one request (e.g. one per month being compared);
+    returns JSON {queries, passages, joined_context} with passages merged and deduplicated by source_id.
+    Optional filters: account number and a since/until range of billing months "YYYY-MM"."""
+    try:
+        where = milvus_index.metadata_filter(account, since=since, until=until)
+    except ValueError as e:
+        return json.dumps({"error": str(e)})
+    return json.dumps(search_many(queries, top_k=k, where=where), ensure_ascii=False)
 
 # # Optional: direct function for two-pass fallback (returns dict instead of JSON)
 # def rag_search(query: str, k: int = TOP_K) -> Dict[str, Any]:
@@ -0,0 +1,356 @@
+import os
+import json
+import time
+import uuid
+import bisect
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Kept free of third-party imports so every module (and pool worker) can use it.
+
+# --- Configuration ---
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") not in ("", "0", "false")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # serve /metrics and /metrics.json on this port (0 = off)
+METRICS_PREFIX = "rag_"
+TRACE_PATH = os.getenv("TRACE_PATH", "")            # JSONL file of trace spans ("" = tracing off)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(labels: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: Tuple[Tuple[str, str], ...], extra: Dict[str, str] = None) -> str:
+    pairs = list(key) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escape = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+
+# --- Metric Types ---
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self._values: Dict[Tuple, Any] = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    """Monotonic count per label set (documents, chunks, bytes, cache hits, failures)."""
+
+    kind = "counter"
+
+    def inc(self, n: float = 1, **labels):
+        if not METRICS_ENABLED or not n:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Current value per label set (queue depths, cache sizes)."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def inc(self, n: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def dec(self, n: float = 1, **labels):
+        self.inc(-n, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+
+class Histogram(_Metric):
+    """
+    Bucketed observations per label set. Buckets are cumulative on export
+    (Prometheus style); the JSON snapshot adds p50/p95 interpolated inside
+    the buckets, which is accurate to the bucket width.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str = "", buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0, "max": 0.0}
+            state["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            state["sum"] += value
+            state["count"] += 1
+            state["max"] = max(state["max"], value)
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def quantile(self, q: float, state: Dict) -> float:
+        target = q * state["count"]
+        seen = 0
+        for i, n in enumerate(state["counts"]):
+            if n and seen + n >= target:
+                lo = self.buckets[i - 1] if i > 0 else 0.0
+                hi = self.buckets[i] if i < len(self.buckets) else state["max"]
+                return min(lo + (hi - lo) * (target - seen) / n, state["max"])
+            seen += n
+        return state["max"]
+
+
+# --- Registry and Exporters ---
+class Registry:
+    """
+    Named metrics of this process. Collectors are callables run right before
+    every export, for values that are cheaper to sample than to track (e.g.
+    the depth of the ingestion queues).
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, help: str, **kwargs) -> Any:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric '{name}' is already registered as a {metric.kind}.")
+            return metric
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str = "") -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str = "", buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def add_collector(self, collector: Callable[[], None]):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[[], None]):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def _collect(self):
+        for collector in list(self._collectors):
+            try:
+                collector()
+            except Exception as e:
+                logging.warning(f"Metrics collector failed: {e}")
+
+    def render_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        self._collect()
+        lines = []
+        for metric in list(self._metrics.values()):
+            name = METRICS_PREFIX + metric.name
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            with metric._lock:
+                items = list(metric._values.items())
+            for key, value in items:
+                if isinstance(metric, Histogram):
+                    cumulative = 0
+                    for bound, n in zip(list(metric.buckets) + ["+Inf"], value["counts"]):
+                        cumulative += n
+                        lines.append(f"{name}_bucket{_format_labels(key, {'le': str(bound)})} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {value['sum']}")
+                    lines.append(f"{name}_count{_format_labels(key)} {value['count']}")
+                else:
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """All metrics as plain JSON: {name: [{labels, value}] } with count/sum/p50/p95/max for histograms."""
+        self._collect()
+        out = {}
+        for metric in list(self._metrics.values()):
+            with metric._lock:
+                items = list(metric._values.items())
+            series = []
+            for key, value in items:
+                entry: Dict[str, Any] = {"labels": dict(key)}
+                if isinstance(metric, Histogram):
+                    entry.update({
+                        "count": value["count"], "sum_s": round(value["sum"], 6),
+                        "p50_s": round(metric.quantile(0.5, value), 6), "p95_s": round(metric.quantile(0.95, value), 6),
+                        "max_s": round(value["max"], 6),
+                    })
+                else:
+                    entry["value"] = value
+                series.append(entry)
+            out[metric.name] = {"type": metric.kind, "help": metric.help, "series": series}
+        return out
+
+    def write_json(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith("/metrics.json"):
+            body, content_type = json.dumps(REGISTRY.snapshot()).encode("utf-8"), "application/json"
+        elif self.path.startswith("/metrics"):
+            body, content_type = REGISTRY.render_prometheus().encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+_server: Optional[ThreadingHTTPServer] = None
+
+
+def start_server(port: int = METRICS_PORT, host: str = "0.0.0.0") -> Optional[ThreadingHTTPServer]:
+    """Serves /metrics (Prometheus text) and /metrics.json from a daemon thread; no-op for port 0."""
+    global _server
+    if not port or _server is not None:
+        return _server
+    _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return _server
+
+
+# --- Trace Spans ---
+# Spans are appended to TRACE_PATH as JSON lines. A bill's spans share the
+# trace id derived from its ETag, so listing, download, extraction, embedding
+# and insert line up into one trace even though they run on different threads
+# (and the extraction in another process). Within a thread, spans opened
+# inside another span record it as their parent.
+_trace_lock = threading.Lock()
+_trace_file = None
+_local = threading.local()
+
+
+def trace_id_for(etag: str) -> str:
+    """Stable 32-hex-digit trace id for one document."""
+    return hashlib.md5(etag.encode("utf-8")).hexdigest()
+
+
+def tracing_enabled() -> bool:
+    return bool(TRACE_PATH)
+
+
+def record_span(name: str, trace_id: str, start: float, end: float, parent_id: str = None, status: str = "ok", **attrs) -> str:
+    """Writes one finished span (wall-clock start/end in seconds); returns its span id."""
+    global _trace_file
+    span_id = uuid.uuid4().hex[:16]
+    if not TRACE_PATH:
+        return span_id
+    record = {
+        "trace_id": trace_id, "span_id": span_id, "parent_id": parent_id, "name": name,
+        "start": round(start, 6), "duration_ms": round(1000 * (end - start), 3), "status": status, "attrs": attrs,
+    }
+    line = json.dumps(record, default=str) + "\n"
+    with _trace_lock:
+        if _trace_file is None:
+            _trace_file = open(TRACE_PATH, "a", buffering=1)
+        _trace_file.write(line)
+    return span_id
+
+
+@contextmanager
+def span(name: str, trace_id: str = None, **attrs):
+    """Traces the block; nested spans in the same thread become its children."""
+    if not TRACE_PATH:
+        yield None
+        return
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1] if stack else None
+    trace_id = trace_id or (parent[0] if parent else uuid.uuid4().hex)
+    span_id = uuid.uuid4().hex[:16]
+    stack.append((trace_id, span_id))
+    start, status = time.time(), "ok"
+    try:
+        yield trace_id
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        stack.pop()
+        record_span(name, trace_id, start, time.time(), parent_id=parent[1] if parent else None, status=status, **attrs)
+
+
+# --- Shared Metrics ---
+STAGE_SECONDS = REGISTRY.histogram("stage_seconds", "Wall time per ingestion / retrieval / chat stage.")
+DOCUMENTS = REGISTRY.counter("documents_total", "Documents by stage and outcome.")
+CHUNKS = REGISTRY.counter("chunks_total", "Text chunks produced.")
+ROWS = REGISTRY.counter("rows_inserted_total", "Rows inserted into Milvus, by collection.")
+BYTES = REGISTRY.counter("bytes_downloaded_total", "Object bytes downloaded.")
+PAGES = REGISTRY.counter("pages_total", "PDF pages by outcome.")
+CACHE = REGISTRY.counter("cache_requests_total", "Cache lookups by cache and result (hit/miss).")
+FAILURES = REGISTRY.counter("failures_total", "Failures by stage.")
+QUEUE_DEPTH = REGISTRY.gauge("queue_depth", "Items waiting in each ingestion queue.")
+
+
+@contextmanager
+def timed(stage: str, trace_id: str = None, **attrs):
+    """Observes the block's duration in STAGE_SECONDS{stage} and, with tracing on, records it as a span."""
+    with span(stage, trace_id, **attrs):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - t0, stage=stage)
+
+
+def count_cache(cache: str, hits: int, misses: int):
+    CACHE.inc(hits, cache=cache, result="hit")
+    CACHE.inc(misses, cache=cache, result="miss")
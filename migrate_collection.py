@@ -0,0 +1,133 @@
+import os
+import sys
+import time
+import argparse
+import logging
+from typing import Any, Dict, List, TYPE_CHECKING
+
+sys.path.append(os.path.abspath(os.path.join(os.getcwd(), '../credentials')))
+from credentials import MILVUS_HOST, MILVUS_PORT, COLLECTION_NAME
+
+import models
+from milvus_index import ensure_collection, has_scalar_fields, VECTOR_FIELD, _vector_dim
+from milvus_pool import get_client, milvus_uri, touch_write_stamp, BufferedWriter
+from bill_fields import extract_bill_fields
+from text_store import TextStore
+
+if TYPE_CHECKING:
+    from pymilvus import MilvusClient
+
+# --- Configuration ---
+MIGRATE_BATCH_ROWS = 1000 # Rows read per query_iterator page and written per insert
+HEADER_CHUNKS = 2         # Leading chunks searched for the account / billing period when no text store is given
+
+# --- Migration ---
+# Copies a collection created before the typed schema (ETag, filename and
+# chunk_id in the dynamic JSON field, no partition key) into a new collection
+# made by ensure_collection(). Vectors and every other field are copied as
+# they are, so nothing is re-embedded; only account and billing_month are
+# new. They are read from the bill itself: the pages in the text store when
+# the document is there, else the first chunks of its text. The source is
+# left untouched; point COLLECTION_NAME at the target once the report looks
+# right.
+
+
+def _document_fields(client: "MilvusClient", source: str, text_store: TextStore = None, batch_size: int = MIGRATE_BATCH_ROWS) -> Dict[str, Dict[str, str]]:
+    """Pass 1: {ETag: {"account", "billing_month"}} for every document of `source`."""
+    headers: Dict[str, Dict[int, str]] = {}
+    iterator = client.query_iterator(
+        collection_name=source, batch_size=batch_size, filter=f"chunk_id < {HEADER_CHUNKS}",
+        output_fields=["ETag", "chunk_id", "text"],
+    )
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            for row in rows:
+                headers.setdefault(row.get("ETag") or "", {})[row.get("chunk_id") or 0] = row.get("text") or ""
+    finally:
+        iterator.close()
+
+    fields = {}
+    for etag, chunks in headers.items():
+        record = text_store.get(etag) if text_store is not None and etag else None
+        pages = record["pages"] if record else [chunks[i] for i in sorted(chunks)]
+        found = extract_bill_fields(pages)
+        fields[etag] = {"account": (found["account"] or "")[:32], "billing_month": found["billing_month"] or ""}
+    return fields
+
+
+def _copy_row(row: Dict[str, Any], fields: Dict[str, Dict[str, str]]) -> Dict[str, Any]:
+    row = dict(row)
+    row.pop("id", None)  # the target assigns its own ids
+    row.setdefault("ETag", "")
+    row.setdefault("filename", "")
+    row.setdefault("chunk_id", 0)
+    row.update(fields.get(row["ETag"]) or {"account": "", "billing_month": ""})
+    return row
+
+
+def migrate(
+    client: "MilvusClient",
+    source: str,
+    target: str,
+    text_store: TextStore = None,
+    batch_size: int = MIGRATE_BATCH_ROWS,
+) -> Dict[str, int]:
+    """
+    Copies every row of `source` into `target` (created with the typed,
+    partitioned schema; it must not exist yet). Returns counts of rows and
+    documents, and of documents whose billing month was not recognised.
+    """
+    if client.has_collection(target):
+        raise ValueError(f"Collection '{target}' already exists; migrate into a new collection.")
+    description = client.describe_collection(source)
+    if has_scalar_fields(description):
+        logging.warning(f"Collection '{source}' already has the typed schema; copying it anyway.")
+    dim = _vector_dim(description, VECTOR_FIELD) or models.EMBEDDING_DIM
+    client.load_collection(source)
+
+    fields = _document_fields(client, source, text_store, batch_size)
+    ensure_collection(client, target, dim=dim)
+
+    report = {"rows": 0, "documents": len(fields), "unknown_month": sum(1 for f in fields.values() if not f["billing_month"])}
+    iterator = client.query_iterator(collection_name=source, batch_size=batch_size, filter="", output_fields=["*"])
+    try:
+        with BufferedWriter(client, target, max_rows=batch_size) as writer:
+            while True:
+                rows = iterator.next()
+                if not rows:
+                    break
+                writer.add([_copy_row(row, fields) for row in rows])
+                report["rows"] += len(rows)
+    finally:
+        iterator.close()
+    client.flush(target)
+    touch_write_stamp(target)
+    return report
+
+
+def _parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Copy a collection into the typed, billing_month-partitioned schema.")
+    parser.add_argument("--source", default=COLLECTION_NAME, help="collection to copy (left unchanged)")
+    parser.add_argument("--target", required=True, help="new collection to create and fill")
+    parser.add_argument("--text-store", default="", help="text store directory; its pages give the most reliable account and billing month")
+    parser.add_argument("--batch-size", type=int, default=MIGRATE_BATCH_ROWS)
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None):
+    args = _parse_args(argv)
+    client = get_client(milvus_uri(MILVUS_HOST, MILVUS_PORT), db_name="default")
+    text_store = TextStore(args.text_store) if args.text_store else None
+    t0 = time.perf_counter()
+    report = migrate(client, args.source, args.target, text_store=text_store, batch_size=args.batch_size)
+    print(f"[migrate] {args.source} -> {args.target}: {report} in {time.perf_counter() - t0:.1f}s")
+    if report["unknown_month"]:
+        print(f"[migrate] {report['unknown_month']} documents have no billing month and sit in the billing_month=\"\" partition.")
+    print(f"[migrate] Set COLLECTION_NAME={args.target} to search the new collection.")
+
+
+if __name__ == "__main__":
+    main()
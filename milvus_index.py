@@ -0,0 +1,210 @@
+import os
+import re
+import json
+import logging
+from typing import Any, Dict, List, Tuple, Union, TYPE_CHECKING
+
+import models
+
+if TYPE_CHECKING:
+    from pymilvus import MilvusClient
+
+# --- Configuration ---
+VECTOR_FIELD = "vector"
+METRIC_TYPE = "COSINE"
+INDEX_TYPE = os.getenv("MILVUS_INDEX_TYPE", "AUTOINDEX").upper()
+INDEX_PARAMS_OVERRIDE = os.getenv("MILVUS_INDEX_PARAMS", "")    # JSON, merged over the preset's build params
+SEARCH_PARAMS_OVERRIDE = os.getenv("MILVUS_SEARCH_PARAMS", "")  # JSON, merged over the preset's search params
+SCALAR_INDEX_TYPE = os.getenv("MILVUS_SCALAR_INDEX_TYPE", "INVERTED")
+PARTITION_KEY_FIELD = "billing_month"
+NUM_PARTITIONS = int(os.getenv("MILVUS_NUM_PARTITIONS", "64"))
+
+# --- Typed Scalar Fields ---
+# Fields every row carries as real, indexed columns instead of keys of the
+# dynamic JSON field, so `ETag in [...]` lookups and metadata filters use an
+# index. billing_month ("YYYY-MM", "" when unknown) is the partition key:
+# equality / `in` filters on it only search the partitions holding those
+# months. Everything else (text, spans, pages, chunk_hash) stays dynamic.
+SCALAR_FIELDS: Dict[str, Tuple[str, Dict[str, Any]]] = {
+    "ETag": ("VARCHAR", {"max_length": 128}),
+    "filename": ("VARCHAR", {"max_length": 1024}),
+    "chunk_id": ("INT64", {}),
+    "account": ("VARCHAR", {"max_length": 32}),
+    "billing_month": ("VARCHAR", {"max_length": 16}),
+}
+
+# --- Index Presets ---
+# Build parameters and the matching search-time knobs per index type. The
+# search knobs trade recall for latency: HNSW's `ef` must be >= top_k, IVF's
+# `nprobe` is how many of the `nlist` clusters are scanned.
+INDEX_PRESETS: Dict[str, Dict[str, Any]] = {
+    "AUTOINDEX": {"build": {}, "search": {}},
+    "FLAT": {"build": {}, "search": {}},
+    "HNSW": {"build": {"M": 16, "efConstruction": 200}, "search": {"ef": 64}},
+    "IVF_FLAT": {"build": {"nlist": 1024}, "search": {"nprobe": 16}},
+    "IVF_SQ8": {"build": {"nlist": 1024}, "search": {"nprobe": 16}},
+    "IVF_PQ": {"build": {"nlist": 1024, "nbits": 8}, "search": {"nprobe": 16}},
+}
+
+
+def _overrides(raw: str) -> Dict[str, Any]:
+    return json.loads(raw) if raw else {}
+
+
+def index_params(index_type: str = INDEX_TYPE, dim: int = models.EMBEDDING_DIM) -> Dict[str, Any]:
+    """Build parameters for `index_type` at vector size `dim`."""
+    index_type = index_type.upper()
+    if index_type not in INDEX_PRESETS:
+        raise ValueError(f"Unknown index type {index_type}; expected one of {sorted(INDEX_PRESETS)}.")
+    params = dict(INDEX_PRESETS[index_type]["build"])
+    if index_type == "IVF_PQ":
+        # PQ splits each vector into m sub-vectors; m must divide dim (8 dims per sub-vector here)
+        params["m"] = max(1, dim // 8)
+    params.update(_overrides(INDEX_PARAMS_OVERRIDE))
+    return params
+
+
+def search_params(index_type: str = INDEX_TYPE, top_k: int = 10) -> Dict[str, Any]:
+    """The `search_params` argument of MilvusClient.search for `index_type`."""
+    index_type = index_type.upper()
+    params = dict(INDEX_PRESETS.get(index_type, {"search": {}})["search"])
+    if "ef" in params:
+        params["ef"] = max(params["ef"], top_k)
+    params.update(_overrides(SEARCH_PARAMS_OVERRIDE))
+    return {"metric_type": METRIC_TYPE, "params": params}
+
+
+def detect_index_type(client: "MilvusClient", collection_name: str, field_name: str = VECTOR_FIELD) -> str:
+    """Index type actually built on the collection's vector field (INDEX_TYPE if it cannot be read)."""
+    try:
+        for name in client.list_indexes(collection_name, field_name=field_name):
+            info = client.describe_index(collection_name, index_name=name)
+            if info.get("index_type"):
+                return str(info["index_type"]).upper()
+    except Exception as e:
+        logging.warning(f"Could not read the index of '{collection_name}', assuming {INDEX_TYPE}: {e}")
+    return INDEX_TYPE
+
+
+def _vector_dim(description: Dict[str, Any], field_name: str) -> int:
+    for field in description.get("fields", []):
+        if field.get("name") == field_name:
+            return int(field.get("params", {}).get("dim", 0))
+    return 0
+
+
+def has_scalar_fields(description: Dict[str, Any]) -> bool:
+    """True for collections created with the typed SCALAR_FIELDS schema."""
+    names = {field.get("name") for field in description.get("fields", [])}
+    return all(name in names for name in SCALAR_FIELDS)
+
+
+def ensure_collection(
+    client: "MilvusClient",
+    collection_name: str,
+    dim: int = models.EMBEDDING_DIM,
+    index_type: str = INDEX_TYPE,
+    scalar_fields: bool = True,
+):
+    """
+    Creates the collection (auto id, `dim`-d COSINE vector with the
+    configured index, the typed and indexed SCALAR_FIELDS partitioned by
+    billing_month, dynamic fields for the rest) unless it exists.
+    scalar_fields=False leaves out the typed fields (vector-only scratch
+    collections). An existing collection whose vector size differs from
+    `dim` is an error: inserts would fail.
+    """
+    if client.has_collection(collection_name):
+        description = client.describe_collection(collection_name)
+        existing = _vector_dim(description, VECTOR_FIELD)
+        if existing and existing != dim:
+            raise ValueError(
+                f"Collection '{collection_name}' stores {existing}-d vectors but EMBEDDING_DIM is {dim}; "
+                f"use a new collection (e.g. auto_checker.py --reindex --target-collection ...)."
+            )
+        if scalar_fields and not has_scalar_fields(description):
+            logging.warning(
+                f"Collection '{collection_name}' keeps ETag/filename/chunk_id in its dynamic field (no scalar "
+                f"indexes, no partition key); copy it with migrate_collection.py to get the typed schema."
+            )
+        print(f"Collection '{collection_name}' already exists.")
+        return
+
+    from pymilvus import DataType, MilvusClient
+
+    schema = MilvusClient.create_schema(auto_id=True, enable_dynamic_field=True)
+    schema.add_field(field_name="id", datatype=DataType.INT64, is_primary=True)
+    schema.add_field(field_name=VECTOR_FIELD, datatype=DataType.FLOAT_VECTOR, dim=dim)
+
+    index = client.prepare_index_params()
+    index.add_index(
+        field_name=VECTOR_FIELD,
+        index_type=index_type.upper(),
+        metric_type=METRIC_TYPE,
+        params=index_params(index_type, dim),
+    )
+    options: Dict[str, Any] = {}
+    if scalar_fields:
+        for name, (datatype, params) in SCALAR_FIELDS.items():
+            schema.add_field(
+                field_name=name, datatype=getattr(DataType, datatype),
+                is_partition_key=name == PARTITION_KEY_FIELD, **params,
+            )
+            index.add_index(field_name=name, index_type=SCALAR_INDEX_TYPE, index_name=f"{name}_idx")
+        options["num_partitions"] = NUM_PARTITIONS
+    client.create_collection(collection_name=collection_name, schema=schema, index_params=index, **options)
+    layout = f", {NUM_PARTITIONS} partitions by {PARTITION_KEY_FIELD}" if scalar_fields else ""
+    print(f"Collection '{collection_name}' created ({dim}-d, {index_type.upper()} index{layout}).")
+
+
+# --- Metadata Filters ---
+_MONTH = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+MAX_FILTER_MONTHS = 120  # longer month ranges become a >=/<= range, which cannot prune partitions
+
+
+def _check_month(month: str) -> str:
+    if not _MONTH.match(month):
+        raise ValueError(f"Months are written YYYY-MM, got {month!r}.")
+    return month
+
+
+def months_between(since: str, until: str) -> List[str]:
+    """Every "YYYY-MM" from since to until, inclusive."""
+    first = int(since[:4]) * 12 + int(since[5:]) - 1
+    last = int(until[:4]) * 12 + int(until[5:]) - 1
+    return [f"{i // 12:04d}-{i % 12 + 1:02d}" for i in range(first, last + 1)]
+
+
+def metadata_filter(account: str = "", month: str = "", since: str = "", until: str = "") -> Dict[str, Union[List[str], Tuple[str, str]]]:
+    """
+    Normalised search filter: {field: [allowed values]} or {field: (min, max)}.
+    A bounded month range is expanded to the list of its months, so that the
+    billing_month partition key can prune partitions. Empty means no filter.
+    """
+    where: Dict[str, Union[List[str], Tuple[str, str]]] = {}
+    if account:
+        where["account"] = [str(account).replace(" ", "").replace("-", "")]
+    if month:
+        where["billing_month"] = [_check_month(month)]
+    elif since or until:
+        since, until = since and _check_month(since), until and _check_month(until)
+        if since and until and len(months_between(since, until)) <= MAX_FILTER_MONTHS:
+            where["billing_month"] = months_between(since, until)
+        else:
+            where["billing_month"] = (since or "0000-01", until)  # the lower bound also skips unknown months ("")
+    return where
+
+
+def filter_expression(where: Dict[str, Union[List[str], Tuple[str, str]]]) -> str:
+    """Milvus boolean expression for a metadata_filter() result ("" for none)."""
+    terms = []
+    for field, condition in where.items():
+        if isinstance(condition, tuple):
+            low, high = condition
+            if low:
+                terms.append(f"{field} >= {json.dumps(low)}")
+            if high:
+                terms.append(f"{field} <= {json.dumps(high)}")
+        else:
+            terms.append(f"{field} in [" + ",".join(json.dumps(v) for v in condition) + "]")
+    return " and ".join(terms)
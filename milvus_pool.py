@@ -0,0 +1,244 @@
+import os
+import time
+import logging
+import threading
+from typing import Callable, Dict, List, Tuple, TYPE_CHECKING
+
+import metrics
+
+if TYPE_CHECKING:
+    from pymilvus import MilvusClient
+
+# --- Shared Clients ---
+# MilvusClient multiplexes concurrent calls over one gRPC channel and is safe to
+# share between threads, so one client per (uri, db_name) serves the whole process.
+# pymilvus (and its gRPC stack) is only imported when the first client is created.
+_clients: Dict[Tuple[str, str], "MilvusClient"] = {}
+_clients_lock = threading.Lock()
+
+
+def milvus_uri(host: str, port) -> str:
+    """Server URI for host:port; a host ending in ".db" is a local milvus-lite file and is used as is."""
+    if str(host).endswith(".db"):
+        return str(host)
+    return f"http://{host}:{port}"
+
+
+def get_client(uri: str, db_name: str = "default") -> "MilvusClient":
+    """
+    Returns the process-wide client for (uri, db_name), connecting on first use.
+    `uri` may also be a local milvus-lite file such as "./milvus.db".
+    """
+    pool_key = (uri, db_name)
+    client = _clients.get(pool_key)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        client = _clients.get(pool_key)
+        if client is None:
+            from pymilvus import MilvusClient
+
+            logging.info(f"Connecting to Milvus at {uri} (db '{db_name}')...")
+            client = MilvusClient(uri=uri, db_name=db_name)
+            _clients[pool_key] = client
+    return client
+
+
+def close_clients():
+    """Closes every pooled client (e.g. at process exit or between tests)."""
+    with _clients_lock:
+        for client in _clients.values():
+            try:
+                client.close()
+            except Exception as e:
+                logging.warning(f"Failed to close Milvus client: {e}")
+        _clients.clear()
+
+
+# --- Write Stamps ---
+# Every successful write to a collection touches a stamp file, so readers in
+# other processes (e.g. the chat host's search cache) can tell with a single
+# stat() call that the collection changed and drop what they cached. The
+# directory is absolute (next to this module by default), so ingestion run from
+# the repo root and chat run from llm_test/ see the same stamps; processes on
+# other hosts must point MILVUS_WRITE_STAMP_DIR at a shared directory.
+WRITE_STAMP_DIR = os.path.abspath(
+    os.getenv("MILVUS_WRITE_STAMP_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".milvus_stamps")
+)
+
+
+def _stamp_path(collection_name: str) -> str:
+    return os.path.join(WRITE_STAMP_DIR, f"{collection_name}.stamp")
+
+
+def touch_write_stamp(collection_name: str):
+    try:
+        os.makedirs(WRITE_STAMP_DIR, exist_ok=True)
+        path = _stamp_path(collection_name)
+        with open(path, "a"):
+            pass
+        os.utime(path, None)
+    except OSError as e:
+        logging.warning(f"Could not update write stamp for '{collection_name}': {e}")
+
+
+def read_write_stamp(collection_name: str) -> int:
+    """Nanosecond mtime of the collection's last recorded write; 0 if none is known."""
+    try:
+        return os.stat(_stamp_path(collection_name)).st_mtime_ns
+    except OSError:
+        return 0
+
+
+# --- Buffered Bulk Writer ---
+def _row_bytes(row: Dict) -> int:
+    """Rough wire size of one row: float32 vectors plus UTF-8 strings."""
+    size = 0
+    for value in row.values():
+        if isinstance(value, (list, tuple)):
+            size += 4 * len(value)
+        elif isinstance(value, str):
+            size += len(value.encode("utf-8"))
+        else:
+            size += 8
+    return size
+
+
+class WriterFull(Exception):
+    """Raised by BufferedWriter.add() when rows that failed to flush already fill the buffer."""
+
+
+class BufferedWriter:
+    """
+    Gathers rows across documents and inserts them in large batches.
+
+    A flush happens when the buffer reaches `max_rows` or `max_bytes`, when
+    `max_interval` seconds have passed since the last flush, on an explicit
+    flush() and when the writer is closed / leaves its `with` block.
+    Rows passed to one add() call are always flushed together, so a document
+    is never split across two inserts. Failed inserts are retried with
+    exponential backoff; if all retries fail the rows stay buffered and the
+    error is raised to the caller of flush(). Retained rows are capped: once
+    `max_pending_rows` rows (or 4 x max_bytes) are held, add() first retries
+    the flush and, if Milvus is still failing, raises WriterFull without
+    taking the new rows. discard() drops whatever is held.
+    `on_flush(rows)` is called after every successful insert.
+    """
+
+    def __init__(
+        self,
+        client: "MilvusClient",
+        collection_name: str,
+        max_rows: int = 5000,
+        max_bytes: int = 32 * 1024 * 1024,
+        max_interval: float = 5.0,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+        on_flush: Callable[[List[Dict]], None] = None,
+        max_pending_rows: int = None,
+    ):
+        self.client = client
+        self.collection_name = collection_name
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.on_flush = on_flush
+        self.max_pending_rows = max_pending_rows or 4 * max_rows
+        self.max_pending_bytes = 4 * max_bytes
+
+        self.rows_written = 0
+        self.flushes = 0
+
+        self._buffer: List[Dict] = []
+        self._buffer_bytes = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        self._timer = None
+        if max_interval:
+            self._timer = threading.Thread(target=self._flush_periodically, name="milvus-writer-timer", daemon=True)
+            self._timer.start()
+
+    def add(self, rows: List[Dict]):
+        if not rows:
+            return
+        with self._lock:
+            if len(self._buffer) >= self.max_pending_rows or self._buffer_bytes >= self.max_pending_bytes:
+                # Earlier flushes failed: get the held rows in before taking more
+                try:
+                    self.flush()
+                except Exception as e:
+                    raise WriterFull(f"{len(self._buffer)} rows are still waiting for '{self.collection_name}': {e}") from e
+            self._buffer.extend(rows)
+            self._buffer_bytes += sum(_row_bytes(row) for row in rows)
+            if len(self._buffer) >= self.max_rows or self._buffer_bytes >= self.max_bytes:
+                self.flush()
+
+    def flush(self) -> int:
+        """Inserts everything buffered; returns the number of rows written."""
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._buffer:
+                return 0
+
+            rows = self._buffer
+            t0, started = time.perf_counter(), time.time()
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self.client.insert(collection_name=self.collection_name, data=rows)
+                    break
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        metrics.FAILURES.inc(stage="insert")
+                        logging.error(f"Giving up on inserting {len(rows)} rows into '{self.collection_name}': {e}")
+                        raise
+                    delay = self.backoff * (2 ** attempt)
+                    logging.warning(f"Insert of {len(rows)} rows failed (attempt {attempt + 1}), retrying in {delay:.1f}s: {e}")
+                    time.sleep(delay)
+
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - t0, stage="insert")
+            metrics.ROWS.inc(len(rows), collection=self.collection_name)
+            if metrics.tracing_enabled():
+                # One insert span per document, so each bill's trace ends at its insert
+                for etag in dict.fromkeys(row.get("ETag") for row in rows if row.get("ETag")):
+                    metrics.record_span("insert", metrics.trace_id_for(etag), started, time.time(), rows=len(rows), collection=self.collection_name)
+            touch_write_stamp(self.collection_name)
+            self._buffer, self._buffer_bytes = [], 0
+            self.rows_written += len(rows)
+            self.flushes += 1
+            logging.info(f"Flushed {len(rows)} rows into collection '{self.collection_name}'.")
+
+        if self.on_flush is not None:
+            self.on_flush(rows)
+        return len(rows)
+
+    def discard(self) -> List[Dict]:
+        """Drops and returns the buffered rows (e.g. after a flush that will not succeed)."""
+        with self._lock:
+            rows, self._buffer, self._buffer_bytes = self._buffer, [], 0
+        return rows
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.max_interval / 2):
+            if time.monotonic() - self._last_flush < self.max_interval:
+                continue
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Timed flush failed, rows kept for the next flush: {e}")
+
+    def close(self):
+        self._closed.set()
+        if self._timer is not None:
+            self._timer.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,304 @@
+import os
+import json
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Union
+
+# Process-wide, lazily loaded model singletons shared by ingestion (pdf_to_vector)
+# and retrieval (llm_test/rag_get_pdf_data): importing this module loads nothing,
+# and each model is loaded at most once per process, on first use or warmup().
+
+# --- Embedding Dimension ---
+# nomic-embed-text-v1.5 is trained with Matryoshka representation learning, so
+# its 768-d vectors can be cut down to 512/256/128/64 dims. Ingestion and
+# search must use the same EMBEDDING_DIM (and the collection must be built with it).
+NATIVE_DIM = 768
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", str(NATIVE_DIM)))
+MATRYOSHKA_DIMS = (768, 512, 256, 128, 64)
+
+# --- Embedding Backends ---
+# "torch" is the SentenceTransformer reference. "onnx" runs the same network
+# exported by export_onnx() under ONNX Runtime, "onnx-int8" its dynamically
+# quantised copy (int8 weights, fp32 activations). Check a new export with
+# benchmarks/bench_embedding.py before switching ingestion or search to it.
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+ONNX_DIR = os.getenv("ONNX_DIR", "onnx_models")      # export_onnx() output, one sub-directory per model
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0"))   # intra-op threads per session (0 = one per core)
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "0")) # >1 spreads large encode() calls over that many processes
+
+_models: Dict[Any, Any] = {}
+_tokenizers: Dict[str, Any] = {}
+_lock = threading.RLock()
+
+
+def get_embedding_model(model_name: str, backend: str = None, workers: int = None):
+    """
+    Returns the embedding model for model_name on the given backend (default
+    EMBEDDING_BACKEND), loading it on first use. Every backend has the
+    SentenceTransformer-style encode(sentences, batch_size) -> numpy.
+    With workers > 1 (default EMBED_WORKERS) an EmbeddingPool is returned.
+    """
+    backend = backend or EMBEDDING_BACKEND
+    workers = EMBED_WORKERS if workers is None else workers
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"EMBEDDING_BACKEND must be one of {EMBEDDING_BACKENDS}, got {backend}.")
+    key = (model_name, backend, workers if workers > 1 else 0)
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    with _lock:
+        model = _models.get(key)
+        if model is None:
+            logging.info(f"Loading embedding model {model_name} ({backend}{f', {workers} workers' if workers > 1 else ''})...")
+            if workers > 1:
+                model = EmbeddingPool(model_name, backend, workers)
+            elif backend == "torch":
+                from sentence_transformers import SentenceTransformer
+
+                model = SentenceTransformer(model_name, trust_remote_code=True)
+            else:
+                model = OnnxEmbedder(onnx_path(model_name, backend))
+            _models[key] = model
+    return model
+
+
+def embedding_model_id(model_name: str, backend: str = None) -> str:
+    """
+    Identity of the vectors a backend produces, for keying embedding caches.
+    fp32 ONNX reproduces the torch vectors up to float rounding and shares
+    their id; int8 vectors are close but not equal, so they get their own.
+    """
+    backend = backend or EMBEDDING_BACKEND
+    return f"{model_name}@{backend}" if backend.endswith("int8") else model_name
+
+
+def get_tokenizer(model_name: str):
+    """Returns the fast tokenizer for model_name, loading it on first use."""
+    tokenizer = _tokenizers.get(model_name)
+    if tokenizer is not None:
+        return tokenizer
+
+    with _lock:
+        tokenizer = _tokenizers.get(model_name)
+        if tokenizer is None:
+            from transformers import AutoTokenizer
+
+            logging.info(f"Loading tokenizer {model_name}...")
+            tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, use_fast=True)
+            if not tokenizer.is_fast:
+                # The chunker slices the source text with offset mappings, which only fast tokenizers provide
+                raise ValueError(f"Tokenizer for {model_name} is not a fast tokenizer.")
+            _tokenizers[model_name] = tokenizer
+    return tokenizer
+
+
+def warmup(model_name: str, tokenizer: bool = True, backend: str = None, workers: int = None):
+    """Loads the model (and tokenizer) up front, e.g. before serving the first request."""
+    get_embedding_model(model_name, backend, workers)
+    if tokenizer:
+        get_tokenizer(model_name)
+
+
+def reduce_dimension(vectors, dim: int = EMBEDDING_DIM):
+    """
+    Matryoshka truncation as recommended for nomic-embed-text-v1.5: layer-norm
+    the full vectors, keep the first `dim` components and L2-normalise. At the
+    native size the vectors are returned unchanged, so existing 768-d
+    collections keep matching. Accepts one vector or a batch; returns numpy.
+    """
+    import numpy as np
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dim >= vectors.shape[-1]:
+        return vectors
+    if dim not in MATRYOSHKA_DIMS:
+        raise ValueError(f"EMBEDDING_DIM must be one of {MATRYOSHKA_DIMS}, got {dim}.")
+    mean = vectors.mean(axis=-1, keepdims=True)
+    var = vectors.var(axis=-1, keepdims=True)
+    normed = (vectors - mean) / np.sqrt(var + 1e-5)  # layer_norm without affine weights
+    truncated = normed[..., :dim]
+    return truncated / np.maximum(np.linalg.norm(truncated, axis=-1, keepdims=True), 1e-12)
+
+
+# --- ONNX Runtime ---
+def onnx_path(model_name: str, backend: str = "onnx", onnx_dir: str = None) -> str:
+    filename = "model.int8.onnx" if backend.endswith("int8") else "model.onnx"
+    return os.path.join(onnx_dir or ONNX_DIR, model_name.replace("/", "__"), filename)
+
+
+class OnnxEmbedder:
+    """
+    SentenceTransformer.encode() on an export_onnx() model: the same
+    tokenizer, pooling and normalisation (they are part of the exported
+    graph), numpy in and out. Batches are formed from length-sorted inputs
+    to keep padding small.
+
+    The weights sit in an external data file that the session memory-maps
+    (prepacking is disabled so they are not copied into the heap), so all
+    processes running the same model share one copy in the page cache.
+    """
+
+    def __init__(self, path: str, threads: int = ONNX_THREADS):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(os.path.dirname(path), "embedder.json")) as f:
+            self.config = json.load(f)
+        options = ort.SessionOptions()
+        options.add_session_config_entry("session.disable_prepacking", "1")
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.max_seq_length = self.config["max_seq_length"]
+        # A private tokenizer: fast tokenizers fail when padding is changed while another thread uses them
+        self.tokenizer = AutoTokenizer.from_pretrained(self.config["model_name"], trust_remote_code=True, use_fast=True)
+        self._tokenizer_lock = threading.Lock()
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.config["dim"]
+
+    def encode(self, sentences: Union[str, List[str]], batch_size: int = 32, **kwargs):
+        import numpy as np
+
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        out = np.empty((len(texts), self.config["dim"]), dtype=np.float32)
+        order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+        for start in range(0, len(texts), batch_size):
+            index = order[start:start + batch_size]
+            with self._tokenizer_lock:
+                encoded = self.tokenizer(
+                    [texts[i] for i in index], padding=True, truncation=True,
+                    max_length=self.max_seq_length, return_tensors="np",
+                )
+            feed = {name: encoded[name].astype(np.int64) for name in self.input_names}
+            out[index] = self.session.run(None, feed)[0]
+        return out[0] if single else out
+
+
+def export_onnx(model_name: str, onnx_dir: str = None, quantize: bool = True, opset: int = 17) -> str:
+    """
+    Exports the SentenceTransformer (transformer, pooling and normalisation
+    in one graph) to onnx_dir/<model>/model.onnx with its weights in
+    model.onnx.data, plus the dynamically int8-quantised model.int8.onnx.
+    Needs torch, sentence-transformers, onnx and onnxruntime; returns the
+    export directory.
+    """
+    import torch
+    import onnx
+    from sentence_transformers import SentenceTransformer
+
+    st_model = SentenceTransformer(model_name, trust_remote_code=True, device="cpu").eval()
+    tokenizer = st_model.tokenizer
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in tokenizer.model_input_names]
+
+    class _Encoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.st_model = st_model
+
+        def forward(self, *inputs):
+            return self.st_model(dict(zip(input_names, inputs)))["sentence_embedding"]
+
+    path = onnx_path(model_name, "onnx", onnx_dir)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    sample = tokenizer(
+        ["search_document: Amount due $123.45", "search_query: how many kWh did I use in the billing period last July?"],
+        padding=True, return_tensors="pt",
+    )
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["sentence_embedding"] = {0: "batch"}
+    logging.info(f"Exporting {model_name} to {path}...")
+    with torch.no_grad():
+        torch.onnx.export(
+            _Encoder(), tuple(sample[name] for name in input_names), path + ".tmp",
+            input_names=input_names, output_names=["sentence_embedding"],
+            dynamic_axes=dynamic_axes, opset_version=opset, dynamo=False,
+        )
+    # Re-save with every weight in one external file, which sessions memory-map
+    graph = onnx.load(path + ".tmp")
+    onnx.save_model(graph, path, save_as_external_data=True, all_tensors_to_one_file=True,
+                    location=os.path.basename(path) + ".data", size_threshold=1024)
+    os.remove(path + ".tmp")
+    if os.path.exists(path + ".tmp.data"):
+        os.remove(path + ".tmp.data")
+
+    with open(os.path.join(directory, "embedder.json"), "w") as f:
+        json.dump({
+            "model_name": model_name, "dim": st_model.get_sentence_embedding_dimension(),
+            "max_seq_length": st_model.max_seq_length, "inputs": input_names, "opset": opset,
+        }, f, indent=2)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        int8_path = onnx_path(model_name, "onnx-int8", onnx_dir)
+        logging.info(f"Quantising to {int8_path}...")
+        quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8, per_channel=True, use_external_data_format=True)
+    return directory
+
+
+# --- Multi-Process Encoding ---
+_worker_model = None
+
+
+def _init_worker(model_name: str, backend: str, threads: int, path: str):
+    global _worker_model
+    if backend == "torch":
+        import torch
+
+        torch.set_num_threads(threads)
+        _worker_model = get_embedding_model(model_name, backend, workers=0)
+    else:
+        _worker_model = OnnxEmbedder(path, threads=threads)
+
+
+def _encode_in_worker(texts: List[str], batch_size: int):
+    return _worker_model.encode(texts, batch_size=batch_size)
+
+
+class EmbeddingPool:
+    """
+    encode() spread over worker processes, each running its own copy of the
+    model with cores / workers threads. Small, few-core sessions scale
+    better than one session using every core, and with the ONNX backends
+    the workers share the memory-mapped weights. A call with at least
+    min_parallel texts is split into one shard per worker; a smaller call
+    (e.g. a single query) is one task, run by whichever worker is free.
+    """
+
+    def __init__(self, model_name: str, backend: str = EMBEDDING_BACKEND, workers: int = EMBED_WORKERS, min_parallel: int = 64):
+        import multiprocessing
+
+        self.workers = max(2, workers)
+        self.min_parallel = min_parallel
+        threads = max(1, (os.cpu_count() or self.workers) // self.workers)
+        # spawn, not fork: the parent may already hold threaded runtimes (torch, ORT, tokenizers)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker, initargs=(model_name, backend, threads, onnx_path(model_name, backend)),
+        )
+        # One task per worker before any finishes starts every process, and each loads its model
+        for f in [self._pool.submit(int) for _ in range(self.workers)]:
+            f.result()
+
+    def encode(self, sentences: Union[str, List[str]], batch_size: int = 32, **kwargs):
+        import numpy as np
+
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if len(texts) < self.min_parallel:
+            vectors = self._pool.submit(_encode_in_worker, texts, batch_size).result()
+        else:
+            size = -(-len(texts) // self.workers)
+            shards = [texts[i:i + size] for i in range(0, len(texts), size)]
+            vectors = np.concatenate([f.result() for f in [self._pool.submit(_encode_in_worker, shard, batch_size) for shard in shards]])
+        return vectors[0] if single else vectors
+
+    def close(self):
+        self._pool.shutdown()
@@ -0,0 +1,258 @@
+import io
+import os
+import mmap
+import signal
+import logging
+import tempfile
+import threading
+from concurrent.futures import Executor, Future
+from typing import Any, Dict, List, Tuple, Union, BinaryIO
+from pypdf import PdfReader
+
+# Kept free of model/client imports so process-pool workers can import it cheaply.
+
+# --- Configuration ---
+SPOOL_MAX_BYTES = 8 * 1024 * 1024  # Downloads larger than this spill from RAM to a temp file
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024 # Read size when streaming an object body
+PAGE_TIMEOUT_SECONDS = float(os.getenv("PDF_PAGE_TIMEOUT", "30")) # A page taking longer is skipped (0 = no limit)
+PAGE_FANOUT_MIN_PAGES = 32 # Documents with more pages are split across the process pool
+PAGES_PER_TASK = 16        # Pages extracted by one pool task when a document is split
+
+
+# --- Memory Accounting ---
+def reset_peak_rss():
+    """Resets this process's peak RSS counter (Linux >= 4.0); a no-op elsewhere."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_kb() -> int:
+    """Peak resident set size of this process in kB since the last reset_peak_rss()."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        return 0
+
+
+# --- Streaming Downloads ---
+def _stream_body(s3_client, bucket: str, key: str, out: BinaryIO) -> Dict[str, Any]:
+    resp = s3_client.get_object(Bucket=bucket, Key=key)
+    for chunk in resp["Body"].iter_chunks(DOWNLOAD_CHUNK_BYTES):
+        out.write(chunk)
+    out.flush()
+    out.seek(0)
+    return {
+        "content_length": resp.get("ContentLength"),
+        "content_type": resp.get("ContentType"),
+        "key": key,
+        "bucket": bucket,
+    }
+
+
+def download_to_spool(s3_client, bucket: str, key: str, spool_max_bytes: int = SPOOL_MAX_BYTES) -> Tuple[BinaryIO, Dict[str, Any]]:
+    """
+    Streams an object into a SpooledTemporaryFile: small files stay in memory,
+    larger ones spill to disk, and the body is never held as one bytes object.
+    Returns: (file_handle positioned at 0, meta). The caller closes the handle.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_max_bytes)
+    try:
+        meta = _stream_body(s3_client, bucket, key, spool)
+    except Exception:
+        spool.close()
+        raise
+    return spool, meta
+
+
+def download_to_tempfile(s3_client, bucket: str, key: str, directory: str = None) -> Tuple[str, Dict[str, Any]]:
+    """
+    Streams an object into a named temp file, so another process can mmap it.
+    Returns: (path, meta). The caller deletes the file.
+    """
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            meta = _stream_body(s3_client, bucket, key, f)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, meta
+
+
+# --- Text Extraction ---
+def open_pdf(source: Union[bytes, BinaryIO]) -> PdfReader:
+    """
+    Opens a PDF from raw bytes or a binary file handle,
+    attempting an empty-password decrypt for encrypted files.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    reader = PdfReader(source)
+
+    try:
+        if getattr(reader, "is_encrypted", False):
+            try:
+                reader.decrypt("")
+            except Exception:
+                pass
+    except Exception:
+        pass
+
+    return reader
+
+
+class PageTimeout(BaseException):
+    """
+    Raised from the SIGALRM handler in the middle of pypdf code. A
+    BaseException (like KeyboardInterrupt), so pypdf's own `except Exception`
+    handlers cannot swallow it; _extract_pages catches it explicitly.
+    """
+
+
+def _raise_page_timeout(signum, frame):
+    raise PageTimeout()
+
+
+def _extract_page(reader: PdfReader, i: int, timeout: float) -> str:
+    """
+    Text of page i. The timeout is enforced with SIGALRM, so it only applies
+    in a process's main thread (the sequential path and pool workers).
+    """
+    if not timeout or threading.current_thread() is not threading.main_thread():
+        return reader.pages[i].extract_text() or ""
+    previous = signal.signal(signal.SIGALRM, _raise_page_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return reader.pages[i].extract_text() or ""
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _extract_pages(reader: PdfReader, start: int, stop: int, timeout: float) -> Tuple[List[str], List[int]]:
+    """
+    Texts of pages [start, stop). A page that fails or times out is left
+    empty and its 1-based number is returned in failed_pages, so one bad
+    page never costs the rest of the document.
+    Returns: (pages_list, failed_pages)
+    """
+    pages, failed = [], []
+    for i in range(start, stop):
+        try:
+            pages.append(_extract_page(reader, i, timeout))
+        except PageTimeout:
+            logging.warning(f"Page {i + 1} timed out after {timeout}s; skipped.")
+            pages.append("")
+            failed.append(i + 1)
+        except Exception as e:
+            logging.warning(f"Page {i + 1} could not be extracted; skipped: {e}")
+            pages.append("")
+            failed.append(i + 1)
+    return pages, failed
+
+
+def extract_pdf_text(source: Union[bytes, BinaryIO], max_pages: int = None, page_timeout: float = PAGE_TIMEOUT_SECONDS) -> Tuple[List[str], int, List[int]]:
+    """
+    Extracts the text of every page (up to max_pages).
+    Pages past max_pages are never parsed.
+    Returns: (pages_list, n_pages_total, failed_pages)
+    """
+    reader = open_pdf(source)
+    n_pages_total = len(reader.pages)
+    pages, failed = _extract_pages(reader, 0, min(n_pages_total, max_pages or n_pages_total), page_timeout)
+    return pages, n_pages_total, failed
+
+
+def extract_pdf_file(path: str, max_pages: int = None, page_timeout: float = PAGE_TIMEOUT_SECONDS) -> Tuple[List[str], int, List[int], int]:
+    """
+    Extracts text from a PDF on disk through a read-only mmap, so the file is
+    paged in by the OS instead of being copied into the process.
+    Returns: (pages_list, n_pages_total, failed_pages, peak_rss_kb for this document)
+    """
+    reset_peak_rss()
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pages, n_pages_total, failed = extract_pdf_text(mm, max_pages, page_timeout)
+    return pages, n_pages_total, failed, peak_rss_kb()
+
+
+def extract_pdf_bytes(body: bytes, max_pages: int = None, page_timeout: float = PAGE_TIMEOUT_SECONDS) -> Tuple[List[str], int, List[int], int]:
+    """
+    In-memory counterpart of extract_pdf_file.
+    Returns: (pages_list, n_pages_total, failed_pages, peak_rss_kb for this document)
+    """
+    reset_peak_rss()
+    pages, n_pages_total, failed = extract_pdf_text(body, max_pages, page_timeout)
+    return pages, n_pages_total, failed, peak_rss_kb()
+
+
+# --- Page Fan-out ---
+# A long document is split into page ranges that run as separate pool tasks,
+# so it no longer ties up one core while the other workers sit idle.
+def count_pages(path: str) -> int:
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return len(open_pdf(mm).pages)
+
+
+def extract_page_range(path: str, start: int, stop: int, page_timeout: float = PAGE_TIMEOUT_SECONDS) -> Tuple[List[str], List[int], int]:
+    """
+    Pool task: texts of pages [start, stop) of the PDF at `path`.
+    Returns: (pages_list, failed_pages, peak_rss_kb)
+    """
+    reset_peak_rss()
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pages, failed = _extract_pages(open_pdf(mm), start, stop, page_timeout)
+    return pages, failed, peak_rss_kb()
+
+
+def submit_page_ranges(pool: Executor, path: str, n_pages_total: int, max_pages: int = None,
+                       pages_per_task: int = PAGES_PER_TASK, page_timeout: float = PAGE_TIMEOUT_SECONDS) -> List[Tuple[int, int, Future]]:
+    """Submits one extract_page_range task per `pages_per_task` pages; returns [(start, stop, future)]."""
+    n = min(n_pages_total, max_pages or n_pages_total)
+    return [
+        (start, min(start + pages_per_task, n), pool.submit(extract_page_range, path, start, min(start + pages_per_task, n), page_timeout))
+        for start in range(0, n, max(1, pages_per_task))
+    ]
+
+
+def gather_page_ranges(ranges: List[Tuple[int, int, Future]]) -> Tuple[List[str], List[int], int]:
+    """
+    Joins the results of submit_page_ranges in page order. Slow pages already
+    time out inside the workers; a task that fails as a whole (e.g. its worker
+    died) marks its pages as failed instead of failing the document.
+    Returns: (pages_list, failed_pages, max peak_rss_kb of the tasks)
+    """
+    pages, failed, peak = [], [], 0
+    for start, stop, future in ranges:
+        try:
+            part, part_failed, part_peak = future.result()
+            pages.extend(part)
+            failed.extend(part_failed)
+            peak = max(peak, part_peak)
+        except Exception as e:
+            logging.warning(f"Pages {start + 1}-{stop} could not be extracted; skipped: {e!r}")
+            pages.extend([""] * (stop - start))
+            failed.extend(range(start + 1, stop + 1))
+    return pages, failed, peak
+
+
+def extract_pdf_file_parallel(path: str, pool: Executor, max_pages: int = None, page_timeout: float = PAGE_TIMEOUT_SECONDS) -> Tuple[List[str], int, List[int], int]:
+    """
+    extract_pdf_file with documents longer than PAGE_FANOUT_MIN_PAGES split
+    across `pool`. Returns: (pages_list, n_pages_total, failed_pages, peak_rss_kb)
+    """
+    n_pages_total = count_pages(path)
+    if n_pages_total <= PAGE_FANOUT_MIN_PAGES:
+        return pool.submit(extract_pdf_file, path, max_pages, page_timeout).result()
+    pages, failed, peak = gather_page_ranges(submit_page_ranges(pool, path, n_pages_total, max_pages, page_timeout=page_timeout))
+    return pages, n_pages_total, failed, peak
@@ -1,22 +1,23 @@
 import os
 import sys
 import json
+import hashlib
 import logging
-from typing import List, Dict
-from sentence_transformers import SentenceTransformer
-from transformers import AutoTokenizer
+from bisect import bisect_right
+from typing import List, Dict, Iterable, Tuple, Set, TYPE_CHECKING
 
 sys.path.append(os.path.abspath(os.path.join(os.getcwd(), '../credentials')))
 from credentials import MILVUS_HOST, MILVUS_PORT, COLLECTION_NAME
 
-from pymilvus import (
-    MilvusClient,
-    DataType,
-    connections,
-    CollectionSchema,
-    FieldSchema,
-    Collection
-)
+import models
+import metrics
+from milvus_pool import get_client, milvus_uri, touch_write_stamp, BufferedWriter
+from embedding_cache import EmbeddingCache, EMBEDDING_CACHE_PATH
+from bill_fields import extract_bill_fields
+
+if TYPE_CHECKING:
+    from pymilvus import MilvusClient
+    from etag_manifest import EtagManifest
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', filename = 'pipeline.log', filemode = 'a')
@@ -24,112 +25,397 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # --- Configuration ---
 MODEL_NAME = 'nomic-ai/nomic-embed-text-v1.5'
 MAX_TOKENS = 8192
-VECTOR_DIMENSION = 768 # For a 1000 token chunk size, a 200 token overlap is considered
+VECTOR_DIMENSION = models.EMBEDDING_DIM # 768, or a Matryoshka size (512/256/128) set via EMBEDDING_DIM
+# For a 1000 token chunk size, a 200 token overlap is considered
 CHUNK_SIZE = 1000  
 CHUNK_OVERLAP = 200
+EMBED_BATCH_SIZE = 32 # Number of chunks sent through the model per forward pass
 
 SEARCH_DOCUMENT_PREFIX = "search_document: "
 
 MILVUS_HOST = MILVUS_HOST
 MILVUS_PORT = MILVUS_PORT
 COLLECTION_NAME = COLLECTION_NAME
+MILVUS_URI = milvus_uri(MILVUS_HOST, MILVUS_PORT)
 
-logging.info("Loading embedding model and tokenizer...")
-try:
-    model = SentenceTransformer(MODEL_NAME, trust_remote_code=True)
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, trust_remote_code=True)
-except Exception as e:
-    logging.error(f"Failed to load model or tokenizer: {e}")
-    raise e
+# --- Lazily Loaded Resources ---
+# Nothing heavy happens at import time; the model and tokenizer are process-wide
+# singletons (shared with the retrieval side) loaded on first use or by warmup().
+_embedding_cache = None
+
+def get_model():
+    try:
+        return models.get_embedding_model(MODEL_NAME)
+    except Exception as e:
+        logging.error(f"Failed to load model: {e}")
+        raise e
+
+def get_tokenizer():
+    try:
+        return models.get_tokenizer(MODEL_NAME)
+    except Exception as e:
+        logging.error(f"Failed to load tokenizer: {e}")
+        raise e
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Persistent cache in front of model.encode; set EMBEDDING_CACHE_PATH="" to disable it."""
+    global _embedding_cache
+    if _embedding_cache is None and EMBEDDING_CACHE_PATH:
+        _embedding_cache = EmbeddingCache(models.embedding_model_id(MODEL_NAME), EMBEDDING_CACHE_PATH)
+    return _embedding_cache
+
+def warmup():
+    """Loads the model and tokenizer up front instead of on the first document."""
+    logging.info("Loading embedding model and tokenizer...")
+    get_model()
+    get_tokenizer()
 
 # --- Text Chunking and Token Management ---
-def _chunk_text(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+PAGE_SEPARATOR = "\n\n" # Must match how read_pdf_from_s3_bytes joins pages into full_text
+
+def _page_starts(pages: List[str]) -> List[int]:
+    """
+    (Internal helper function)
+    Returns the character offset at which every page begins inside
+    PAGE_SEPARATOR.join(pages).
+    """
+    starts, offset = [], 0
+    for page in pages:
+        starts.append(offset)
+        offset += len(page) + len(PAGE_SEPARATOR)
+    return starts
+
+def _chunk_text(text: str, chunk_size: int, chunk_overlap: int, page_starts: List[int] = None) -> List[Dict]:
     """
     (Internal helper function)
     Splits a large text into smaller chunks with a specified overlap.
+    Windows are cut straight out of the original string using the tokenizer's
+    offset mapping, so every chunk is an exact substring of `text`.
+    Returns dicts with the chunk text, its [char_start, char_end) span and the
+    1-based pages the chunk starts and ends on (when page_starts is given).
     """
     logging.info(f"Splitting text into chunks of size {chunk_size} with overlap of {chunk_overlap}.")
-    
-    tokens = tokenizer.encode(text)
-    token_count = len(tokens)
-    
-    chunks = []
-    
+    with metrics.timed("chunk"):
+        chunks = _split_by_tokens(text, chunk_size, chunk_overlap, page_starts)
+    metrics.CHUNKS.inc(len(chunks))
+    logging.info(f"Original text split into {len(chunks)} chunks.")
+    return chunks
+
+def _split_by_tokens(text: str, chunk_size: int, chunk_overlap: int, page_starts: List[int] = None) -> List[Dict]:
+    encoding = get_tokenizer()(text, add_special_tokens=False, return_offsets_mapping=True)
+    offsets = encoding["offset_mapping"]
+    token_count = len(offsets)
+
+    def _make_chunk(char_start: int, char_end: int) -> Dict:
+        page = bisect_right(page_starts, char_start) if page_starts else None
+        page_end = bisect_right(page_starts, max(char_start, char_end - 1)) if page_starts else None
+        return {"text": text[char_start:char_end], "char_start": char_start, "char_end": char_end, "page": page, "page_end": page_end}
+
+    if token_count == 0:
+        return []
+
     # Check if the entire text already fits within a single chunk
     if token_count <= chunk_size:
-        return [text]
+        return [_make_chunk(0, len(text))]
+
+    chunks = []
 
     # Use a sliding window to create chunks with overlap
     for i in range(0, token_count, chunk_size - chunk_overlap):
-        chunk_tokens = tokens[i : i + chunk_size]
-        chunk_text = tokenizer.decode(chunk_tokens, skip_special_tokens=True)
-        chunks.append(chunk_text)
+        end = min(i + chunk_size, token_count)
+        chunks.append(_make_chunk(offsets[i][0], offsets[end - 1][1]))
 
-    logging.info(f"Original text split into {len(chunks)} chunks.")
+        # The window reached the end of the text; any further window would lie inside this one's overlap
+        if end == token_count:
+            break
     return chunks
 
-# --- Main Vectorization & Insertion Function ---
-def convert_to_vectors(key: str, filename: str, full_text: str):
+# --- Batched Embedding ---
+def _encode_chunks(chunks: List[str], batch_size: int = EMBED_BATCH_SIZE) -> List[List[float]]:
     """
-    Takes a file key, filename, and the full text of a document,
-    chunks it, converts the chunks to vectors, and inserts them into Milvus.
+    (Internal helper function)
+    Encodes all chunks in as few forward passes as possible. If the batched
+    call fails, falls back to encoding chunk by chunk so a single bad chunk
+    only drops itself (None is returned in its slot).
     """
-    # Defensive check for valid inputs
-    if not key or not filename or not full_text:
-        logging.warning("Skipping vectorization and insertion. Missing key, filename, or text input.")
-        return
+    if not chunks:
+        return []
 
-    # Chunk the raw text to ensure each piece fits the model's token limit
-    chunks = _chunk_text(full_text, CHUNK_SIZE, CHUNK_OVERLAP)
-    
-    milvus_payload = []
+    model = get_model()
+    prefixed_chunks = [SEARCH_DOCUMENT_PREFIX + chunk for chunk in chunks]
+    try:
+        vectors = model.encode(prefixed_chunks, batch_size=batch_size)
+        return [vector.tolist() for vector in vectors]
+    except Exception as e:
+        logging.error(f"Batched encoding of {len(chunks)} chunks failed, retrying one by one: {e}")
 
-    for i, chunk in enumerate(chunks):
-        # Apply the task-specific prefix for RAG
-        prefixed_chunk = SEARCH_DOCUMENT_PREFIX + chunk
-        
-        # Generate the vector embedding
+    vectors = []
+    for i, prefixed_chunk in enumerate(prefixed_chunks):
         try:
-            vector = model.encode(prefixed_chunk).tolist()
+            vectors.append(model.encode(prefixed_chunk).tolist())
         except Exception as e:
-            logging.error(f"Failed to encode chunk for {filename}, chunk {i}: {e}")
+            logging.error(f"Failed to encode chunk {i}: {e}")
+            vectors.append(None)
+    return vectors
+
+def _reduce_dimension(vectors: List[List[float]]) -> List[List[float]]:
+    """Matryoshka-truncates full-size vectors to VECTOR_DIMENSION (same transform as the query side)."""
+    if VECTOR_DIMENSION >= models.NATIVE_DIM:
+        return vectors
+    return [models.reduce_dimension(vector, VECTOR_DIMENSION).tolist() if vector is not None else None for vector in vectors]
+
+def _embed_chunks(chunks: List[str], batch_size: int = EMBED_BATCH_SIZE) -> List[List[float]]:
+    """
+    (Internal helper function)
+    Looks every chunk up in the embedding cache and only runs the model on
+    the distinct chunks that are not cached yet. The cache holds full-size
+    vectors, so changing EMBEDDING_DIM does not invalidate it.
+    """
+    embedding_cache = get_embedding_cache()
+    if embedding_cache is None:
+        with metrics.timed("embed"):
+            return _reduce_dimension(_encode_chunks(chunks, batch_size=batch_size))
+
+    vectors = embedding_cache.get_many(SEARCH_DOCUMENT_PREFIX, chunks)
+    novel = list(dict.fromkeys(chunk for chunk, vector in zip(chunks, vectors) if vector is None))
+    misses = sum(vector is None for vector in vectors)
+    metrics.count_cache("embedding", hits=len(chunks) - misses, misses=misses)
+    if novel:
+        with metrics.timed("embed"):
+            novel_vectors = _encode_chunks(novel, batch_size=batch_size)
+        embedding_cache.put_many(SEARCH_DOCUMENT_PREFIX, novel, novel_vectors)
+        by_text = dict(zip(novel, novel_vectors))
+        vectors = [vector if vector is not None else by_text[chunk] for chunk, vector in zip(chunks, vectors)]
+
+    logging.info(f"Embedded {len(chunks)} chunks ({len(novel)} encoded, the rest from cache); cache {embedding_cache.stats()}")
+    return _reduce_dimension(vectors)
+
+def chunk_hash(text: str) -> str:
+    """Content hash stored with every row; equal hashes mean the chunk (and its vector) is unchanged."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+def _chunk_document(full_text: str, pages: List[str] = None) -> List[Dict]:
+    page_starts = _page_starts(pages) if pages else None
+    return _chunk_text(full_text, CHUNK_SIZE, CHUNK_OVERLAP, page_starts=page_starts)
+
+def _document_fields(full_text: str, pages: List[str] = None) -> Dict[str, str]:
+    """Account and billing month of a bill, stored on every row (partition key); "" when not recognised."""
+    fields = extract_bill_fields(pages or [full_text])
+    return {"account": (fields["account"] or "")[:32], "billing_month": fields["billing_month"] or ""}
+
+def _make_row(key: str, filename: str, i: int, chunk: Dict, vector: List[float], fields: Dict[str, str]) -> Dict:
+    return {
+        "ETag": key,
+        "filename": filename,
+        "chunk_id": i,
+        "account": fields["account"],
+        "billing_month": fields["billing_month"],
+        "chunk_hash": chunk_hash(chunk["text"]),
+        "text": chunk["text"],
+        "char_start": chunk["char_start"],
+        "char_end": chunk["char_end"],
+        "page": chunk["page"],
+        "page_end": chunk["page_end"],
+        "vector": vector,
+    }
+
+def build_payloads(documents: Iterable[Tuple], batch_size: int = EMBED_BATCH_SIZE) -> List[Dict]:
+    """
+    Takes (key, filename, full_text) or (key, filename, full_text, pages) tuples,
+    chunks every document and embeds the chunks of all documents together, so
+    several small bills share one batch. Returns the Milvus rows in document order.
+    """
+    owners, all_chunks = [], []
+    for key, filename, full_text, *rest in documents:
+        pages = rest[0] if rest else None
+        # Defensive check for valid inputs
+        if not key or not filename or not full_text:
+            logging.warning("Skipping vectorization. Missing key, filename, or text input.")
+            continue
+
+        # Chunk the raw text to ensure each piece fits the model's token limit
+        chunks = _chunk_document(full_text, pages)
+        fields = _document_fields(full_text, pages)
+        for i, chunk in enumerate(chunks):
+            owners.append((key, filename, i, fields))
+            all_chunks.append(chunk)
+
+    vectors = _embed_chunks([chunk["text"] for chunk in all_chunks], batch_size=batch_size)
+
+    milvus_payload = []
+    for (key, filename, i, fields), chunk, vector in zip(owners, all_chunks, vectors):
+        if vector is None:
+            logging.error(f"Dropping chunk {i} of {filename}: no vector was produced.")
             continue
 
         # Prepare the payload for insertion into Milvus
-        payload_entry = {
-            "ETag": key,
-            "filename": filename,
-            "chunk_id": i,
-            "text": chunk, 
-            "vector": vector,
-        }
-        milvus_payload.append(payload_entry)
-        
-    logging.info(f"Created a total of {len(milvus_payload)} vectors for file '{filename}'.")
+        milvus_payload.append(_make_row(key, filename, i, chunk, vector, fields))
+    return milvus_payload
 
-    # Connect to Milvus and insert the payload
+def insert_payload(milvus_payload: List[Dict]):
+    """
+    Inserts prepared rows into the Milvus collection.
+    """
     if not milvus_payload:
         logging.info("Payload is empty. Skipping Milvus insertion.")
         return
 
     try:
-        logging.info(f"Connecting to Milvus at {MILVUS_HOST}:{MILVUS_PORT}...")
-        client = MilvusClient(
-            uri=f"http://{MILVUS_HOST}:{MILVUS_PORT}"
-        )
-        
+        client = get_client(MILVUS_URI)
+
         logging.info(f"Inserting {len(milvus_payload)} vectors into collection '{COLLECTION_NAME}'...")
-        client.insert(
-            collection_name=COLLECTION_NAME,
-            data=milvus_payload
-        )
-        
+        with metrics.timed("insert"):
+            client.insert(
+                collection_name=COLLECTION_NAME,
+                data=milvus_payload
+            )
+        touch_write_stamp(COLLECTION_NAME)
+        metrics.ROWS.inc(len(milvus_payload), collection=COLLECTION_NAME)
+
         logging.info("Data insertion successful.")
         
     except Exception as e:
+        metrics.FAILURES.inc(stage="insert")
         logging.error(f"An error occurred during Milvus insertion: {e}")
         raise e
 
+# --- Main Vectorization & Insertion Function ---
+def convert_to_vectors(key: str, filename: str, full_text: str, pages: List[str] = None, batch_size: int = EMBED_BATCH_SIZE, writer: BufferedWriter = None):
+    """
+    Takes a file key, filename, and the full text of a document,
+    chunks it, converts the chunks to vectors, and inserts them into Milvus.
+    Pass the per-page texts that full_text was joined from to record source pages.
+    With a BufferedWriter the rows are queued for a bulk insert instead of
+    being inserted right away.
+    """
+    # Defensive check for valid inputs
+    if not key or not filename or not full_text:
+        logging.warning("Skipping vectorization and insertion. Missing key, filename, or text input.")
+        return
+
+    with metrics.span("vectorize", metrics.trace_id_for(key), key=filename):
+        milvus_payload = build_payloads([(key, filename, full_text, pages)], batch_size=batch_size)
+        logging.info(f"Created a total of {len(milvus_payload)} vectors for file '{filename}'.")
+
+        if writer is not None:
+            writer.add(milvus_payload)
+        else:
+            insert_payload(milvus_payload)
+    metrics.DOCUMENTS.inc(stage="vectorize", result="ok" if milvus_payload else "empty")
+
+# --- Delta Re-ingestion ---
+UPSERT_QUERY_LIMIT = 16384 # Milvus caps a single query at 16384 rows
+
+def _filename_filter(filenames: Iterable[str]) -> str:
+    return "filename in [" + ",".join(json.dumps(f) for f in filenames) + "]"
+
+def _stored_rows(client: "MilvusClient", collection_name: str, filenames: List[str]) -> Dict[str, List[Dict]]:
+    """Current rows of each filename: id, ETag, chunk_id and chunk hash (computed from the text for older rows)."""
+    rows = client.query(
+        collection_name=collection_name,
+        filter=_filename_filter(filenames),
+        output_fields=["id", "ETag", "filename", "chunk_id", "chunk_hash", "text"],
+        limit=UPSERT_QUERY_LIMIT,
+    )
+    if len(rows) >= UPSERT_QUERY_LIMIT:
+        raise RuntimeError(f"{len(filenames)} files have {UPSERT_QUERY_LIMIT}+ stored rows; upsert fewer documents per batch.")
+    by_filename: Dict[str, List[Dict]] = {}
+    for row in rows:
+        row["chunk_hash"] = row.get("chunk_hash") or chunk_hash(row.get("text") or "")
+        by_filename.setdefault(row["filename"], []).append(row)
+    return by_filename
+
+def upsert_documents(
+    documents: Iterable[Tuple],
+    client: "MilvusClient" = None,
+    collection_name: str = COLLECTION_NAME,
+    writer: BufferedWriter = None,
+    manifest: "EtagManifest" = None,
+    batch_size: int = EMBED_BATCH_SIZE,
+) -> Dict[str, int]:
+    """
+    Replaces the stored version of each (key, filename, full_text[, pages])
+    document, keyed by filename, touching only what changed:
+      - stored rows whose (chunk_id, chunk_hash) still occur are kept as they are,
+      - only new or changed chunks are embedded and inserted,
+      - every other row of the filename (old chunks, duplicate copies from
+        earlier appends) is deleted in one bulk call after the new rows are in.
+    Kept rows retain the ETag of the version that produced them. With a
+    manifest, the new ETags are recorded and ETags left without rows are
+    discarded. Returns {"documents", "added", "removed", "reused"}.
+    """
+    report = {"documents": 0, "added": 0, "removed": 0, "reused": 0}
+    documents = [doc for doc in documents if doc[0] and doc[1] and doc[2]]
+    if not documents:
+        return report
+    client = client or (writer.client if writer is not None else get_client(MILVUS_URI))
+    stored = _stored_rows(client, collection_name, list(dict.fromkeys(doc[1] for doc in documents)))
+
+    owners, pending, stale_ids = [], [], []
+    kept_etags: Set[str] = set()
+    removed_etags: Set[str] = set()
+    for key, filename, full_text, *rest in documents:
+        available: Dict[Tuple, List[Dict]] = {}
+        for row in stored.pop(filename, []):
+            available.setdefault((row["chunk_id"], row["chunk_hash"]), []).append(row)
+
+        pages = rest[0] if rest else None
+        fields = _document_fields(full_text, pages)
+        for i, chunk in enumerate(_chunk_document(full_text, pages)):
+            match = available.get((i, chunk_hash(chunk["text"])))
+            if match:
+                kept_etags.add(match.pop()["ETag"])
+                report["reused"] += 1
+            else:
+                owners.append((key, filename, i, fields))
+                pending.append(chunk)
+
+        for rows in available.values():
+            for row in rows:
+                stale_ids.append(row["id"])
+                removed_etags.add(row["ETag"])
+        report["documents"] += 1
+
+    vectors = _embed_chunks([chunk["text"] for chunk in pending], batch_size=batch_size)
+    new_rows = []
+    for (key, filename, i, fields), chunk, vector in zip(owners, pending, vectors):
+        if vector is None:
+            logging.error(f"Dropping chunk {i} of {filename}: no vector was produced.")
+            continue
+        new_rows.append(_make_row(key, filename, i, chunk, vector, fields))
+
+    # Insert before deleting, so readers never see a document with no rows
+    if writer is not None:
+        writer.add(new_rows)
+        writer.flush()
+    else:
+        insert_payload(new_rows)
+    if stale_ids:
+        for i in range(0, len(stale_ids), 1000):
+            client.delete(collection_name=collection_name, ids=stale_ids[i:i + 1000])
+        touch_write_stamp(collection_name)
+
+    report["added"] = len(new_rows)
+    report["removed"] = len(stale_ids)
+    if manifest is not None:
+        manifest.add_many({(key, filename) for key, filename, *_ in documents})
+        gone = removed_etags - kept_etags - {key for key, *_ in documents}
+        if gone:
+            manifest.discard_many(gone)
+    logging.info(f"Upserted {report['documents']} documents: {report}")
+    return report
+
+def convert_many_to_vectors(documents: Iterable[Tuple], batch_size: int = EMBED_BATCH_SIZE):
+    """
+    Batch variant of convert_to_vectors for backfills: embeds the chunks of
+    several (key, filename, full_text[, pages]) documents together and inserts them
+    with a single Milvus call.
+    """
+    milvus_payload = build_payloads(documents, batch_size=batch_size)
+    logging.info(f"Created a total of {len(milvus_payload)} vectors across the document batch.")
+
+    insert_payload(milvus_payload)
+
 # --- Example Usage (for local testing) ---
 if __name__ == "__main__":
     example_key = "oci_file_key_12345"
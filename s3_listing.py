@@ -0,0 +1,204 @@
+import os
+import json
+import string
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Generator, List, Optional, Tuple
+
+# --- Sharding ---
+# Prefix shards split the key space at first characters typical of object keys.
+# Ranges are contiguous and the first and last are open-ended, so every key
+# (upper case, punctuation, non-ASCII included) belongs to exactly one shard.
+_PREFIX_ALPHABET = string.digits + string.ascii_lowercase
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """Parses "i/N" (0-based shard index i out of N)."""
+    try:
+        index, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{spec}', expected 'i/N'.")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{spec}', need 0 <= i < N.")
+    return index, count
+
+
+def key_hash_shard(key: str, count: int) -> int:
+    """Stable across processes and hosts (unlike the builtin hash())."""
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big") % count
+
+
+def prefix_range(index: int, count: int) -> Tuple[Optional[str], Optional[str]]:
+    """Returns the [lo, hi) key range owned by a prefix shard; None means unbounded."""
+    n = len(_PREFIX_ALPHABET)
+    lo = _PREFIX_ALPHABET[index * n // count] if index > 0 else None
+    hi = _PREFIX_ALPHABET[(index + 1) * n // count] if index + 1 < count else None
+    return lo, hi
+
+
+def _start_after_for(lo: str) -> str:
+    # Sorts after (nearly) every key of the previous range but before any key >= lo
+    return chr(ord(lo[0]) - 1) + "~" * 8
+
+
+class ShardSpec:
+    """Which part of the bucket a worker owns: by key hash or by key prefix range."""
+
+    def __init__(self, index: int = 0, count: int = 1, mode: str = "hash"):
+        if mode not in ("hash", "prefix"):
+            raise ValueError(f"Unknown shard mode '{mode}'.")
+        self.index, self.count, self.mode = index, count, mode
+        self.lo, self.hi = prefix_range(index, count) if mode == "prefix" else (None, None)
+
+    @property
+    def label(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    # Keys passed to owns/past_end are relative to the listing prefix
+    def owns(self, key: str) -> bool:
+        if self.count == 1:
+            return True
+        if self.mode == "hash":
+            return key_hash_shard(key, self.count) == self.index
+        return (self.lo is None or key >= self.lo) and (self.hi is None or key < self.hi)
+
+    def past_end(self, key: str) -> bool:
+        """True once a (sorted) listing has moved beyond this shard's range."""
+        return self.mode == "prefix" and self.hi is not None and key >= self.hi
+
+    def start_after(self, resume_key: str = None, prefix: str = "") -> Optional[str]:
+        candidates = [k for k in (resume_key, prefix + _start_after_for(self.lo) if self.lo else None) if k]
+        return max(candidates) if candidates else None
+
+
+# --- Checkpointing ---
+class ListingCheckpoint:
+    """
+    Persists the last key of a shard's listing below which every object has
+    been completed (ingested or skipped), so a restarted worker can resume
+    with StartAfter. Keys finish out of order in the pipeline; the checkpoint
+    only advances over an unbroken run of completed keys, and never past a
+    failed one: a resumed run lists the first failure again and retries it.
+    Failed keys are kept in the checkpoint file under "failed".
+    """
+
+    def __init__(self, path: str, shard: ShardSpec, save_every: float = 10.0):
+        self.path = path
+        self.shard = shard
+        self.save_every = save_every
+        self.last_key = None
+        self.counts = {"listed": 0, "new": 0, "done": 0, "failed": 0}
+        self.failed_keys: List[str] = []
+
+        # key -> False while in flight, then "done" or "failed"
+        self._pending: "OrderedDict[str, Any]" = OrderedDict()
+        self._stalled = False  # a failed key was reached; last_key stays before it
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._last_save = 0.0
+
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get("shard") != shard.label or state.get("mode") != shard.mode:
+                raise ValueError(f"Checkpoint {path} belongs to shard {state.get('shard')} ({state.get('mode')}).")
+            self.last_key = state.get("last_key")
+            self.counts.update(state.get("counts", {}))
+            self.counts["failed"] = 0  # the previous run's failures lie after last_key and are listed again
+
+    @staticmethod
+    def path_for(directory: str, shard: ShardSpec) -> str:
+        return os.path.join(directory, f"listing_{shard.mode}_{shard.index}_of_{shard.count}.json")
+
+    def listed(self, key: str, new: bool):
+        with self._lock:
+            self.counts["listed"] += 1
+            if new:
+                self.counts["new"] += 1
+            self._pending[key] = False
+        if not new:
+            self.done(key)
+
+    def done(self, key: str):
+        self._finish(key, "done")
+
+    def failed(self, key: str):
+        """Records a key that could not be ingested; the checkpoint stops short of it."""
+        self._finish(key, "failed")
+
+    def _finish(self, key: str, result: str):
+        with self._lock:
+            if self._pending.get(key) is not False:
+                if result == "failed" and key not in self.failed_keys:
+                    # Part of it failed after its first rows were reported done
+                    self.failed_keys.append(key)
+                    self.counts["failed"] += 1
+                return  # not in flight, or already reported
+            self._pending[key] = result
+            self.counts[result] += 1
+            if result == "failed":
+                self.failed_keys.append(key)
+            while self._pending:
+                first_key, finished = next(iter(self._pending.items()))
+                if not finished:
+                    break
+                self._pending.popitem(last=False)
+                if finished == "failed":
+                    self._stalled = True
+                elif not self._stalled:
+                    self.last_key = first_key
+            due = time.monotonic() - self._last_save >= self.save_every
+            if due:
+                self._last_save = time.monotonic()
+        if due:
+            self.save()
+
+    def progress(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"shard": self.shard.label, "mode": self.shard.mode, "last_key": self.last_key,
+                    "in_flight": len(self._pending), "counts": dict(self.counts), "failed": list(self.failed_keys)}
+
+    def save(self):
+        # One writer at a time: pipeline threads share the .tmp file
+        with self._save_lock:
+            state = self.progress()
+            state["updated_at"] = time.time()
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+            self._last_save = time.monotonic()
+        logging.info(f"[shard {state['shard']}] checkpoint at {state['last_key']!r} {state['counts']}")
+
+
+def iter_listing(s3_client, bucket: str, prefix: str = "", shard: ShardSpec = None, resume_key: str = None) -> Generator[Dict[str, Any], None, None]:
+    """
+    Yields listing pages restricted to the objects owned by `shard`, starting
+    after `resume_key`. Prefix shards start listing at their range and stop at
+    its end instead of walking the whole bucket.
+    """
+    shard = shard or ShardSpec()
+    prefix = prefix or ""
+    params = {"Bucket": bucket, "Prefix": prefix}
+    start_after = shard.start_after(resume_key, prefix)
+    if start_after:
+        params["StartAfter"] = start_after
+
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(**params):
+        contents = page.get("Contents", []) or []
+        owned = []
+        for obj in contents:
+            key = obj.get("Key", "")
+            if shard.past_end(key[len(prefix):]):
+                if owned:
+                    yield {**page, "Contents": owned}
+                return
+            if resume_key and key <= resume_key:
+                continue
+            if shard.owns(key[len(prefix):]):
+                owned.append(obj)
+        yield {**page, "Contents": owned}
@@ -0,0 +1,67 @@
+# --- Test setup ---
+# The modules read their Milvus / object storage settings from a `credentials`
+# module that lives outside the repo; like benchmarks/bench_e2e.py, the tests
+# write one into a scratch directory before anything imports it. Embedding
+# and chunking are replaced per test (see fake_embeddings), so neither the
+# model nor its tokenizer is needed.
+
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+WORKDIR = tempfile.mkdtemp(prefix="rag_tests_")
+
+os.environ.update({
+    "MILVUS_WRITE_STAMP_DIR": os.path.join(WORKDIR, "stamps"),
+    "EMBEDDING_CACHE_PATH": "",
+    "RAG_ANSWER_CACHE": "0",
+    "RAG_HISTORY_DB": "",
+})
+with open(os.path.join(WORKDIR, "credentials.py"), "w") as f:
+    f.write(
+        "MILVUS_HOST = 'localhost'\nMILVUS_PORT = '19530'\nCOLLECTION_NAME = 'test_bills'\n"
+        "ORACLE_S3_ACCESS_KEY = ORACLE_S3_SECRET_KEY = 'test'\nORACLE_S3_ENDPOINT = None\n"
+        "ORACLE_REGION = 'us-east-1'\nORACLE_INGEST_BUCKET = 'test-bills'\n"
+    )
+sys.path[:0] = [WORKDIR, ROOT, os.path.join(ROOT, "llm_test"), os.path.join(ROOT, "benchmarks")]
+
+EMBEDDING_DIM = 8
+
+
+@pytest.fixture
+def fake_embeddings(monkeypatch):
+    """One chunk per page and deterministic vectors instead of the embedding model."""
+    import pdf_to_vector
+
+    def _chunk_document(full_text, pages=None):
+        return [{"text": p, "char_start": 0, "char_end": len(p), "page": i + 1, "page_end": i + 1}
+                for i, p in enumerate(pages or [full_text])]
+
+    def _embed_chunks(chunks, batch_size=32):
+        return [np.random.default_rng(len(c)).normal(size=EMBEDDING_DIM).tolist() for c in chunks]
+
+    monkeypatch.setattr(pdf_to_vector, "_chunk_document", _chunk_document)
+    monkeypatch.setattr(pdf_to_vector, "_embed_chunks", _embed_chunks)
+
+
+class FakeMilvusClient:
+    """Records inserted rows; insert raises while `down` is set."""
+
+    def __init__(self, down: bool = False):
+        self.down = down
+        self.rows = []
+
+    def insert(self, collection_name, data):
+        if self.down:
+            raise ConnectionError("Milvus is unavailable")
+        self.rows.extend(data)
+        return {"insert_count": len(data)}
+
+
+@pytest.fixture
+def milvus():
+    return FakeMilvusClient()
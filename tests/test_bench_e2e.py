@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+import bench_e2e
+from bench_e2e import StageTimer, compare
+from bill_fields import extract_bill_fields
+from pdf_extract import extract_pdf_bytes
+from synthetic_bills import generate_bills
+
+
+def _results(**stages):
+    return {"stages": {stage: {"p50_ms": p50, "p95_ms": p95, "items_per_s": rate} for stage, (p50, p95, rate) in stages.items()}}
+
+
+def test_synthetic_bills_extract_to_their_facts():
+    bills = generate_bills(4, pages=(1, 3), seed=3)
+    assert len({key for key, _, _ in bills}) == 4
+    for key, body, facts in bills:
+        pages, _, _, _ = extract_pdf_bytes(body)
+        found = extract_bill_fields(pages)
+        assert found["account"] == facts["account"]
+        assert found["kwh"] == facts["kwh"]
+        assert found["amount_due"] == facts["amount_due"]
+
+
+def test_stage_timer_summary():
+    timer = StageTimer()
+    for seconds in (0.010, 0.020, 0.030):
+        timer.record("embed", seconds, items=10)
+    with timer.time("list"):
+        pass
+
+    summary = timer.summary()
+    assert list(summary) == ["list", "embed"]  # pipeline order, not insertion order
+    assert summary["embed"]["calls"] == 3 and summary["embed"]["items"] == 30
+    assert summary["embed"]["p50_ms"] == pytest.approx(20.0)
+    assert summary["embed"]["max_ms"] == pytest.approx(30.0)
+    assert summary["embed"]["items_per_s"] == pytest.approx(500.0)
+
+
+def test_compare_flags_slowdowns_and_throughput_drops():
+    baseline = _results(embed=(10.0, 20.0, 500.0), insert=(5.0, 8.0, 2000.0), search=(0.2, 0.3, 100.0))
+    current = _results(embed=(13.0, 21.0, 490.0), insert=(5.1, 8.2, 1500.0), search=(0.4, 0.6, 100.0))
+
+    regressions = compare(baseline, current, tolerance=0.15)
+    assert any(r.startswith("embed p50_ms") for r in regressions)
+    assert any(r.startswith("insert items_per_s") for r in regressions)
+    assert not any(r.startswith("embed p95_ms") for r in regressions)
+    assert not any(r.startswith("search") for r in regressions)  # slower, but by less than min_ms
+    assert compare(baseline, baseline) == []
+
+
+def test_compare_command_exits_non_zero_on_regression(tmp_path):
+    old, new = tmp_path / "old.json", tmp_path / "new.json"
+    old.write_text(json.dumps(_results(extract=(50.0, 90.0, 40.0))))
+    new.write_text(json.dumps(_results(extract=(80.0, 90.0, 40.0))))
+
+    bench_e2e.main(["--compare", str(old), str(old)])
+    with pytest.raises(SystemExit) as exit_info:
+        bench_e2e.main(["--compare", str(old), str(new)])
+    assert exit_info.value.code == 1
@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+from synthetic_bills import generate_bills
+
+BUCKET = "test-bills"
+RUN_TIMEOUT = 120  # seconds; a stage that never sees _DONE hangs run()
+
+
+@pytest.fixture
+def s3():
+    boto3 = pytest.importorskip("boto3")
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1", aws_access_key_id="test", aws_secret_access_key="test")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def _upload(s3, n: int):
+    bills = generate_bills(n, pages=(1, 3), seed=1)
+    for key, body, _ in bills:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+    return [{"Key": obj["Key"], "ETag": obj["ETag"]} for obj in s3.list_objects_v2(Bucket=BUCKET)["Contents"]]
+
+
+def _run(s3, milvus, objects, **kwargs):
+    """Runs the pipeline in a thread so that a hang fails the test instead of the suite."""
+    from milvus_pool import BufferedWriter
+    from ingest_pipeline import IngestPipeline
+
+    done, failed, result = [], [], {}
+    writer = BufferedWriter(milvus, "test_bills", max_rows=4, max_interval=0, max_retries=0)
+    pipeline = IngestPipeline(s3, BUCKET, writer=writer, download_workers=2, extract_workers=1,
+                              on_done=done.append, on_failed=failed.append, **kwargs)
+    thread = threading.Thread(target=lambda: result.update(pipeline.run(iter(objects))), daemon=True)
+    thread.start()
+    thread.join(RUN_TIMEOUT)
+    assert not thread.is_alive(), "IngestPipeline.run() did not finish"
+    return result, done, failed, writer
+
+
+def test_all_documents_are_inserted(s3, milvus, fake_embeddings):
+    objects = _upload(s3, 3)
+    stats, done, failed, _ = _run(s3, milvus, objects)
+
+    assert stats["queued"] == stats["downloaded"] == stats["extracted"] == stats["embedded"] == 3
+    assert stats["failed"] == 0 and not failed
+    assert sorted(done) == sorted(obj["Key"] for obj in objects)
+    assert stats["rows_inserted"] == len(milvus.rows) > 0
+    assert {row["ETag"] for row in milvus.rows} == {obj["ETag"].strip('"') for obj in objects}
+
+
+def test_failing_download_is_reported_and_the_rest_ingested(s3, milvus, fake_embeddings):
+    objects = _upload(s3, 2) + [{"Key": "bills/missing.pdf", "ETag": '"0123456789abcdef"'}]
+    stats, done, failed, _ = _run(s3, milvus, objects)
+
+    assert failed == ["bills/missing.pdf"]
+    assert stats["failed"] == 1 and stats["embedded"] == 2
+    assert "bills/missing.pdf" not in done and len(done) == 2
+
+
+def test_malformed_listing_entry_does_not_stop_a_worker(s3, milvus, fake_embeddings):
+    objects = _upload(s3, 3)
+    objects.insert(1, {"Key": "bills/no-etag.pdf"})
+    stats, done, failed, _ = _run(s3, milvus, objects)
+
+    assert failed == ["bills/no-etag.pdf"]
+    assert stats["embedded"] == 3
+    assert len({row["ETag"] for row in milvus.rows}) == 3
+
+
+def test_insert_failure_fails_documents_without_hanging(s3, milvus, fake_embeddings):
+    objects = _upload(s3, 3)
+    milvus.down = True
+    stats, done, failed, writer = _run(s3, milvus, objects)
+
+    assert stats["embedded"] == 3
+    assert stats["failed"] == 3 and sorted(failed) == sorted(obj["Key"] for obj in objects)
+    assert stats["rows_inserted"] == 0 and not done
+    assert writer.discard() == []  # nothing left buffered
@@ -0,0 +1,62 @@
+import pytest
+
+pytest.importorskip("langchain_openai")
+llm_with_rag = pytest.importorskip("llm_with_rag")
+
+from llm_with_rag import ThinkStripper, strip_think
+
+RESPONSES = [
+    "<think>The bill is from March.</think>\n\nThe amount due is $84.20.",
+    "reasoning without an opening tag</think>\nAnswer",  # DeepSeek-R1 style
+    "A plain answer with no thoughts.",
+    "  <think>only thoughts, the stream was cut",
+    "<think>\n</think>",
+    "Mentions </think> late: kept after the tag",
+    "",
+]
+
+
+def _stream(text: str, size: int, hold: bool = True):
+    stripper = ThinkStripper(hold=hold)
+    shown = [stripper.feed(text[i:i + size]) for i in range(0, len(text), size)]
+    return shown, stripper.flush()
+
+
+@pytest.mark.parametrize("text", RESPONSES)
+@pytest.mark.parametrize("size", [1, 3, 1000])
+def test_streamed_output_equals_strip_think(text, size):
+    shown, rest = _stream(text, size)
+    assert "".join(shown) + rest == strip_think(text)
+
+
+def test_hold_keeps_everything_back_until_close_tag():
+    stripper = ThinkStripper()
+    assert stripper.feed("step one, ") == ""  # no <think>, yet nothing of the reasoning leaks
+    assert stripper.feed("step two") == ""
+    assert stripper.feed("</think>\n") == ""
+    assert stripper.feed("Answer") == "Answer"
+    assert stripper.flush() == ""
+
+
+def test_without_hold_plain_text_streams_immediately():
+    stripper = ThinkStripper(hold=False)
+    assert stripper.feed("Hello") == "Hello"
+    assert stripper.feed(" there") == " there"
+    assert stripper.flush() == ""
+
+
+def test_without_hold_a_leading_think_block_is_still_dropped():
+    shown, rest = _stream("<think>hidden</think>  visible", 2, hold=False)
+    assert "".join(shown) + rest == "visible"
+
+
+def test_note_think_ignores_empty_tool_call_responses(monkeypatch):
+    monkeypatch.setattr(llm_with_rag, "_model_emits_think", None)
+    llm_with_rag._note_think("")
+    llm_with_rag._note_think("  \n")
+    assert llm_with_rag._model_emits_think is None
+
+    llm_with_rag._note_think("reasoning</think>Answer")
+    assert llm_with_rag._model_emits_think is True
+    llm_with_rag._note_think("An answer without the tag")
+    assert llm_with_rag._model_emits_think is True
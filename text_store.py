@@ -0,0 +1,60 @@
+import os
+import re
+import gzip
+import json
+import tempfile
+from typing import Any, Dict, Generator, List, Optional
+
+# --- Configuration ---
+TEXT_STORE_DIR = os.getenv("TEXT_STORE_DIR", "text_store") # "" disables the store
+
+
+class TextStore:
+    """
+    Local, gzip-compressed store of extracted PDF text keyed by ETag.
+
+    One file per document holds its per-page text and the extraction meta,
+    so changing chunking parameters or the embedding model only needs a
+    CPU re-run over this store instead of re-downloading and re-parsing
+    every bill.
+    """
+
+    def __init__(self, root: str = TEXT_STORE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, etag: str) -> str:
+        safe = re.sub(r"[^A-Za-z0-9_.-]", "_", etag)
+        return os.path.join(self.root, safe[:2], f"{safe}.json.gz")
+
+    def has(self, etag: str) -> bool:
+        return os.path.exists(self._path(etag))
+
+    def get(self, etag: str) -> Optional[Dict[str, Any]]:
+        """Returns {"etag", "key", "pages", "meta"} or None when the ETag is not stored."""
+        try:
+            with gzip.open(self._path(etag), "rt", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, etag: str, key: str, pages: List[str], meta: Dict[str, Any]):
+        path = self._path(etag)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        record = {"etag": etag, "key": key, "pages": pages, "meta": meta}
+        # Write-then-rename so a crash never leaves a truncated record behind
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                f.write(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def iter_records(self) -> Generator[Dict[str, Any], None, None]:
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in sorted(filenames):
+                if name.endswith(".json.gz"):
+                    with gzip.open(os.path.join(dirpath, name), "rt", encoding="utf-8") as f:
+                        yield json.load(f)